@@ -1,8 +1,8 @@
 #!/usr/bin/env python2
 
-import sys, os, re, json, subprocess, gzip
+import sys, os, re, json, subprocess, contextlib
 from klab.process import tee
-from . import pipeline
+from . import pipeline, pdb_codecs
 
 def submit(script, workspace, **params):
     """Submit a job with the given parameters."""
@@ -84,13 +84,46 @@ def debrief():
     run_command(['/usr/local/sge/bin/linux-x64/qstat', '-j', job_number])
 
 def run_rosetta(workspace, job_info, 
-        use_resfile=False, use_restraints=False, use_fragments=False):
+        use_resfile=False, use_restraints=False, use_fragments=False,
+        write_metrics=None):
+
+    with rosetta_readable_copy(workspace.input_path(job_info)) as input_path:
+        _run_rosetta(
+                workspace, job_info, input_path,
+                use_resfile, use_restraints, use_fragments, write_metrics)
+
+@contextlib.contextmanager
+def rosetta_readable_copy(pdb_path):
+    """
+    Yield a path to the given model that rosetta can read.  Rosetta only reads 
+    uncompressed or gzipped models, so models in any other format (see 
+    pdb_codecs) are gzipped into a temporary directory, which is removed 
+    afterwards.  The copy has the same name as the original, so rosetta names 
+    its outputs the same way.
+    """
+    codec = pdb_codecs.find_codec(pdb_path)
+    if codec is None or codec.name in ('gz', 'none'):
+        yield pdb_path
+        return
+
+    import tempfile, shutil
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        name = os.path.basename(pdb_codecs.strip_extension(pdb_path))
+        tmp_path = os.path.join(tmp_dir, name + '.pdb.gz')
+        pdb_codecs.write_bytes(tmp_path, pdb_codecs.read_bytes(pdb_path))
+        yield tmp_path
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def _run_rosetta(workspace, job_info, input_path,
+        use_resfile, use_restraints, use_fragments, write_metrics):
 
     rosetta_cmd = [
         workspace.rosetta_scripts_path,
         '-database', workspace.rosetta_database_path,
-        '-in:file:s', workspace.input_path(job_info),
-        '-in:file:native', workspace.input_path(job_info),
+        '-in:file:s', input_path,
+        '-in:file:native', input_path,
         '-out:prefix', workspace.output_prefix(job_info),
         '-out:suffix', workspace.output_suffix(job_info),
         '-out:no_nstruct_label',
@@ -116,6 +149,12 @@ def run_rosetta(workspace, job_info,
 
     run_command(rosetta_cmd)
     run_external_metrics(workspace, job_info)
+    compress_output(workspace, job_info)
+
+    if write_metrics is None:
+        write_metrics = workspace.write_metrics_sidecars
+    if write_metrics:
+        write_metrics_sidecar(workspace, job_info)
 
 def run_external_metrics(workspace, job_info):
     pdb_path = workspace.output_path(job_info)
@@ -132,14 +171,63 @@ def run_external_metrics(workspace, job_info):
         sys.stdout.flush()
 
         stdout, stderr = tee([metric, pdb_path])
-        file = gzip.open(pdb_path, 'a')
+        lines = [
+                line + '\n' for line in stdout.split('\n')
+                if line.startswith('EXTRA_METRIC ')]
+
+        # Appending nothing would still add an empty member to compressed 
+        # files.
+        if lines:
+            pdb_codecs.append_lines(pdb_path, lines)
+
+def compress_output(workspace, job_info):
+    """
+    Convert the structure that was just generated (which rosetta always 
+    gzips) into the format chosen for the workspace.  This has to happen after 
+    the external metrics are added to the structure, and before its metrics 
+    sidecar is written.
+    """
+    pdb_path = workspace.output_path(job_info)
+
+    # Bail out if the PDB file doesn't exist for some reason.
+    if not os.path.exists(pdb_path):
+        return
+
+    pdb_codecs.recompress(pdb_path, workspace.model_compression)
+
+def write_metrics_sidecar(workspace, job_info):
+    """
+    Calculate the metrics for the structure that was just generated, so they 
+    don't have to be calculated when the structure is cached later on.  This 
+    has to happen after the external metrics are added to the structure.
+
+    The sidecar is only an optimization, so if it can't be written (e.g. 
+    because the analysis dependencies aren't installed on the cluster), the 
+    problem is reported and the job carries on.  The metrics will just be 
+    calculated when the structure is cached.
+    """
+    import traceback
 
-        for line in stdout.split('\n'):
-            if line.startswith('EXTRA_METRIC '):
-                file.write(line + '\n')
+    # The structure may have been recompressed by compress_output().
+    pdb_path = pdb_codecs.find_model(workspace.output_path(job_info))
+
+    # Bail out if the PDB file doesn't exist for some reason.
+    if pdb_path is None:
+        return
+
+    try:
+        from . import structures
+
+        print "Writing metrics:", structures.metrics_sidecar_path(pdb_path)
+        sys.stdout.flush()
+
+        structures.write_metrics_sidecar(workspace, pdb_path)
+
+    except Exception:
+        print "Couldn't write metrics for '{}':".format(pdb_path)
+        traceback.print_exc(file=sys.stdout)
+        sys.stdout.flush()
 
-        file.close()
-            
 def run_command(command):
     print "Working directory:", os.getcwd()
     print "Command:", ' '.join(command)
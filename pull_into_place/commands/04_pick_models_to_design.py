@@ -22,6 +22,16 @@ Options:
 
     --dry-run, -d
         Choose which models to pick, but don't actually make any symlinks.
+
+    --compact, -c
+        Keep the metrics in a more memory efficient form (i.e. single precision 
+        floats and categorical strings) while picking.  This is useful for very 
+        large rounds, but a metric that is exactly equal to a threshold may be 
+        picked differently.
+
+    -j, --processes NUM     [default: 1]
+        The number of processes to use when reading models that haven't been 
+        cached yet.  Specify 0 to use one process per CPU.
 """
 
 import os, glob
@@ -45,6 +55,8 @@ def main():
             use_cache=not args['--recalc'],
             dry_run=args['--dry-run'],
             keep_dups=True,
+            compact=args['--compact'],
+            processes=int(args['--processes']),
     )
     
 
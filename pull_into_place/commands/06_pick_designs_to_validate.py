@@ -39,6 +39,16 @@ Options:
         Don't actually fill in the input directory of the validation workspace.  
         Instead just report how many designs would be picked.
 
+    --compact, -c
+        Keep the metrics in a more memory efficient form (i.e. single precision 
+        floats and categorical strings) while picking.  This is useful for very 
+        large rounds, but a metric that is exactly equal to a threshold may be 
+        picked differently.
+
+    -j, --processes NUM     [default: 1]
+        The number of processes to use when reading models that haven't been 
+        cached yet.  Specify 0 to use one process per CPU.
+
 Metrics:
     The given metrics specify which scores will be used to construct the Pareto 
     front.  You can refer to any of the metrics available in the 'plot_funnels' 
@@ -86,4 +96,6 @@ def main():
             clear=args['--clear'],
             use_cache=not args['--recalc'],
             dry_run=args['--dry-run'],
+            compact=args['--compact'],
+            processes=int(args['--processes']),
     )
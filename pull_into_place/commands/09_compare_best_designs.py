@@ -58,7 +58,7 @@ from __future__ import division
 import os, re, sys, string, itertools, yaml, numpy as np, pandas as pd
 from klab import docopt, scripting
 from nonstdlib import indices_from_str
-from .. import pipeline, structures
+from .. import pipeline, structures, pdb_codecs
 
 class Metric (object):
     """
@@ -132,7 +132,7 @@ class DesignNameMetric (Metric):
 
     def load_cell(self, design, verbose=False):
         round = re.search('round_(\d+)', design.directory).group(1)
-        name = design['path'][design.rep][:-len('.pdb.gz')]
+        name = pdb_codecs.strip_extension(design['path'][design.rep])
         design.name = "Round {}: {}".format(round, name)
 
     def face_value(self, design):
@@ -167,6 +167,7 @@ class SequenceClusterMetric (Metric):
 
     def __init__(self, matrix_name):
         from klab.bio.subs_matrix import load_subs_matrix
+        self.matrix_name = matrix_name
         self.subs_matrix = load_subs_matrix(matrix_name)
 
     def load(self, designs, verbose=False):
@@ -261,16 +262,38 @@ class SequenceClusterMetric (Metric):
             pylab.show()
 
     def _get_pairwise_distance_matrix(self, designs):
-        from klab.bio.subs_matrix import score_gap_free_alignment
-
+        # This calculates the same distance as score_gap_free_alignment() from 
+        # klab.bio.subs_matrix for every pair of designs, but it compares each 
+        # design to all the others at once by using the residue codes from 
+        # structures.sequence_matrix() to index into a lookup table.
+
+        # Pairs of residues that aren't in the substitution matrix are left as 
+        # NaN, and are an error (like they are for score_gap_free_alignment()) 
+        # rather than letting NaN distances into the clustering.
+
+        subs_table = np.full((256, 256), np.nan)
+        for (aa_1, aa_2), score in self.subs_matrix.items():
+            subs_table[ord(aa_1), ord(aa_2)] = score
+
+        seqs = np.array([x.resfile_sequence_codes for x in designs])
+        codes = np.unique(seqs)
+        unmapped = np.isnan(subs_table[np.ix_(codes, codes)])
+
+        if unmapped.any():
+            unknown = unmapped.all(axis=1)
+            if not unknown.any():
+                unknown = unmapped.any(axis=1)
+            raise KeyError("The '{}' substitution matrix has no scores for: {}".format(
+                self.matrix_name, ', '.join(repr(chr(x)) for x in codes[unknown])))
+        self_scores = subs_table[seqs, seqs]
         dist_matrix = np.zeros((len(designs), len(designs)))
-        design_combos = itertools.combinations(enumerate(designs), 2)
 
-        for (i, design_i), (j, design_j) in design_combos:
-            seq_i, seq_j = design_i.resfile_sequence, design_j.resfile_sequence
-            dist_matrix[i,j] = score_gap_free_alignment(seq_i, seq_j, self.subs_matrix)
-            dist_matrix[j,i] = dist_matrix[i,j]
+        for i in range(len(designs)):
+            score = subs_table[seqs[i], seqs].sum(axis=1)
+            max_score = np.maximum(self_scores[i], self_scores).sum(axis=1)
+            dist_matrix[i] = 1 - np.maximum(score, 0) / max_score
 
+        np.fill_diagonal(dist_matrix, 0)
         return dist_matrix
 
 
@@ -299,13 +322,22 @@ class StructureClusterMetric (Metric):
         return design.structure_cluster
 
     def read_loop_coords(self, design):
-        if design.rep_path.endswith('.gz'):
-            from gzip import open
-        else:
-            from __builtin__ import open
+        # Use the coordinates saved by `pull_into_place cache_models --coords` 
+        # if they're available, so the representative doesn't have to be read 
+        # again.
+
+        atoms = structures.loop_backbone_atoms(design.loops)
+        try:
+            paths, xyzs = structures.load_coords(design.directory, atoms)
+        except EnvironmentError:
+            paths, xyzs = [], None
+
+        rep = design['path'][design.rep]
+        if rep in paths and not np.isnan(xyzs[paths.index(rep)]).any():
+            design.loop_coords = xyzs[paths.index(rep)]
+            return
 
-        with open(design.rep_path) as file:
-            lines = file.readlines()
+        lines = pdb_codecs.read_lines(design.rep_path)
 
         loop_coords = []
         loop_indices = []
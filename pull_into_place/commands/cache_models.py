@@ -17,6 +17,17 @@ Options:
         
     -f, --recalc
         Force the cache to be regenerated.
+
+    -c, --coords
+        Also save the coordinates of the restrained atoms and the loop backbone 
+        atoms of each model, so that later steps (e.g. clustering the designs 
+        by loop RMSD) don't have to read the models again.
+
+    -j, --processes NUM     [default: 1]
+        The number of processes to use when reading structures that haven't 
+        been cached yet.  The structures from every directory given on the 
+        command line are divided between the same processes.  Specify 0 to use 
+        one process per CPU.
 """
 
 from klab import docopt, scripting
@@ -25,10 +36,11 @@ from .. import structures
 @scripting.catch_and_print_errors()
 def main():
     args = docopt.docopt(__doc__)
-    for directory in args['<directories>']:
-        structures.load(
-                directory,
-                use_cache=not args['--recalc'],
-                require_io_dir=False,
-        )
+    structures.load_dirs(
+            args['<directories>'],
+            use_cache=not args['--recalc'],
+            require_io_dir=False,
+            processes=int(args['--processes']),
+            store_coords=args['--coords'],
+    )
 
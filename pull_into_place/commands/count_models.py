@@ -13,10 +13,12 @@ Options:
     --recalc, -f
         Recalculate all the metrics that will be used to choose designs.
 
-    --restraints PATH
-        The path to a set of restraints that can be used to recalculate the 
-        restraint_distance metric.  This is only necessary if the cache is 
-        being regenerated in a directory that is not a workspace.
+    -j, --processes NUM     [default: 1]
+        The number of processes to use when reading models that haven't been 
+        cached yet.  Specify 0 to use one process per CPU.
+
+    -t, --threads NUM       [default: {load_threads}]
+        The number of directories to read from the cache and count at once.
 
 Queries:
     The query strings use the same syntax of the query() method of pandas 
@@ -49,6 +51,16 @@ Queries:
 
     'restraint_dist < 0.6'
     'buried_unsat_score <= 4'
+
+    The restraint metrics are always calculated using the restraints file of 
+    the workspace containing each directory.  To count models using different 
+    restraints, see the rescore_models command.
+
+Output:
+    If more than one directory is given, the number of matching models in each 
+    directory is printed, followed by the total.  Otherwise only the total is 
+    printed.  Only the metrics that the query refers to are read from the 
+    cache, and models are only read if they haven't been cached yet.
 """
 
 import os
@@ -57,15 +69,22 @@ from .. import pipeline, structures
 
 @scripting.catch_and_print_errors()
 def main():
-    args = docopt.docopt(__doc__)
-    num_models = 0
-
-    for directory in args['<directories>']:
-        records = structures.\
-                load(directory, args['--restraints'], not args['--recalc'])
-        if args['--query']:
-            records = records.query(args['--query'])
-        num_models += len(records)
+    args = docopt.docopt(
+            __doc__.format(load_threads=structures.LOAD_THREADS))
+    directories = args['<directories>']
+    counts = structures.count_models(
+            directories,
+            query=args['--query'],
+            use_cache=not args['--recalc'],
+            processes=int(args['--processes']),
+            threads=int(args['--threads']),
+    )
 
-    print num_models
+    if len(directories) > 1:
+        width = max(len(x) for x in directories)
+        for directory, count in zip(directories, counts):
+            print '{0:<{1}}  {2}'.format(directory, width, count)
+        print '{0:<{1}}  {2}'.format('Total', width, sum(counts))
+    else:
+        print sum(counts)
 
@@ -31,6 +31,15 @@ Options:
     --wait-time MINUTES, -w MINUTES     [default: 5]
         The amount of time to wait in between attempts to fetch and cache new 
         models, if the --keep-going flag was given.
+
+    --processes NUM, -j NUM     [default: 1]
+        The number of processes to use when caching the models that were just 
+        downloaded.  Specify 0 to use one process per CPU.
+
+    --coords, -c
+        Also save the coordinates of the restrained atoms and the loop backbone 
+        atoms of each model, so that later steps (e.g. clustering the designs 
+        by loop RMSD) don't have to read the models again.
 """
 
 from __future__ import division
@@ -51,6 +60,8 @@ def main():
                     remote_url=args['--remote'],
                     recursive=not args['--no-recurse'],
                     include_logs=args['--include-logs'],
+                    processes=int(args['--processes']),
+                    store_coords=args['--coords'],
             )
 
             print "Waiting {} min...".format(wait_secs // 60)
@@ -62,4 +73,6 @@ def main():
                 remote_url=args['--remote'],
                 recursive=not args['--no-recurse'],
                 include_logs=args['--include-logs'],
+                processes=int(args['--processes']),
+                store_coords=args['--coords'],
         )
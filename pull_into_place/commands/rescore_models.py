@@ -0,0 +1,65 @@
+#!/usr/bin/env python2
+
+"""\
+Calculate the restraint metrics that the models in the given directories would 
+have with one or more alternative restraints files.  The models aren't read 
+again: the metrics are calculated from the coordinates saved when the models 
+were cached, so this only takes a few seconds even for large directories.
+
+Usage:
+    pull_into_place rescore_models <directories>... (-r PATH)... [options]
+
+Options:
+    -r PATH, --restraints PATH
+        A restraints file to score the models against.  This option can be 
+        given more than once, in which case every restraints file is evaluated 
+        in the same pass.
+
+    -q QUERY, --query QUERY   [default: restraint_dist < 1.0]
+        Count the models meeting the given query for each restraints file. 
+        The query uses the same syntax as the count_models command.
+
+    -o PATH, --output PATH
+        Save the rescored metrics for every model to the given CSV file.  The 
+        file has one row for each model and restraints file.
+
+Only the coordinates of atoms that were restrained when the models were cached 
+are saved in the cache, along with the loop backbone atoms if the models were 
+cached with the `--coords` option.  Restraints involving any other atoms will 
+produce NaN metrics.
+"""
+
+import pandas as pd
+from klab import docopt, scripting
+from .. import structures
+
+@scripting.catch_and_print_errors()
+def main():
+    args = docopt.docopt(__doc__)
+    restraints_paths = args['--restraints']
+    results = structures.rescore_restraints(
+            args['<directories>'], restraints_paths)
+
+    row = '{0:<40} {1:>8} {2:>8} {3:>12} {4:>8}'
+    print row.format('Restraints', 'Models', 'Best', 'Median', 'Passing')
+
+    for path, (records, metadata) in zip(restraints_paths, results):
+        dists = records.get('restraint_dist', pd.Series())
+        passing = records.query(args['--query']) if len(records) else records
+        print row.format(
+                path,
+                len(records),
+                '{0:.3f}'.format(dists.min()),
+                '{0:.3f}'.format(dists.median()),
+                len(passing),
+        )
+
+    if args['--output']:
+        frames = []
+        for path, (records, metadata) in zip(restraints_paths, results):
+            records.insert(0, 'restraints', path)
+            frames.append(records)
+        columns = ['restraints', 'directory', 'path'] + sorted(
+                set(x for df in frames for x in df if x.startswith('restraint_')))
+        pd.concat([x.reindex(columns=columns) for x in frames], ignore_index=True)\
+                .to_csv(args['--output'], index=False)
@@ -24,6 +24,7 @@ think a bit about how to do that.
 """
 
 import os, tempfile, subprocess
+import numpy as np
 import weblogolib as weblogo, corebio
 
 from klab import docopt, scripting
@@ -37,21 +38,21 @@ def main():
     directory = args['<directory>']
 
     if directory:
-        models, filters = structures.load(directory)
+        models, filters = structures.load(directory, columns=['sequence'])
         resfile = pipeline.load_resfile(directory)
-        resis = sorted(int(i) for i in resfile.designable)
-        print resis
+        sequences = structures.sequence_matrix(models['sequence'])
+        designable = structures.designable_mask(resfile, sequences.shape[1])
+        print (np.flatnonzero(designable) + 1).tolist()
         title = directory
-        sequences = [
-                ''.join(models['sequence'][i][j-1] for j in resis)
-                for i in models.index
-        ]
+        sequences = [x.tostring() for x in sequences[:, designable]]
 
     else:
         workspace = pipeline.ValidatedDesigns(root, round)
         workspace.check_paths()
         title = workspace.focus_dir
-        designs = [structures.Design(x) for x in workspace.output_subdirs]
+        designs = [
+                structures.Design(x, columns=structures.Design.essential_columns)
+                for x in workspace.output_subdirs]
         sequences = [x.resfile_sequence for x in designs]
 
     sequences = corebio.seq.SeqList(
@@ -0,0 +1,282 @@
+#!/usr/bin/env python2
+
+"""\
+This module reads and writes model files in any of the compression formats
+supported by the pipeline, so that the rest of the code doesn't have to care
+how a model was saved.  The format of a model is determined by its file
+extension:
+
+    .pdb        Uncompressed.
+    .pdb.gz     gzip, which is what rosetta writes (the default).
+    .pdb.bz2    bzip2, which is smaller but slower.
+    .pdb.zst    zstandard, which is about as small as gzip but much faster.
+                This uses the ``zstandard`` python module if it's installed,
+                or the ``zstd`` command-line program otherwise.
+
+Models can be appended to (e.g. to add extra metrics) in any format.  Since
+rosetta can only write gzipped models, models are recompressed into the format
+chosen for the workspace (see Workspace.model_compression) once they're
+finished.
+"""
+
+import os, gzip, io, subprocess
+
+def find_codec(path):
+    """
+    Return the codec for the given model, based on its file extension, or None
+    if the path doesn't seem to refer to a model.
+    """
+    for codec in CODECS:
+        if path.endswith(codec.extension):
+            return codec
+
+def codec_from_name(name):
+    """
+    Return the codec with the given name (e.g. 'gz'), as used to specify the
+    format of new models.
+    """
+    for codec in CODECS:
+        if codec.name == name:
+            return codec
+
+    raise IOError("unknown model compression '{0}', expected one of: {1}".format(
+        name, ', '.join(x.name for x in CODECS)))
+
+def is_pdb_path(path):
+    return find_codec(path) is not None
+
+def strip_extension(path):
+    """
+    Return the given path without its model extension (e.g. '.pdb.gz').
+    """
+    codec = find_codec(path)
+    return path[:-len(codec.extension)] if codec else path
+
+def find_model(path):
+    """
+    Return the path to the model with the same name as the given path, but in
+    any format, or None if there isn't one.  This is useful for finding models
+    that may have been recompressed.
+    """
+    for codec in CODECS:
+        candidate = strip_extension(path) + codec.extension
+        if os.path.exists(candidate):
+            return candidate
+
+def read_bytes(path):
+    """
+    Return the decompressed contents of the given model.  An IOError is raised
+    if the file can't be read or isn't a valid file of the format implied by
+    its extension.
+    """
+    codec = find_codec(path)
+    if codec is None:
+        raise IOError("'{0}' isn't a model file".format(path))
+
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    try:
+        return codec.decompress(data)
+    except EnvironmentError as error:
+        raise IOError("couldn't decompress '{0}': {1}".format(path, error))
+
+def read_lines(path):
+    """
+    Return the lines of the given model, like readlines() would.  Splitting the
+    decompressed file all at once is several times faster than readlines(),
+    which splits the lines in python rather than in C.
+    """
+    return read_bytes(path).splitlines(True)
+
+def append_lines(path, lines):
+    """
+    Add the given lines to the end of the given model, without rewriting the
+    rest of the file.  Every format allows compressed data to be appended to a
+    file, and it's read back as if the whole file was compressed at once.
+    """
+    codec = find_codec(path)
+    if codec is None:
+        raise IOError("'{0}' isn't a model file".format(path))
+
+    with open(path, 'ab') as file:
+        file.write(codec.compress(b''.join(lines)))
+
+def write_bytes(path, data):
+    """
+    Compress the given data into a new model, in the format implied by the 
+    path's extension.  The file is written under a temporary name and then 
+    renamed, so it's never seen half-written.
+    """
+    codec = find_codec(path)
+    if codec is None:
+        raise IOError("'{0}' isn't a model file".format(path))
+
+    tmp_path = '{0}.tmp{1}'.format(path, os.getpid())
+
+    with open(tmp_path, 'wb') as file:
+        file.write(codec.compress(data))
+
+    os.rename(tmp_path, path)
+
+def recompress(path, name):
+    """
+    Convert the given model into the format with the given name (see
+    codec_from_name()) and return the path to the converted model.  The
+    original file is replaced, but the converted file is written completely
+    before the original is removed, so the model is never missing.
+    """
+    old_codec = find_codec(path)
+    new_codec = codec_from_name(name)
+
+    if old_codec is new_codec:
+        return path
+
+    new_path = strip_extension(path) + new_codec.extension
+    write_bytes(new_path, read_bytes(path))
+    os.remove(path)
+    return new_path
+
+def _run_filter(command, data):
+    try:
+        process = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+        )
+    except OSError as error:
+        raise IOError("couldn't run '{0}': {1}".format(command[0], error))
+
+    stdout, stderr = process.communicate(data)
+
+    if process.returncode != 0:
+        raise IOError("'{0}' failed: {1}".format(
+            ' '.join(command), stderr.strip()))
+
+    return stdout
+
+
+class PlainCodec(object):
+    name = 'none'
+    extension = '.pdb'
+
+    def compress(self, data):
+        return data
+
+    def decompress(self, data):
+        return data
+
+
+class GzipCodec(object):
+    name = 'gz'
+    extension = '.pdb.gz'
+
+    def compress(self, data):
+        buffer = io.BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as file:
+            file.write(data)
+        return buffer.getvalue()
+
+    def decompress(self, data):
+        import zlib
+
+        # Use zlib directly rather than the gzip module, which is about 15% 
+        # slower because it decompresses in small chunks in python.  (External 
+        # programs like pigz are slower still for files the size of a model, 
+        # because starting a process takes longer than decompressing it.)  
+        # Each append adds a new gzip member, and zlib stops at the end of 
+        # each one and checks its CRC.  A sentinel byte is added to the end of 
+        # the data, so that a member that ends with the file (i.e. the last 
+        # one, unless it's truncated) leaves just the sentinel unused.
+        if not data:
+            return b''
+
+        sentinel = b'\0'
+        data += sentinel
+        chunks = []
+
+        try:
+            while True:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                chunks.append(decompressor.decompress(data))
+                data = decompressor.unused_data
+
+                if data == sentinel:
+                    break
+                if not data:
+                    raise IOError("compressed data ended before the end of the stream")
+
+        except zlib.error as error:
+            raise IOError(str(error))
+
+        return b''.join(chunks)
+
+
+class Bzip2Codec(object):
+    name = 'bz2'
+    extension = '.pdb.bz2'
+
+    def compress(self, data):
+        import bz2
+        return bz2.compress(data)
+
+    def decompress(self, data):
+        import bz2
+
+        # Each append adds a new stream, but python2's bz2 module only reads
+        # one stream at a time.  A decompressor that has seen a whole stream
+        # raises EOFError if given any more data, which is used to make sure
+        # that the last stream isn't truncated.
+        chunks = []
+
+        while data:
+            decompressor = bz2.BZ2Decompressor()
+            chunks.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+
+            if not data:
+                try:
+                    decompressor.decompress(b'')
+                except EOFError:
+                    break
+                raise IOError("compressed data ended before the end of the stream")
+
+        return b''.join(chunks)
+
+
+class ZstdCodec(object):
+    name = 'zst'
+    extension = '.pdb.zst'
+
+    def compress(self, data):
+        try:
+            import zstandard
+        except ImportError:
+            return _run_filter(['zstd', '--quiet', '--stdout'], data)
+
+        return zstandard.ZstdCompressor(write_checksum=True).compress(data)
+
+    def decompress(self, data):
+        try:
+            import zstandard
+        except ImportError:
+            return _run_filter(['zstd', '--quiet', '--decompress', '--stdout'], data)
+
+        # Unlike the command-line program, the python module doesn't notice if 
+        # the last frame is truncated.  That can't happen to models written by 
+        # recompress(), which only replaces a model once it's fully written.
+        try:
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                    io.BytesIO(data), read_across_frames=True)
+            return reader.read()
+        except zstandard.ZstdError as error:
+            raise IOError(str(error))
+
+
+# Every supported format, in the order that find_model() looks for them.
+CODECS = [GzipCodec(), PlainCodec(), Bzip2Codec(), ZstdCodec()]
+
+
+class IOError (IOError):
+    no_stack_trace = True
@@ -12,6 +12,7 @@ the design, each of which is related to a cluster job.
 import os, re, glob, json, pickle
 from klab import scripting
 from pprint import pprint
+from . import pdb_codecs
 
 class Workspace(object):
     """
@@ -202,6 +203,10 @@ Expected to find a file matching '{0}'.  Did you forget to compile rosetta?
     def metrics_dir(self):
         return self.find_path('metrics')
 
+    @property
+    def metrics_index_path(self):
+        return os.path.join(self.root_dir, 'metrics.db')
+
     @property
     def metric_scripts(self):
         return glob.glob(os.path.join(self.metrics_dir, '*'))
@@ -237,6 +242,36 @@ Expected to find a file matching '{0}'.  Did you forget to compile rosetta?
         with open(self.rsync_url_path) as file:
             return file.read().strip()
 
+    @property
+    def model_compression_path(self):
+        return self.find_path('model_compression')
+
+    @property
+    def model_compression(self):
+        """
+        The format that new models should be saved in (e.g. 'gz', 'bz2', 
+        'zst', or 'none'; see pdb_codecs).  Models are gzipped by default.
+        """
+        if not os.path.exists(self.model_compression_path):
+            return 'gz'
+        with open(self.model_compression_path) as file:
+            return file.read().strip()
+
+    @property
+    def metrics_sidecars_path(self):
+        return self.find_path('metrics_sidecars')
+
+    @property
+    def write_metrics_sidecars(self):
+        """
+        Whether the cluster jobs should calculate the metrics for each model 
+        as soon as it's made (see structures.write_metrics_sidecar()).  This 
+        is off unless a file called 'metrics_sidecars' exists, because it 
+        requires the analysis dependencies (numpy, pandas, etc.) to be 
+        installed on the cluster.
+        """
+        return os.path.exists(self.metrics_sidecars_path)
+
     @property
     def rsync_recursive_flag(self):
         return False
@@ -407,7 +442,8 @@ class BigJobWorkspace(Workspace):
 
     def output_path(self, job_info):
         prefix = self.output_prefix(job_info)
-        basename = os.path.basename(self.input_path(job_info)[:-len('.pdb.gz')])
+        basename = os.path.basename(
+                pdb_codecs.strip_extension(self.input_path(job_info)))
         suffix = self.output_suffix(job_info)
         return prefix + basename + suffix + '.pdb.gz'
 
@@ -684,11 +720,11 @@ class ValidatedDesigns(BigJobWorkspace, WithFragmentLibs):
         return sorted(glob.glob(os.path.join(self.output_dir, '*/')))
 
     def output_subdir(self, input_name):
-        basename = os.path.basename(input_name[:-len('.pdb.gz')])
+        basename = os.path.basename(pdb_codecs.strip_extension(input_name))
         return os.path.join(self.output_dir, basename)
 
     def output_prefix(self, job_info):
-        input_model = self.input_basename(job_info)[:-len('.pdb.gz')]
+        input_model = pdb_codecs.strip_extension(self.input_basename(job_info))
         return os.path.join(self.output_dir, input_model) + '/'
 
     def output_suffix(self, job_info):
@@ -721,7 +757,7 @@ class AdditionalMetricWorkspace (Workspace):
         inputs = []
         for subdir, dirs, files in os.walk(self.root_directory):
             for file in files:
-                if file.endswith('.pdb') or file.endswith('.pdb.gz'):
+                if pdb_codecs.is_pdb_path(file):
                     inputs.append(os.path.join(subdir, file))
         return inputs
 
@@ -872,8 +908,11 @@ def load_resfile(directory, resfile_path=None):
         workspace = workspace_from_dir(directory)
         resfile_path = workspace.resfile_path
 
+    # Remember where the resfile came from, for error messages.
     from klab.rosetta.input_files import Resfile
-    return Resfile(resfile_path)
+    resfile = Resfile(resfile_path)
+    resfile.path = resfile_path
+    return resfile
 
 def fetch_data(directory, remote_url=None, recursive=True, include_logs=False, dry_run=False):
     import os, subprocess
@@ -902,6 +941,7 @@ def fetch_data(directory, remote_url=None, recursive=True, include_logs=False, d
             '--exclude', 'rosetta',
             '--exclude', 'rsync_url',
             '--exclude', 'fragments',
+            '--exclude', 'metrics.db*',
             '--exclude', 'core.*',
             '--exclude', 'sequence_profile*',
     ]
@@ -930,13 +970,14 @@ def fetch_data(directory, remote_url=None, recursive=True, include_logs=False, d
     else:
         subprocess.call(rsync_command)
 
-def fetch_and_cache_data(directory, remote_url=None, recursive=True, include_logs=False):
+def fetch_and_cache_data(directory, remote_url=None, recursive=True, include_logs=False, processes=1, store_coords=False):
     from . import structures
     fetch_data(directory, remote_url, recursive, include_logs)
 
     # Don't try to cache anything if nothing has been downloaded yet.
     if glob.glob(os.path.join(directory, '*.pdb*')):
-        structures.load(directory)
+        structures.load(
+                directory, processes=processes, store_coords=store_coords)
 
 def push_data(directory, remote_url=None, recursive=True, dry_run=False):
     import os, subprocess
@@ -954,6 +995,7 @@ def push_data(directory, remote_url=None, recursive=True, dry_run=False):
     ] +   (['--no-recursive'] if not recursive else []) + [
             '--exclude', 'rosetta',
             '--exclude', 'rsync_url',
+            '--exclude', 'metrics.db*',
             '--exclude', 'logs',
             directory + '/', remote_dir,
     ]
@@ -8,120 +8,1642 @@ from __future__ import unicode_literals
 This module provides a function that will read a directory of PDB files and
 return a pandas data frame containing a number of score, distance, and sequence
 metrics for each structure.  This information is also cached, because it takes
-a while to calculate up front.  Note that the cache files are pickles and seem
-to depend very closely on the version of pandas used to generate them.  For
-example, caches generated with pandas 0.15 can't be read by pandas 0.14.
+a while to calculate up front.  The cache is stored as one ``numpy`` array per
+column (see write_metrics_table()), so it can be read one column at a time and
+doesn't depend on the version of pandas used to generate it.
 """
 
-import sys, os, re, glob, collections, gzip, re, yaml, codecs
+import sys, os, re, glob, time, collections, contextlib, re, yaml, codecs, json
 import numpy as np, scipy as sp, pandas as pd
 from scipy.spatial.distance import euclidean
 from klab import scripting
 from pprint import pprint
-from . import pipeline
+from . import pipeline, pdb_codecs
 
-def load(pdb_dir, use_cache=True, job_report=None, require_io_dir=True):
+def load(pdb_dir, use_cache=True, job_report=None, require_io_dir=True, processes=1, store_coords=False, compact=False, columns=None):
     """
     Return a variety of score and distance metrics for the structures found in
     the given directory.  As much information as possible will be cached.  Note
-    that new information will only be calculated for file names that haven't
-    been seen before.  If a file changes or is deleted, the cache will not be
-    updated to reflect this and you may be presented with stale data.
+    that new information will only be calculated for files that haven't been
+    seen before or that have changed (i.e. have a different size, modification
+    time, or inode) since they were cached.  Files that have been deleted are
+    dropped from the cache.  If the restraints file changes, the restraint 
+    metrics are recalculated from the cached coordinates of the restrained 
+    atoms whenever possible, see MetricsCache.
+
+    If processes is greater than 1, the structures that haven't been cached yet 
+    will be divided between that many worker processes.
+
+    If store_coords is true, the coordinates of the restrained atoms and the 
+    loop backbone atoms of every structure are also saved, so that they can 
+    later be retrieved by load_coords() without reading the structures again.
+
+    If compact is true, the data frame uses less memory, at the expense of some 
+    precision (see compact_metrics()).
+
+    If columns is given, only those columns (plus the 'path' column) are read 
+    from the cache and returned.  Shell-style wildcards can be used to select 
+    families of metrics, e.g. 'restraint_dist_*' (see match_columns()).  This 
+    is much faster than reading every column when only a few metrics are 
+    needed.  To read columns only once they're used, see load_lazy().
+
+    New metrics are written to the cache periodically while the structures 
+    are being read (see MetricsCache.checkpoint()), so if this function is 
+    interrupted, calling it again only reads the structures that weren't 
+    checkpointed yet.
     """
+    cache = MetricsCache(pdb_dir, use_cache, require_io_dir, store_coords, columns)
+    try:
+        records, metadata = read_and_calculate(
+                cache.workspace, cache.uncached_paths, processes,
+                coord_atoms=cache.coord_atoms, checkpoint=cache.checkpoint)
+    except KeyboardInterrupt:
+        cache.flush_checkpoint()
+        raise
+    records, metadata = cache.update(records, metadata, job_report)
+    return (compact_metrics(records) if compact else records), metadata
+
+def load_dirs(pdb_dirs, use_cache=True, require_io_dir=True, processes=1, store_coords=False, compact=False, columns=None, threads=1):
+    """
+    Load the metrics for several directories at once, and return a list with 
+    one (records, metadata) tuple for each directory.
+
+    The advantage of calling this function rather than calling load() for each 
+    directory is that all the uncached structures are distributed between a 
+    single pool of worker processes.  This keeps every process busy even when 
+    each individual directory only contains a handful of new structures, e.g.  
+    the output subdirectories of a validation run.
+
+    If threads is greater than 1, the directories are scanned and their caches 
+    are read in that many threads, which helps when there are many 
+    directories on a network filesystem.
+    """
+    caches = _thread_map(
+            lambda pdb_dir: MetricsCache(
+                pdb_dir, use_cache, require_io_dir, store_coords, columns),
+            pdb_dirs, threads)
+    try:
+        results = read_and_calculate_dirs(
+                [(x.workspace, x.uncached_paths, x.coord_atoms) for x in caches],
+                processes,
+                checkpoints=[x.checkpoint for x in caches],
+        )
+    except KeyboardInterrupt:
+        for cache in caches:
+            cache.flush_checkpoint()
+        raise
+    results = [
+            cache.update(records, metadata)
+            for cache, (records, metadata) in zip(caches, results)
+    ]
+    return [
+            (compact_metrics(records) if compact else records, metadata)
+            for records, metadata in results
+    ]
+
+def count_models(pdb_dirs, query=None, use_cache=True, require_io_dir=True, processes=1, threads=None):
+    """
+    Return a list with the number of models matching the given query (see 
+    DataFrame.query()) in each of the given directories, or the number of 
+    models in each directory if no query is given.
+
+    This is much faster than loading every directory and querying the data 
+    frames.  Directories that can be counted from their summary statistics 
+    (see count_from_summary()) aren't loaded at all.  Only the columns that 
+    the query refers to are read from the other caches, and the caches are 
+    read and queried in several threads.  pandas evaluates queries with 
+    numexpr (if it's installed), which releases the GIL, so the queries 
+    really do run in parallel.  Models that aren't cached yet are read first, 
+    in a single pool of processes (see load_dirs()).  By default, 
+    LOAD_THREADS threads are used.
+    """
+    pdb_dirs = list(pdb_dirs)
+    counts = [None] * len(pdb_dirs)
+    threads = threads or LOAD_THREADS
+
+    if use_cache:
+        counts = _thread_map(
+                lambda x: count_from_summary(read_metrics_summary(x), query),
+                pdb_dirs, threads)
+
+    uncounted = [i for i, x in enumerate(counts) if x is None]
+    if not uncounted:
+        return counts
+
+    columns = sorted(set(re.findall(r'[A-Za-z_]\w*', query or '')))
+    results = load_dirs(
+            [pdb_dirs[i] for i in uncounted],
+            use_cache, require_io_dir, processes,
+            columns=columns, threads=threads)
+
+    def count(records):
+        return len(records.query(query)) if query else len(records)
+
+    for i, n in zip(uncounted, _thread_map(count, [x[0] for x in results], threads)):
+        counts[i] = n
+
+    return counts
+
+def load_lazy(pdb_dir, use_cache=True, require_io_dir=True, processes=1):
+    """
+    Return a LazyMetrics object for the structures in the given directory.  
+    The cache is brought up to date exactly like it is by load(), but none of 
+    the metrics are read from it until they're actually used.
+    """
+    records, metadata = load(
+            pdb_dir, use_cache, None, require_io_dir, processes, columns=[])
+    return LazyMetrics(pdb_dir, records['path'])
+
+def compact_metrics(records):
+    """
+    Return a copy of the given data frame (e.g. from load()) that uses much 
+    less memory.  The metrics are stored as single precision floats, which is 
+    plenty for scores that are only printed to a few decimal places, but note 
+    that a value that is exactly on a threshold (e.g. 'restraint_dist < 1.2') 
+    may compare differently.  The paths are stored as byte strings (rather 
+    than unicode strings, which take 4 bytes per character), and every other 
+    string column (i.e. the sequences and, for frames from the metrics index, 
+    the directories and steps) is stored as a categorical column, so each 
+    distinct value is only kept once.
+
+    For a simulated round of 200,000 designs (500 designs for each of 400 
+    backbones, 250 residues, about 73,000 distinct sequences, and 30 metrics), 
+    the frame shrinks from 284 MB to 61 MB.
+    """
+    records = records.copy()
+
+    for column in records.columns:
+        dtype = records[column].dtype
+
+        if dtype == np.float64:
+            records[column] = records[column].astype(np.float32)
+        elif dtype == object and column == 'path':
+            records[column] = [
+                    x.encode('utf8') if isinstance(x, unicode) else x
+                    for x in records[column]]
+        elif dtype == object:
+            records[column] = records[column].map(
+                    lambda x: x.encode('utf8') if isinstance(x, unicode) else x)
+            records[column] = records[column].astype('category')
+
+    return records
+
+def match_columns(columns, patterns):
+    """
+    Return the given columns that match any of the given patterns, in the 
+    order of the patterns.  Each pattern is either the name of a column or a 
+    shell-style wildcard (e.g. 'fragment_crmsd_pos_*').  Patterns that don't 
+    match any column are ignored.
+    """
+    import fnmatch
+
+    matches = []
+    for pattern in patterns:
+        hits = [x for x in columns if x == pattern] or \
+                fnmatch.filter(columns, pattern)
+        matches += [x for x in hits if x not in matches]
 
-    # Make sure the given directory seems to be a reasonable place to look for
-    # data, i.e. it exists and contains PDB files.
+    return matches
 
+def scan_pdb_dir(pdb_dir):
+    """
+    Return a data frame with the name, size, modification time, and inode of 
+    every PDB file in the given directory, in any of the formats supported by 
+    pdb_codecs.
+
+    The directory is only listed once, and each file is only stat'ed once.  An 
+    IOError is raised if the directory doesn't exist or doesn't contain any PDB 
+    files.  The rows are sorted by file name.
+    """
     if not os.path.exists(pdb_dir):
         raise IOError("'{}' does not exist".format(pdb_dir))
     if not os.path.isdir(pdb_dir):
         raise IOError("'{}' is not a directory".format(pdb_dir))
-    if not os.listdir(pdb_dir):
+
+    file_names = os.listdir(pdb_dir)
+
+    if not file_names:
         raise IOError("'{}' is empty".format(pdb_dir))
-    if not glob.glob(os.path.join(pdb_dir, '*.pdb*')):
+    if not any('.pdb' in x for x in file_names):
         raise IOError("'{}' doesn't contain any PDB files".format(pdb_dir))
 
-    # The given directory must also be a workspace, so that the restraint file
-    # can be found and used to calculate the "restraint_dist" metric later on.
+    paths, sizes, mtimes, inodes = [], [], [], []
+
+    for file_name in sorted(file_names):
+        if not pdb_codecs.is_pdb_path(file_name):
+            continue
+        try:
+            stat = os.stat(os.path.join(pdb_dir, file_name))
+        except OSError:
+            continue
+
+        paths.append(file_name)
+        sizes.append(stat.st_size)
+        mtimes.append(stat.st_mtime)
+        inodes.append(stat.st_ino)
+
+    manifest = collections.OrderedDict()
+    manifest['path'] = np.array(paths, dtype=object)
+    manifest['_file_size'] = np.array(sizes, dtype=np.int64)
+    manifest['_file_mtime'] = np.array(mtimes, dtype=np.float64)
+    manifest['_file_inode'] = np.array(inodes, dtype=np.uint64)
+
+    return pd.DataFrame(manifest)
+
+def read_metrics_table(table_dir, columns=None):
+    """
+    Read a data frame that was saved by write_metrics_table().
+
+    Each column is stored in its own memory-mapped ``*.npy`` file (or in one 
+    row of the array for its metric family, see write_metrics_table()), so 
+    only the requested columns are actually read from disk.  By default, every 
+    column is read.  The columns can be given as wildcards (see 
+    match_columns()), and any that aren't in the table are skipped.  An 
+    IOError is raised if the table doesn't exist, was written with an 
+    incompatible version of the cache format, or seems to be incomplete.
+    """
+    schema = read_metrics_schema(table_dir)
+    known_columns = [x['name'] for x in schema['columns']]
+    if columns is None:
+        columns = known_columns
+    else:
+        columns = match_columns(known_columns, columns)
+
+    data = collections.OrderedDict()
+    column_infos = {x['name']: x for x in schema['columns']}
+    family_infos = {x['prefix']: x for x in schema.get('families', [])}
+    families = {}
+    num_rows = schema['num_rows']
+
+    for name in columns:
+        info = column_infos[name]
+
+        if 'family' in info:
+            prefix = info['family']
+            if prefix not in families:
+                families[prefix] = _read_family(
+                        table_dir, family_infos[prefix], num_rows)
+            data[name] = families[prefix](info['index'])
+            continue
+
+        array = np.load(os.path.join(table_dir, info['file']), mmap_mode='r')
+
+        if len(array) != num_rows:
+            raise IOError("'{}' has {} rows, expected {}".format(
+                info['file'], len(array), num_rows))
+
+        if info['kind'] == 'str':
+            array = np.char.decode(array, 'utf8').astype(object)
+
+        data[name] = array
+
+    return pd.DataFrame(data, index=pd.RangeIndex(num_rows))
+
+def _read_family(table_dir, family, num_rows):
+    """
+    Return a function that takes the index of a member of the given metric 
+    family and returns the values for that member (see write_metrics_table()).
+    """
+    path = lambda x: os.path.join(table_dir, family[x])
+
+    if family['layout'] == 'dense':
+        array = np.load(path('file'), mmap_mode='r')
+        if array.shape[1:] != (num_rows,):
+            raise IOError("'{}' has {} rows, expected {}".format(
+                family['file'], array.shape[1:], num_rows))
+        return lambda i: array[i]
+
+    # Sparse families are stored in long format: the row index and value of 
+    # every non-NaN entry, grouped by member.  The offsets give the range of 
+    # entries that belongs to each member.
+
+    offsets = family['offsets']
+    rows = np.load(path('rows'), mmap_mode='r')
+    values = np.load(path('values'), mmap_mode='r')
+
+    if len(rows) != offsets[-1] or len(values) != offsets[-1]:
+        raise IOError("'{}' seems to be incomplete".format(family['rows']))
+
+    def read_member(i):
+        member = np.full(num_rows, np.nan)
+        member[rows[offsets[i]:offsets[i+1]]] = values[offsets[i]:offsets[i+1]]
+        return member
+
+    return read_member
+
+def read_metrics_schema(table_dir):
+    """
+    Return the schema of a table that was saved by write_metrics_table(), 
+    after making sure that it was written with a compatible version of the 
+    cache format.
+    """
+    schema_path = os.path.join(table_dir, 'schema.json')
+
+    if not os.path.exists(schema_path):
+        raise IOError("'{}' not found".format(schema_path))
+
+    with open(schema_path) as file:
+        schema = json.load(file)
+
+    if schema.get('version') not in READABLE_CACHE_VERSIONS:
+        raise IOError("'{}' has version {}, expected {}".format(
+            table_dir, schema.get('version'), CACHE_VERSION))
+
+    return schema
+
+def read_metrics_array(table_dir, name):
+    """
+    Return one of the arrays that was saved along with a table by 
+    write_metrics_table().  The array is memory-mapped, so only the parts of 
+    it that are actually used are read from disk.
+    """
+    schema = read_metrics_schema(table_dir)
+    array_infos = {x['name']: x for x in schema.get('arrays', [])}
+
+    if name not in array_infos:
+        raise IOError("'{}' doesn't have a '{}' array".format(table_dir, name))
+
+    file_name = array_infos[name]['file']
+    array = np.load(os.path.join(table_dir, file_name), mmap_mode='r')
+
+    if len(array) != schema['num_rows']:
+        raise IOError("'{}' has {} rows, expected {}".format(
+            file_name, len(array), schema['num_rows']))
+
+    return array
+
+def write_metrics_table(table_dir, records, arrays=None, attrs=None):
+    """
+    Save the given data frame in a format that can be read one column at a time 
+    and that doesn't depend on the version of pandas used to write it.
+
+    The data frame is saved to a directory containing a ``schema.json`` file 
+    and one ``*.npy`` file for each column.  The schema records the version of 
+    the cache format (see CACHE_VERSION), the number of rows, and the name, 
+    file, and kind (i.e. 'float', 'int', or 'str') of each column.  Numeric 
+    columns are saved as they are.  String columns (e.g. 'path' and 
+    'sequence') are encoded as UTF-8 and saved as fixed-width byte strings.
+
+    The per-position metrics (see METRIC_FAMILIES) would otherwise add hundreds 
+    of files to each table, so the float columns belonging to each family are 
+    packed into a single array with one row per column.  If most of the values 
+    in a family are NaN (e.g. because the records came from different steps), 
+    only the values that are present are saved, along with their row indices.  
+    read_metrics_table() unpacks these columns, so callers never see the 
+    difference.
+
+    Multidimensional data that doesn't fit in a data frame (e.g. coordinates) 
+    can be saved alongside the columns by giving a dictionary of arrays, each 
+    with one row per record.  These arrays are read by read_metrics_array().  
+    Any other information that applies to the whole table (e.g. which atoms 
+    the coordinates belong to) can be given as a dictionary of JSON-friendly 
+    attributes, which are saved in the schema.
+
+    The table is written to a temporary directory which is then renamed, so 
+    readers never see a partially written table.  A directory can't be 
+    atomically renamed over an existing one, so tables are never replaced: an 
+    IOError is raised if the table already exists.  (The caches always write 
+    new shards with names that aren't in use yet.)
+    """
+    import shutil
+
+    if os.path.exists(table_dir):
+        raise IOError("'{}' already exists".format(table_dir))
+
+    tmp_dir = '{}.tmp{}'.format(table_dir, os.getpid())
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    schema = {
+            'version': CACHE_VERSION,
+            'num_rows': len(records),
+            'columns': [],
+    }
+
+    families = collections.OrderedDict()
+    for name in records.columns:
+        prefix = metric_family(name)
+        if prefix and records[name].dtype.kind == 'f':
+            families.setdefault(prefix, []).append(name)
+
+    families = {k: v for k, v in families.items() if len(v) > 1}
+    family_columns = {}
+
+    for prefix, names in sorted(families.items()):
+        family_columns.update({x: (prefix, i) for i, x in enumerate(names)})
+        schema.setdefault('families', []).append(
+                _write_family(tmp_dir, prefix, records[names].values.T))
+
+    for name in records.columns:
+        if name in family_columns:
+            prefix, index = family_columns[name]
+            schema['columns'].append({
+                'name': name,
+                'family': prefix,
+                'index': index,
+                'kind': 'float',
+            })
+            continue
+
+        column = records[name]
+        file_name = '{}.npy'.format(name)
+
+        if column.dtype == object:
+            kind = 'str'
+            array = np.array([
+                    ('' if pd.isnull(x) else unicode(x)).encode('utf8')
+                    for x in column], dtype=bytes)
+        elif column.dtype.kind in 'iu':
+            kind = 'int'
+            array = column.values
+        else:
+            kind = 'float'
+            array = column.values.astype(float)
+
+        np.save(os.path.join(tmp_dir, file_name), array)
+        schema['columns'].append({
+            'name': name,
+            'file': file_name,
+            'kind': kind,
+        })
+
+    for name, array in sorted((arrays or {}).items()):
+        if len(array) != len(records):
+            raise ValueError("'{}' has {} rows, expected {}".format(
+                name, len(array), len(records)))
+
+        file_name = '{}.npy'.format(name)
+        np.save(os.path.join(tmp_dir, file_name), array)
+        schema.setdefault('arrays', []).append({
+            'name': name,
+            'file': file_name,
+        })
+
+    if attrs:
+        schema['attrs'] = attrs
+
+    with open(os.path.join(tmp_dir, 'schema.json'), 'w') as file:
+        json.dump(schema, file)
+
+    # The rename fails if another table was written to the same place in the 
+    # meantime, rather than replacing it.
+
+    os.rename(tmp_dir, table_dir)
+
+def _write_family(table_dir, prefix, array):
+    array = np.ascontiguousarray(array, dtype=float)
+    present = ~np.isnan(array)
+    family = {'prefix': prefix}
+
+    if present.mean() >= 0.5:
+        family['layout'] = 'dense'
+        family['file'] = '{}family.npy'.format(prefix)
+        np.save(os.path.join(table_dir, family['file']), array)
+
+    else:
+        members, rows = np.nonzero(present)
+        counts = np.bincount(members, minlength=len(array))
+        family['layout'] = 'long'
+        family['rows'] = '{}family.rows.npy'.format(prefix)
+        family['values'] = '{}family.values.npy'.format(prefix)
+        family['offsets'] = [0] + np.cumsum(counts).tolist()
+        np.save(os.path.join(table_dir, family['rows']), rows.astype(np.int32))
+        np.save(os.path.join(table_dir, family['values']), array[present])
+
+    return family
+
+def metric_family(name):
+    """
+    Return the prefix of the per-position metric family (see METRIC_FAMILIES) 
+    that the given column belongs to, or None.
+    """
+    for prefix in METRIC_FAMILIES:
+        if name.startswith(prefix) and name != prefix:
+            return prefix
+
+def read_metadata(metadata_path):
+    """
+    Return the metadata saved in the given YAML file, as a dictionary mapping 
+    metric names to ScoreMetadata objects.
+    """
+    with codecs.open(metadata_path, encoding='utf8') as file:
+        metadata_list = [ScoreMetadata(**x) for x in yaml.safe_load(file)]
+        return {x.name: x for x in metadata_list}
+
+def write_metadata(metadata_path, metadata):
+    """
+    Save the given metadata (a dictionary of ScoreMetadata objects) to a YAML 
+    file.  The file is replaced atomically, so readers will see either the old 
+    or the new metadata, but never a partially written file.
+    """
+    tmp_path = '{}.tmp{}'.format(metadata_path, os.getpid())
+    with codecs.open(tmp_path, 'w', encoding='utf8') as file:
+        yaml.safe_dump([v.to_dict() for k,v in metadata.items()], file)
+    os.rename(tmp_path, metadata_path)
+
+@contextlib.contextmanager
+def lock_metrics_cache(cache_dir):
+    """
+    Prevent other processes (and threads) from writing to the given cache 
+    until the with-block exits.
+
+    Only writers need to acquire this lock.  Shards are never modified once 
+    they've been written, and they're only deleted once a compacted shard 
+    containing the same records is in place, so readers can always get a 
+    consistent view of the cache without waiting for writers to finish.
+    """
+    import fcntl
 
     try:
-        workspace = pipeline.workspace_from_dir(pdb_dir)
-    except pipeline.WorkspaceNotFound:
-        raise IOError("'{}' is not a workspace".format(pdb_dir))
-    if require_io_dir and not any(
-            os.path.samefile(pdb_dir, x) for x in workspace.io_dirs):
-        raise IOError("'{}' is not an input or output directory".format(pdb_dir))
-
-    # Find all the structures in the given directory, then decide which have
-    # already been cached and which haven't.
-
-    pdb_paths = glob.glob(os.path.join(pdb_dir, '*.pdb.gz'))
-    base_pdb_names = set(os.path.basename(x) for x in pdb_paths)
-    cache_path = os.path.join(pdb_dir, 'metrics.pkl')
-    metadata_path = os.path.join(pdb_dir, 'metrics.yml')
-
-    cached_records = []
-    uncached_paths = pdb_paths
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            raise
+
+    with open(os.path.join(cache_dir, 'lock'), 'a') as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+def list_metrics_shards(cache_dir):
+    """
+    Return the names of the shards making up the given cache, oldest first.
+
+    Each shard is a table (see write_metrics_table()) in a subdirectory named 
+    'shard_<first>_<last>'.  New records are appended to the cache by writing a 
+    new shard where <first> and <last> are both one more than the highest 
+    shard number in use.  Compacting the cache merges a range of shards into a 
+    single shard spanning the same range of numbers.  If a compacted shard is 
+    present, any shards that it spans are ignored, because they're about to be 
+    deleted.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+
+    shards = []
+    for name in os.listdir(cache_dir):
+        match = re.match(r'^shard_(\d+)_(\d+)$', name)
+        if match:
+            first, last = int(match.group(1)), int(match.group(2))
+            shards.append((first, last, name))
+
+    def is_spanned(shard):
+        first, last, name = shard
+        return any(
+                x[0] <= first and last <= x[1] and x != shard
+                for x in shards)
+
+    return [x[2] for x in sorted(shards) if not is_spanned(x)]
+
+def read_metrics_shards(cache_dir, columns=None, shards=None):
+    """
+    Read the given shards (every shard in the cache by default) and return a 
+    single data frame with the most recent record for each path, along with 
+    the total number of records that were read.
+
+    The 'path' column and the manifest columns are always read, because 
+    they're needed to decide which records are still valid.
+    """
+    if columns is not None:
+        columns = ['path'] + MANIFEST_COLUMNS + [
+                x for x in columns if x not in ['path'] + MANIFEST_COLUMNS]
+
+    # Retry if one of the shards disappears while we're reading it, which can 
+    # happen if the cache is being compacted at the same time.
+
+    for attempt in range(3):
+        listed_shards = shards or list_metrics_shards(cache_dir)
+        try:
+            tables = [
+                    read_metrics_table(os.path.join(cache_dir, x), columns)
+                    for x in listed_shards
+            ]
+            break
+        except EnvironmentError:
+            if shards or listed_shards == list_metrics_shards(cache_dir):
+                raise
+
+    if not tables:
+        raise IOError("'{}' doesn't contain any shards".format(cache_dir))
+
+    num_rows = sum(len(x) for x in tables)
+    records = concat_records(tables)
+    records = records.drop_duplicates('path', keep='last')
+    return records.reset_index(drop=True), num_rows
+
+def append_metrics_shard(cache_dir, records):
+    """
+    Write the given records to a new shard at the end of the given cache, and 
+    return the name of that shard.  The caller must hold the lock for the 
+    cache (see lock_metrics_cache()).
+    """
+    name = 'shard_{0:06d}_{0:06d}'.format(_next_shard_number(cache_dir))
+    write_metrics_table(os.path.join(cache_dir, name), records)
+    return name
+
+def _next_shard_number(cache_dir):
+    numbers = [-1] + [
+            int(x.split('_')[2]) for x in list_metrics_shards(cache_dir)]
+    return max(numbers) + 1
+
+def compact_metrics_cache(pdb_dir):
+    """
+    Merge all the shards in the cache for the given directory into one.
+
+    Records that have been superseded by more recent records for the same 
+    file, and records for files that have since been changed or deleted, are 
+    discarded in the process.  This is done automatically by load() in a 
+    background thread once the cache accumulates enough shards or discarded 
+    records, but it can also be called directly.  The coordinate store (see 
+    load_coords()) is compacted at the same time.
+    """
+    import shutil
+
+    cache_dir = os.path.join(pdb_dir, 'metrics_cache')
+    compact_coords_store(pdb_dir)
+
+    with lock_metrics_cache(cache_dir):
+        shards = list_metrics_shards(cache_dir)
+
+        # Clean up after any writers that crashed.  Nobody else can be writing 
+        # while we hold the lock, so any temporary directories are abandoned.
+
+        for name in os.listdir(cache_dir):
+            if re.match(r'^shard_\d+_\d+\.(tmp|old)\d+$', name):
+                shutil.rmtree(os.path.join(cache_dir, name))
+
+        if not shards:
+            return
+
+        records, num_rows = read_metrics_shards(cache_dir, shards=shards)
+        records, num_dropped = drop_stale_records(records, scan_pdb_dir(pdb_dir))
+
+        if len(shards) == 1 and num_rows == len(records):
+            return
+
+        # The compacted shard spans all the existing shards plus a new shard 
+        # number, so it has a name that isn't already in use.  It's written 
+        # before the old shards are removed, so that the records are never 
+        # missing from the cache.
+
+        first = int(shards[0].split('_')[1])
+        last = _next_shard_number(cache_dir)
+        name = 'shard_{0:06d}_{1:06d}'.format(first, last)
+        write_metrics_table(os.path.join(cache_dir, name), records)
+
+        for shard in shards:
+            shutil.rmtree(os.path.join(cache_dir, shard))
+
+def drop_stale_records(records, manifest):
+    """
+    Discard any records for files that have been deleted, or that have a 
+    different size, modification time, or inode than the given manifest (see 
+    scan_pdb_dir()).  Return the records that remain and the number of records 
+    that were discarded.
+
+    Records from caches that predate the manifest can't be checked, so they're 
+    assumed to still be valid (which is what older versions did) and adopt the 
+    values from the manifest.
+    """
+    current = manifest.set_index('path')
+    exists = records['path'].isin(current.index).values
+    records = records[exists].reset_index(drop=True)
+    current = current.loc[records['path']]
+    cached = records.reindex(columns=MANIFEST_COLUMNS)
+
+    unknown = cached.isnull().all(axis='columns').values
+    unchanged = np.ones(len(records), dtype=bool)
+    for column in MANIFEST_COLUMNS:
+        unchanged &= cached[column].values == current[column].values
+    fresh = unchanged | unknown
+
+    records = records[fresh].reset_index(drop=True)
+    for column in MANIFEST_COLUMNS:
+        records[column] = current[column].values[fresh]
+
+    num_dropped = len(exists) - len(records)
+    return records, num_dropped
+
+def concat_records(frames):
+    """
+    Concatenate the given data frames, which may not all have the same columns, 
+    without converting anything to dictionaries.  The columns are sorted, 
+    because that's what the data frame constructor does when given 
+    dictionaries.
+    """
+    frames = [x for x in frames if len(x)]
+    if not frames:
+        return pd.DataFrame()
+
+    columns = sorted(set().union(*[x.columns for x in frames]))
+    return pd.concat(
+            [x.reindex(columns=columns) for x in frames],
+            ignore_index=True,
+    )
+
+def metrics_sidecar_path(pdb_path):
+    """
+    Return the path to the file where the metrics for the given structure are 
+    saved by write_metrics_sidecar().
+    """
+    return pdb_codecs.strip_extension(pdb_path) + '.metrics.json'
+
+def write_metrics_sidecar(workspace, pdb_path):
+    """
+    Calculate the metrics for the given structure and save them to a file 
+    alongside it (see metrics_sidecar_path()).
+
+    This is meant to be called on the cluster, right after a structure is 
+    generated, so that load() doesn't have to read the structure again.  The 
+    size and modification time of the structure are saved along with the 
+    metrics, so load() can tell if the structure changed after the metrics 
+    were calculated (in which case the metrics are ignored).
+    """
+    records, metadata = read_and_calculate(workspace, [pdb_path], progress=False)
+    if not records:
+        return
+
+    stat = os.stat(pdb_path)
+    sidecar = {
+            'version': CACHE_VERSION,
+            'file_size': stat.st_size,
+            'file_mtime': stat.st_mtime,
+            'record': records[0],
+            'metadata': [v.to_dict() for k,v in metadata.items()],
+    }
+
+    sidecar_path = metrics_sidecar_path(pdb_path)
+    tmp_path = '{}.tmp{}'.format(sidecar_path, os.getpid())
+    with open(tmp_path, 'w') as file:
+        json.dump(sidecar, file)
+    os.rename(tmp_path, sidecar_path)
+
+def read_metrics_sidecars(pdb_dir, manifest, restraints_hash):
+    """
+    Return the records and metadata saved by write_metrics_sidecar() for any 
+    of the structures in the given manifest (see scan_pdb_dir()).
+
+    Metrics are ignored if the structure has a different size or modification 
+    time than when they were calculated, or if they were calculated using a 
+    different restraints file (as identified by the given hash).  The 
+    modification times are only compared to the nearest second, because some 
+    network filesystems report them with different precisions to different 
+    hosts.
+    """
+    records = []
     metadata = {}
 
-    if use_cache:
+    sidecar_names = set(x for x in os.listdir(pdb_dir) if x.endswith('.metrics.json'))
+    if not sidecar_names:
+        return records, metadata
+
+    for path, size, mtime in zip(
+            manifest['path'], manifest['_file_size'], manifest['_file_mtime']):
+
+        sidecar_name = metrics_sidecar_path(path)
+        if sidecar_name not in sidecar_names:
+            continue
+
         try:
-            cached_records = pd.read_pickle(cache_path).to_dict('records')
-            cached_paths = set(x['path'] for x in cached_records)
-            uncached_paths = [
-                    pdb_path for pdb_path in pdb_paths
-                    if os.path.basename(pdb_path) not in cached_paths]
+            with open(os.path.join(pdb_dir, sidecar_name)) as file:
+                sidecar = json.load(file)
 
-            with codecs.open(metadata_path, encoding='utf8') as file:
-                metadata_list = [ScoreMetadata(**x) for x in yaml.safe_load(file)]
-                metadata = {x.name: x for x in metadata_list}
+            if sidecar['version'] not in READABLE_CACHE_VERSIONS:
+                continue
+            if sidecar['file_size'] != size:
+                continue
+            if int(sidecar['file_mtime']) != int(mtime):
+                continue
+            if sidecar['record'].get('_restraints_hash') != restraints_hash:
+                continue
 
-        except:
-            cached_records = []
-            uncached_paths = pdb_paths
-            metadata = {}
+            record = sidecar['record']
+            submetadata = [ScoreMetadata(**x) for x in sidecar['metadata']]
 
-    # Calculate score and distance metrics for the uncached paths, then combine
-    # the cached and uncached data into a single data frame.
+        except (EnvironmentError, ValueError, KeyError, TypeError):
+            continue
 
-    uncached_records, uncached_metadata = \
-            read_and_calculate(workspace, uncached_paths)
+        record['path'] = path
+        records.append(record)
+        metadata.update({x.name: x for x in submetadata})
 
-    all_records = pd.DataFrame(cached_records + uncached_records)
-    metadata.update(uncached_metadata)
+    return records, metadata
 
-    # Make sure all the expected metrics were calculated.
+def metrics_summary_path(pdb_dir):
+    return os.path.join(pdb_dir, 'metrics_cache', 'summary.json')
 
-    expected_metrics = [
-            'total_score',
-            'restraint_dist',
-            'sequence',
+def manifest_fingerprint(manifest):
+    """
+    Return a hash of the given manifest (see scan_pdb_dir()), which changes if 
+    any structure is added, removed, or modified.
+    """
+    import hashlib
+    hashes = pd.util.hash_pandas_object(
+            manifest[['path'] + MANIFEST_COLUMNS], index=False)
+    return hashlib.md5(hashes.values.tobytes()).hexdigest()
+
+def summarize_metrics(records):
+    """
+    Return a dictionary with summary statistics for every numeric column of the 
+    given records: the number of values that aren't NaN, the minimum and 
+    maximum, the percentiles listed in SUMMARY_PERCENTILES, and a histogram 
+    with SUMMARY_BINS evenly spaced bins between the minimum and the maximum.
+    """
+    summary = {}
+
+    for column in records:
+        if records[column].dtype.kind not in 'iuf':
+            continue
+
+        values = records[column].values.astype(float)
+        values = values[~np.isnan(values)]
+        if not len(values):
+            continue
+
+        lower, upper = values.min(), values.max()
+        counts, edges = np.histogram(
+                values, bins=SUMMARY_BINS, range=(lower, upper))
+
+        summary[column] = {
+                'count': len(values),
+                'min': float(lower),
+                'max': float(upper),
+                'percentiles': [
+                    float(x) for x in np.percentile(values, SUMMARY_PERCENTILES)],
+                'histogram': [int(x) for x in counts],
+        }
+
+    return summary
+
+def read_metrics_summary(pdb_dir):
+    """
+    Return the summary statistics that load() saved for the given directory 
+    (see MetricsCache), or None if there aren't any or if they're out of date. 
+
+    The summary is a dictionary with the number of models ('num_models') and 
+    the statistics for each metric ('columns', see summarize_metrics()).  It's 
+    out of date if any structure was added, removed, or modified, or if the 
+    restraints file changed, since it was written.  Checking this only 
+    requires listing the directory, so the summary can be used to count or 
+    bound the models in a directory much faster than loading the metrics.
+    """
+    summary = _read_summary_file(metrics_summary_path(pdb_dir))
+    if summary is None:
+        return None
+
+    try:
+        workspace = pipeline.workspace_from_dir(pdb_dir)
+        manifest = scan_pdb_dir(pdb_dir)
+        restraints_hash = hash_restraints(workspace.restraints_path)
+    except (pipeline.WorkspaceNotFound, EnvironmentError):
+        return None
+
+    if summary['fingerprint'] != manifest_fingerprint(manifest):
+        return None
+    if summary['restraints_hash'] != restraints_hash:
+        return None
+
+    return summary
+
+def _read_summary_file(path):
+    try:
+        with open(path) as file:
+            summary = json.load(file)
+    except (EnvironmentError, ValueError):
+        return None
+
+    if summary.get('version') not in READABLE_CACHE_VERSIONS:
+        return None
+    if summary.get('percentiles') != SUMMARY_PERCENTILES:
+        return None
+
+    return summary
+
+def write_metrics_summary(pdb_dir, summary):
+    path = metrics_summary_path(pdb_dir)
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+
+    with open(tmp_path, 'w') as file:
+        json.dump(summary, file)
+    os.rename(tmp_path, path)
+
+def count_from_summary(summary, query=None):
+    """
+    Return the number of models matching the given query, using only the given 
+    summary (see read_metrics_summary()), or None if the summary isn't enough 
+    to tell.
+
+    The summary can only answer queries that are made up of comparisons 
+    between a metric and a number, joined by 'and' (e.g. 'restraint_dist < 1.0 
+    and total_score < -300'), and only if every model is on the same side of 
+    one of the thresholds (i.e. none of them match) or of all of them (i.e. 
+    all of them match).  This is often the case for directories where the 
+    design didn't work at all, or worked very well, so they can be skipped 
+    without being loaded.
+    """
+    import operator
+
+    if summary is None:
+        return None
+
+    num_models = summary['num_models']
+    if not query or not query.strip():
+        return num_models
+
+    if re.search(r'\bor\b|\bnot\b|[|~()]', query):
+        return None
+
+    name = r'([A-Za-z_]\w*)'
+    number = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+    op = r'(<=|>=|==|!=|<|>)'
+    flipped_ops = {'<': '>', '>': '<', '<=': '>=', '>=': '<=', '==': '==', '!=': '!='}
+    operators = {
+            '<': operator.lt, '>': operator.gt,
+            '<=': operator.le, '>=': operator.ge,
+    }
+    all_match = True
+
+    for clause in re.split(r'\band\b|&', query):
+        clause = clause.strip()
+        match = re.match(r'^{0}\s*{1}\s*{2}$'.format(name, op, number), clause)
+        if match:
+            column, op_str, value = match.groups()
+        else:
+            match = re.match(r'^{0}\s*{1}\s*{2}$'.format(number, op, name), clause)
+            if not match:
+                return None
+            value, op_str, column = match.groups()
+            op_str = flipped_ops[op_str]
+
+        stats = summary['columns'].get(column)
+        if stats is None:
+            return None
+
+        value = float(value)
+        lower, upper = stats['min'], stats['max']
+        in_range = lower <= value <= upper
+
+        if op_str == '==':
+            none_match, every_match = not in_range, lower == upper == value
+        elif op_str == '!=':
+            none_match, every_match = lower == upper == value, not in_range
+        else:
+            matches = [operators[op_str](x, value) for x in (lower, upper)]
+            none_match, every_match = not any(matches), all(matches)
+
+        if none_match:
+            return 0
+
+        # Models with NaN for this metric never match.
+        all_match &= every_match and stats['count'] == num_models
+
+    return num_models if all_match else None
+
+def load_coords(pdb_dir, atoms):
+    """
+    Return the coordinates of the given atoms (i.e. (atom name, residue id) 
+    tuples) for the structures in the given directory, as saved by 
+    load(store_coords=True), without reading any of the structures.
+
+    A list of file names and an array with one row for each of those files 
+    and one (x, y, z) coordinate for each atom are returned.  Structures that 
+    were never stored, that have changed since they were stored, or that were 
+    stored without some of the given atoms are left out, so callers should 
+    fall back on reading any structures they need that aren't listed.  Atoms 
+    that weren't found in a structure are NaN.
+    """
+    coords_dir = os.path.join(pdb_dir, 'metrics_cache', 'coords')
+    index, num_rows = read_coords_index(coords_dir, atoms)
+    index, num_dropped = drop_stale_records(index, scan_pdb_dir(pdb_dir))
+    return list(index['path']), read_coords(coords_dir, index, atoms)
+
+def loop_backbone_atoms(loops):
+    """
+    Return the backbone atoms (i.e. N, CA, and C) of every residue in the given 
+    loops (see pipeline.load_loops()), in the order they appear in a PDB file.
+    """
+    return [
+            (atom_name, residue_id)
+            for start, stop in loops
+            for residue_id in range(start, stop + 1)
+            for atom_name in ('N', 'CA', 'C')
     ]
-    for metric in expected_metrics:
-        if metric not in all_records:
-            print all_records.keys()
-            raise IOError("'{}' wasn't calculated for the models in '{}'".format(metric, pdb_dir))
 
-    # If everything else looks good, cache the data frame so we can load faster
-    # next time.
+def find_stored_atoms(workspace, pdb_dir):
+    """
+    Return the atoms whose coordinates are kept in the coordinate store for the 
+    given directory: the restrained atoms, followed by the backbone atoms of 
+    the loops that don't also happen to be restrained.
+    """
+    atoms = []
 
-    all_records.to_pickle(cache_path)
-    with codecs.open(metadata_path, 'w', encoding='utf8') as file:
-        yaml.safe_dump([v.to_dict() for k,v in metadata.items()], file)
+    try:
+        atoms += find_restrained_atoms(parse_restraints(workspace.restraints_path))
+    except EnvironmentError:
+        pass
+
+    try:
+        atoms += loop_backbone_atoms(pipeline.load_loops(pdb_dir))
+    except EnvironmentError:
+        pass
+
+    unique_atoms = []
+    for atom in atoms:
+        if atom not in unique_atoms:
+            unique_atoms.append(atom)
+    return unique_atoms
+
+def read_coords_index(coords_dir, atoms, shards=None):
+    """
+    Return a data frame with the path and manifest columns of the most recent 
+    coordinates stored for each structure in the given coordinate store, along 
+    with the total number of rows that were read.
+
+    Only the shards that include every one of the given atoms are considered.  
+    The '_shard' and '_row' columns say where the coordinates themselves can be 
+    found, see read_coords().  The coordinate store is laid out like the 
+    metrics cache (see list_metrics_shards()), except that each shard only has 
+    the path and manifest columns, plus a 'xyzs' array and an 'atoms' 
+    attribute (see append_coords_shard()).
+    """
+    columns = ['path'] + MANIFEST_COLUMNS
+
+    # Retry if one of the shards disappears while we're reading it, which can 
+    # happen if the store is being compacted at the same time.
+
+    for attempt in range(3):
+        listed_shards = shards or list_metrics_shards(coords_dir)
+        try:
+            tables = []
+            for shard in listed_shards:
+                table_dir = os.path.join(coords_dir, shard)
+                stored_atoms = read_metrics_schema(table_dir)['attrs']['atoms']
+                if not set(atoms) <= set(tuple(x) for x in stored_atoms):
+                    continue
+
+                table = read_metrics_table(table_dir, columns)
+                table['_shard'] = shard
+                table['_row'] = np.arange(len(table))
+                tables.append(table)
+            break
+        except EnvironmentError:
+            if shards or listed_shards == list_metrics_shards(coords_dir):
+                raise
+
+    num_rows = sum(len(x) for x in tables)
+    if not num_rows:
+        index = pd.DataFrame(columns=columns + ['_shard', '_row'])
+        return index, num_rows
+
+    index = pd.concat(tables, ignore_index=True)
+    index = index.drop_duplicates('path', keep='last').sort_values('path')
+    return index.reset_index(drop=True), num_rows
+
+def read_coords(coords_dir, index, atoms):
+    """
+    Return the coordinates of the given atoms for every row of the given index 
+    (see read_coords_index()), as an array with one row per structure.  Only 
+    the rows and atoms that are asked for are read from disk.
+    """
+    xyzs = np.full((len(index), len(atoms), 3), np.nan)
+
+    for shard in index['_shard'].unique():
+        table_dir = os.path.join(coords_dir, shard)
+        stored_atoms = read_metrics_schema(table_dir)['attrs']['atoms']
+        stored_columns = {tuple(x): i for i, x in enumerate(stored_atoms)}
+        columns = [stored_columns[x] for x in atoms]
+
+        selected = (index['_shard'] == shard).values
+        rows = index['_row'].values[selected].astype(int)
+        stored_xyzs = read_metrics_array(table_dir, 'xyzs')
+        xyzs[selected] = stored_xyzs[rows][:,columns]
+
+    return xyzs
+
+def read_coords_from_pdbs(pdb_paths, atoms, progress=True):
+    """
+    Read the coordinates of the given atoms from the given structures, for 
+    structures whose metrics are already cached but whose coordinates aren't 
+    in the coordinate store yet.  Return the paths that could be read and an 
+    array with one row per path.
+    """
+    parser = RosettaPdbParser(atoms=atoms)
+    paths, xyzs = [], []
+
+    for i, path in enumerate(pdb_paths):
+        if progress:
+            sys.stdout.write("\rReading coordinates from '{}' [{}/{}]".format(
+                os.path.relpath(os.path.dirname(path)), i+1, len(pdb_paths)))
+            sys.stdout.flush()
 
-    # Report how many structures had to be cached, in case the caller is
-    # interested, and return to loaded data frame.
+        try:
+            lines = pdb_codecs.read_lines(path)
+        except EnvironmentError:
+            print "\nFailed to read '{}'".format(path)
+            continue
+
+        parser.parse(lines)
+        paths.append(path)
+        xyzs.append(parser.xyzs)
+
+    if pdb_paths and progress:
+        sys.stdout.write('\n')
+
+    return paths, np.array(xyzs).reshape(len(xyzs), len(atoms), 3)
+
+def append_coords_shard(coords_dir, records, atoms, xyzs):
+    """
+    Write the given coordinates to a new shard at the end of the given 
+    coordinate store, and return the name of that shard.  The caller must hold 
+    the lock for the metrics cache (see lock_metrics_cache()).
+    """
+    name = 'shard_{0:06d}_{0:06d}'.format(_next_shard_number(coords_dir))
+    write_coords_table(os.path.join(coords_dir, name), records, atoms, xyzs)
+    return name
+
+def write_coords_table(table_dir, records, atoms, xyzs):
+    """
+    Save the given coordinates as a table (see write_metrics_table()).  The 
+    records must have the path and manifest columns, and the coordinates must 
+    be an array with one row per record and one (x, y, z) coordinate per atom.  
+    The coordinates are stored with single precision, which is more than 
+    enough for the three decimal places in a PDB file.
+    """
+    write_metrics_table(
+            table_dir,
+            records[['path'] + MANIFEST_COLUMNS].reset_index(drop=True),
+            arrays={'xyzs': np.asarray(xyzs, dtype=np.float32)},
+            attrs={'atoms': [list(x) for x in atoms]},
+    )
+
+def compact_coords_store(pdb_dir):
+    """
+    Merge all the shards in the coordinate store for the given directory into 
+    one, keeping only the most recent coordinates for structures that haven't 
+    changed since.  Only the coordinates stored with the most recent set of 
+    atoms are kept.  This is called by compact_metrics_cache().
+    """
+    import shutil
+
+    cache_dir = os.path.join(pdb_dir, 'metrics_cache')
+    coords_dir = os.path.join(cache_dir, 'coords')
+
+    if not os.path.isdir(coords_dir):
+        return
+
+    with lock_metrics_cache(cache_dir):
+        shards = list_metrics_shards(coords_dir)
+
+        for name in os.listdir(coords_dir):
+            if re.match(r'^shard_\d+_\d+\.(tmp|old)\d+$', name):
+                shutil.rmtree(os.path.join(coords_dir, name))
+
+        if not shards:
+            return
+
+        last_shard = os.path.join(coords_dir, shards[-1])
+        atoms = [tuple(x) for x in read_metrics_schema(last_shard)['attrs']['atoms']]
+        index, num_rows = read_coords_index(coords_dir, atoms, shards)
+        index, num_dropped = drop_stale_records(index, scan_pdb_dir(pdb_dir))
+
+        if len(shards) == 1 and num_rows == len(index):
+            return
+
+        first = int(shards[0].split('_')[1])
+        last = _next_shard_number(coords_dir)
+        name = 'shard_{0:06d}_{1:06d}'.format(first, last)
+        xyzs = read_coords(coords_dir, index, atoms)
+        write_coords_table(os.path.join(coords_dir, name), index, atoms, xyzs)
+
+        for shard in shards:
+            shutil.rmtree(os.path.join(coords_dir, shard))
+
+def open_metrics_index(workspace):
+    """
+    Return a connection to the SQLite database that indexes the metrics for 
+    every directory in the given workspace, creating it if necessary.
+
+    The database has a 'models' table with one row for every structure that 
+    has been loaded by load(), a 'families' table with the per-position 
+    metrics (see METRIC_FAMILIES) for those structures, and a 'metadata' table 
+    with the metadata for every metric in every directory (as a JSON string).  
+    Each model is identified by its directory (relative to the root of the 
+    workspace) and its path, and is labeled with the round, step (e.g. 
+    'validate_designs'), and design (for validation runs) that it came from.  
+    The metrics are stored in one column each, and columns are added as new 
+    metrics are encountered.  The per-position metrics would add hundreds of 
+    columns, so each family is instead stored as a JSON string with one row 
+    per model.  The manifest columns are stored too, so 
+    refresh_metrics_index() can tell which directories have changed.
+
+    The index is only a cache, so if it was made by a different version of 
+    this module (see METRICS_INDEX_VERSION), it's simply rebuilt.
+    """
+    import sqlite3
+
+    db = sqlite3.connect(workspace.metrics_index_path, timeout=60)
+    version, = db.execute('PRAGMA user_version').fetchone()
+
+    if version != METRICS_INDEX_VERSION:
+        # Manage the transaction by hand, because the sqlite3 module would 
+        # otherwise commit before each statement that changes the schema, and 
+        # another process could create the tables in between.
+        db.isolation_level = None
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            version, = db.execute('PRAGMA user_version').fetchone()
+            if version != METRICS_INDEX_VERSION:
+                _create_metrics_index(db)
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+        finally:
+            db.isolation_level = ''
+
+    return db
+
+def _create_metrics_index(db):
+    for table in 'models', 'families', 'metadata':
+        db.execute('DROP TABLE IF EXISTS {0}'.format(table))
+
+    db.execute("""\
+            CREATE TABLE models (
+                directory TEXT NOT NULL,
+                path TEXT NOT NULL,
+                round INTEGER,
+                step TEXT,
+                design TEXT,
+                PRIMARY KEY (directory, path))""")
+    db.execute("""\
+            CREATE INDEX models_by_step
+            ON models (step, round, design)""")
+    db.execute("""\
+            CREATE TABLE families (
+                directory TEXT NOT NULL,
+                path TEXT NOT NULL,
+                family TEXT NOT NULL,
+                json TEXT NOT NULL,
+                PRIMARY KEY (directory, path, family))""")
+    db.execute("""\
+            CREATE TABLE metadata (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                json TEXT NOT NULL,
+                PRIMARY KEY (directory, name))""")
+    db.execute('PRAGMA user_version = {0}'.format(METRICS_INDEX_VERSION))
+
+def update_metrics_index(workspace, pdb_dir, records, metadata, changed_paths, partial=False):
+    """
+    Bring the rows for the given directory in the metrics index (see 
+    open_metrics_index()) up to date with the given records, which should 
+    include the manifest columns.  Only the rows for the given paths (i.e. the 
+    structures that were just cached), for paths that aren't in the index yet, 
+    and for paths that no longer exist are touched, so keeping the index up to 
+    date costs about as much as keeping the cache up to date.
+
+    If partial is true, only the records for the given paths are complete 
+    (e.g. because the others were loaded with only a few columns), so paths 
+    that aren't in the index yet are left for refresh_metrics_index().
+
+    If the records include the '_restraints_hash' column, it's indexed too, 
+    and rows indexed with a different hash are also rewritten (unless partial 
+    is true), so that refresh_metrics_index() can tell when the restraint 
+    metrics in the index are out of date.
+
+    The per-position metrics are stored in the 'families' table, except for 
+    the coordinates, which query_metrics_index() wouldn't return anyway.  The 
+    metadata is stored separately for each directory, because the same metric 
+    can be described differently in different steps.
+    """
+    directory = metrics_index_dir(workspace, pdb_dir)
+    round, step, design = describe_pdb_dir(workspace, pdb_dir)
+
+    families = collections.OrderedDict()
+    columns = ['directory', 'round', 'step', 'design']
+
+    for column in records.columns:
+        family = metric_family(column)
+        if family is None:
+            columns.append(column)
+        elif not family.startswith('_'):
+            families.setdefault(family, []).append(column)
+
+    db = open_metrics_index(workspace)
+    try:
+        with db:
+            # Add columns for any metrics that haven't been seen before.  
+            # SQLite limits the number of columns in a table and the number of 
+            # values in a statement (to 999 by default), so make sure we stay 
+            # below both.
+
+            known_columns = set(x[1] for x in db.execute('PRAGMA table_info(models)'))
+            sql_types = {'f': 'REAL', 'i': 'INTEGER', 'u': 'INTEGER', 'b': 'INTEGER'}
+
+            num_columns = len(known_columns | set(columns))
+            if num_columns > MAX_INDEX_COLUMNS:
+                raise IOError("""\
+The metrics index would need {0} columns to index '{1}', but only {2} are 
+allowed.""".format(num_columns, pdb_dir, MAX_INDEX_COLUMNS))
+
+            for column in columns[4:]:
+                if column not in known_columns:
+                    sql_type = sql_types.get(records[column].dtype.kind, 'TEXT')
+                    db.execute('ALTER TABLE models ADD COLUMN "{0}" {1}'.format(
+                        column, sql_type))
+
+            has_hashes = '_restraints_hash' in records
+            indexed_hashes = dict(db.execute(
+                'SELECT path, {0} FROM models WHERE directory = ?'.format(
+                    '"_restraints_hash"' if has_hashes else 'NULL'),
+                (directory,)))
+            indexed_paths = set(indexed_hashes)
+            current_paths = set(records['path'])
+            changed_paths = set(changed_paths) & current_paths
+
+            # Rows indexed with a different restraints file (e.g. by a version 
+            # of this module that didn't record which one) are rewritten, 
+            # unless only some columns were loaded.
+
+            if has_hashes and not partial:
+                changed_paths |= set(
+                        path for path, hash in zip(
+                            records['path'], records['_restraints_hash'])
+                        if path in indexed_hashes and indexed_hashes[path] != hash)
+
+            dropped_paths = (indexed_paths - current_paths) | changed_paths
+            added_paths = changed_paths if partial else \
+                    (current_paths - indexed_paths) | changed_paths
+            added = records['path'].isin(added_paths).values
+            added_records = records[added]
+
+            for table in 'models', 'families':
+                db.executemany(
+                        'DELETE FROM {0} WHERE directory = ? AND path = ?'.format(table),
+                        [(directory, x) for x in dropped_paths])
+
+            db.executemany(
+                    'INSERT INTO models ({0}) VALUES ({1})'.format(
+                        ', '.join('"{0}"'.format(x) for x in columns),
+                        ', '.join('?' for x in columns)),
+                    [
+                        (directory, round, step, design) + tuple(
+                            _sql_value(x) for x in row)
+                        for row in added_records[columns[4:]].itertuples(index=False)
+                    ])
+
+            # Only the values that are present are stored for each family, 
+            # because most of them are NaN when the records come from several 
+            # steps.
+
+            for family, family_columns in families.items():
+                names = np.array(family_columns)
+                values = added_records[family_columns].values.astype(float)
+                present = ~np.isnan(values)
+                db.executemany(
+                        'INSERT INTO families (directory, path, family, json) '
+                        'VALUES (?, ?, ?, ?)',
+                        [
+                            (directory, path, family, json.dumps(dict(zip(
+                                names[mask].tolist(), row[mask].tolist()))))
+                            for path, row, mask in zip(
+                                added_records['path'], values, present)
+                            if mask.any()
+                        ])
+
+            db.executemany(
+                    'INSERT OR REPLACE INTO metadata (directory, name, json) '
+                    'VALUES (?, ?, ?)',
+                    [
+                        (directory, k, json.dumps(v.to_dict()))
+                        for k, v in metadata.items()
+                    ])
+    finally:
+        db.close()
+
+def refresh_metrics_index(workspace, pdb_dirs, use_cache=True, processes=1, threads=None):
+    """
+    Make sure the metrics index has up-to-date rows for every structure in the 
+    given directories.  Only the directories that have changed since they 
+    were last indexed (i.e. where any file was added, removed, or modified, 
+    or where the restraints file changed) are loaded, all at once via 
+    load_dirs(), which updates the index.
+
+    The directories are checked, and their caches are read, in the given 
+    number of threads (LOAD_THREADS by default), since most of that time is 
+    spent waiting for the filesystem.
+
+    load_dirs() only prints a message if it can't update the index (e.g. 
+    because the database stayed locked), so the directories are checked again 
+    afterwards, and an IOError is raised if any of them still aren't indexed.  
+    Otherwise query_metrics_index() would silently return stale metrics.
+    """
+    threads = threads or LOAD_THREADS
+
+    if use_cache:
+        is_indexed = _thread_map(
+                lambda x: _is_indexed(workspace, x), pdb_dirs, threads)
+        stale_dirs = [
+                x for x, indexed in zip(pdb_dirs, is_indexed)
+                if not indexed]
+    else:
+        stale_dirs = list(pdb_dirs)
+
+    if not stale_dirs:
+        return
+
+    load_dirs(
+            stale_dirs, use_cache=use_cache, processes=processes,
+            threads=threads)
+
+    is_indexed = _thread_map(
+            lambda x: _is_indexed(workspace, x), stale_dirs, threads)
+    unindexed_dirs = [
+            x for x, indexed in zip(stale_dirs, is_indexed)
+            if not indexed]
+
+    if unindexed_dirs:
+        raise IOError("""\
+Couldn't update the metrics index ('{0}') for the following directories:
+{1}""".format(
+            os.path.relpath(workspace.metrics_index_path),
+            '\n'.join('    ' + os.path.relpath(x) for x in unindexed_dirs)))
+
+def _is_indexed(workspace, pdb_dir):
+    # Each thread needs its own connection.
+    db = open_metrics_index(workspace)
+    columns = ['path'] + MANIFEST_COLUMNS + ['_restraints_hash']
+    try:
+        indexed = pd.read_sql_query(
+                'SELECT {0} FROM models WHERE directory = ? ORDER BY path'.format(
+                    ', '.join('"{0}"'.format(x) for x in columns)),
+                db, params=(metrics_index_dir(workspace, pdb_dir),))
+    except pd.io.sql.DatabaseError:
+        return False
+    finally:
+        db.close()
+
+    manifest = scan_pdb_dir(pdb_dir)
+    if list(indexed['path']) != list(manifest['path']):
+        return False
+
+    # The restraint metrics are out of date if the restraints file changed.  
+    # The restraints are those of the workspace containing the directory, 
+    # which is what load() uses.
+    try:
+        restraints_path = pipeline.workspace_from_dir(pdb_dir).restraints_path
+        restraints_hash = hash_restraints(restraints_path)
+    except (pipeline.WorkspaceNotFound, EnvironmentError):
+        return False
+    if (indexed['_restraints_hash'] != restraints_hash).any():
+        return False
+
+    return all(
+            np.array_equal(
+                indexed[x].values.astype(float),
+                manifest[x].values.astype(float))
+            for x in MANIFEST_COLUMNS)
+
+def query_metrics_index(workspace, pdb_dirs=None, where=None, params=()):
+    """
+    Return the metrics for the structures in the given directories (or the 
+    whole workspace by default) matching the given SQL condition (e.g. 
+    "step = 'validate_designs' AND restraint_dist < ?"), along with the 
+    metadata for those metrics.  This only reads the metrics index, so call 
+    refresh_metrics_index() first if the directories may have changed.
+
+    Like load(), the manifest columns aren't returned, and neither are metrics 
+    that don't apply to any of the structures (e.g. filters only used in other 
+    steps).  The 'directory' column is returned as an absolute path.  The 
+    per-position metrics (see METRIC_FAMILIES) are returned too, but the SQL 
+    condition can't refer to them, because they aren't stored as columns.  
+    If a metric is described differently in different directories, the 
+    metadata from the last directory (in alphabetical order) is returned.
+    """
+    directory_conditions = []
+    directory_params = []
+
+    if pdb_dirs is not None:
+        directory_params = [metrics_index_dir(workspace, x) for x in pdb_dirs]
+        directory_conditions.append('directory IN ({0})'.format(
+            ', '.join('?' for x in directory_params)))
+
+    conditions = directory_conditions + (['({0})'.format(where)] if where else [])
+    params = directory_params + list(params)
 
-    if job_report is not None:
-        job_report['new_records'] = len(uncached_records)
-        job_report['old_records'] = len(cached_records)
+    def sql_where(conditions):
+        return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
 
-    return all_records, metadata
+    db = open_metrics_index(workspace)
+    try:
+        records = pd.read_sql_query(
+                'SELECT * FROM models{0} ORDER BY directory, path'.format(
+                    sql_where(conditions)),
+                db, params=params)
+        family_rows = db.execute(
+                'SELECT directory, path, json FROM families{0}'.format(
+                    sql_where(directory_conditions)),
+                directory_params).fetchall()
+        metadata_rows = db.execute(
+                'SELECT name, json FROM metadata{0} ORDER BY directory'.format(
+                    sql_where(directory_conditions)),
+                directory_params).fetchall()
+    finally:
+        db.close()
+
+    # The column names in the JSON strings are decoded as unicode, but pandas 
+    # returns the other column names as byte strings.
+
+    family_values = collections.defaultdict(dict)
+    for directory, path, values in family_rows:
+        family_values[directory, path].update(
+                (str(k), v) for k, v in json.loads(values).items())
+
+    if family_values:
+        families = pd.DataFrame(
+                [
+                    family_values.get(x, {})
+                    for x in zip(records['directory'], records['path'])
+                ],
+                index=records.index)
+        records = pd.concat([records, families], axis=1)
+
+    descriptors = ['directory', 'path', 'round', 'step', 'design']
+    records = records[descriptors + [
+            x for x in records.columns
+            if x not in descriptors and not x.startswith('_')
+            and not records[x].isnull().all()]]
+
+    for column in records.columns[len(descriptors):]:
+        if records[column].dtype == object and column != 'sequence':
+            records[column] = pd.to_numeric(records[column], errors='ignore')
+
+    # There are far fewer directories than records, so only join each 
+    # directory with the root once.
+    directories = records['directory'].unique()
+    records['directory'] = records['directory'].map(dict(zip(
+            directories,
+            [os.path.join(workspace.root_dir, x) for x in directories])))
+
+    metadata = {}
+    for name, x in metadata_rows:
+        if name in records:
+            metadata[name] = ScoreMetadata(**json.loads(x))
 
-def read_and_calculate(workspace, pdb_paths):
+    return records, metadata
+
+def metrics_index_dir(workspace, pdb_dir):
+    """
+    Return the name used for the given directory in the metrics index, i.e. its 
+    path relative to the root of the workspace, so that the index stays valid 
+    if the whole workspace is moved.
+    """
+    return os.path.relpath(os.path.abspath(pdb_dir), workspace.root_dir)
+
+def describe_pdb_dir(workspace, pdb_dir):
+    """
+    Return the round, step, and design (any of which may be None) that the 
+    structures in the given directory belong to.  The design is the name of the 
+    input structure for the output subdirectories of validation runs.
+    """
+    round = getattr(workspace, 'round', None)
+    step = workspace.focus_name or None
+    design = None
+
+    output_dir = getattr(workspace, 'output_dir', None)
+    pdb_dir = os.path.abspath(pdb_dir)
+
+    if output_dir and os.path.dirname(pdb_dir) == os.path.abspath(output_dir):
+        design = os.path.basename(pdb_dir)
+
+    return round, step, design
+
+def _sql_value(x):
+    if isinstance(x, float) and np.isnan(x):
+        return None
+    if isinstance(x, np.generic):
+        return _sql_value(x.item())
+    return x
+
+def read_and_calculate(workspace, pdb_paths, processes=1, progress=True, coord_atoms=None, checkpoint=None):
     """
     Calculate a variety of score and distance metrics for the given structures.
+
+    If any coord_atoms (i.e. (atom name, residue id) tuples) are given, the 
+    coordinates of those atoms are included in each record, in a '_coords' 
+    field, for the coordinate store (see MetricsCache).
+
+    If a checkpoint function is given, the structures are read in chunks and 
+    the function is called with the records and metadata for each chunk as 
+    soon as it's finished (see read_and_calculate_dirs()).
     """
+    if processes > 1 or checkpoint is not None:
+        return read_and_calculate_dirs(
+                [(workspace, pdb_paths, coord_atoms)], processes,
+                checkpoints=[checkpoint])[0]
 
     # Parse the given restraints file.  The restraints definitions are used to
     # calculate the "restraint_dist" metric, which reflects how well each
@@ -131,60 +1653,38 @@ def read_and_calculate(workspace, pdb_paths):
     # distance is a very important metric for deciding which designs worked.
 
     restraints = parse_restraints(workspace.restraints_path)
+    restraints_hash = hash_restraints(workspace.restraints_path)
+    is_sidechain_restraint = find_sidechain_restraints(restraints)
 
     # Calculate score and distance metrics for each structure.
 
-    from klab.bio.basics import residue_type_3to1_map
-
     records = []
     metadata = {}
-    num_restraints = len(restraints) + 1
-    atom_xyzs = {}
-    fragment_size = 0
+    xyzs = []
+    sequence_maps = []
+    restrained_atoms = find_restrained_atoms(restraints)
+    coord_atoms = coord_atoms or []
+    parser = RosettaPdbParser(
+            list(is_sidechain_restraint),
+            restrained_atoms + [
+                x for x in coord_atoms if x not in restrained_atoms])
+    coord_rows = [parser.atoms.index(x) for x in coord_atoms]
 
-    # It's kinda hard to tell which lines are part of the score table.  The 
-    # first column has some pretty heterogeneous strings (examples below) and 
-    # all the other columns are just numbers.  My strategy here is to try to 
-    # make a regular expression that matches all of these examples, with the 
-    # exception of the ligand.  I think the ligand will simply be too 
-    # heterogeneous to match, and the purpose of this is to get dunbrack 
-    # scores, which the ligand doesn't have.
-    #
-    #   MET:NtermProteinFull_1
-    #   ASN_2
-    #   LYS:protein_cutpoint_lower_39
-    #   ASP:protein_cutpoint_upper_40
-    #   ALA:CtermProteinFull_124
-    #   HIS_D_224
-    #   pdb_EQU_250
+    # Read (and decompress) the PDB files in background threads, so the next 
+    # files are being read while this one is parsed.
 
-    score_table_pattern = re.compile(
-            r'^[A-Z]{3}(?:_[A-Z])?'  # Residue name with optional tautomer.
-            r'(?::[A-Za-z_]+)?'      # Optional patch type.
-            r'_([0-9]+) '            # Residue number preceded by underscore.
-    )                                # The terminal space is important to match
-                                     # the full residue number.
+    pdb_paths = sorted(pdb_paths)
 
-    for i, path in enumerate(sorted(pdb_paths)):
-        record = {'path': os.path.basename(path)}
-        sequence = ""
-        sequence_map = {}
-        last_residue_id = None
-        dunbrack_index = None
-        dunbrack_scores = {}
+    for i, (path, lines) in enumerate(prefetch_pdb_lines(pdb_paths)):
 
         # Update the user on our progress, because this is often slow.
 
-        sys.stdout.write("\rReading '{}' [{}/{}]".format(
-            os.path.relpath(os.path.dirname(path)), i+1, len(pdb_paths)))
-        sys.stdout.flush()
-
-        # Read the PDB file, which we are assuming is gzipped.
+        if progress:
+            sys.stdout.write("\rReading '{}' [{}/{}]".format(
+                os.path.relpath(os.path.dirname(path)), i+1, len(pdb_paths)))
+            sys.stdout.flush()
 
-        try:
-            with gzip.open(path) as file:
-                lines = file.readlines()
-        except IOError:
+        if lines is None:
             print "\nFailed to read '{}'".format(path)
             continue
 
@@ -195,284 +1695,699 @@ def read_and_calculate(workspace, pdb_paths):
         # Get different information from different lines in the PDB file.  Some
         # of these lines are specific to different simulations.
 
-        for line in lines:
-            line = line.decode('utf8')
-
-            score_table_match = \
-                    dunbrack_index and score_table_pattern.match(line)
-
-            if line.startswith('pose'):
-                meta = ScoreMetadata(
-                        name='total_score',
-                        title='Total Score',
-                        unit='REU',
-                        order=1,
-                )
-                record['total_score'] = float(line.split()[-1])
-                metadata[meta.name] = meta
-
-            elif line.startswith('label'):
-                fields = line.split()
-                dunbrack_index = fields.index('fa_dun')
-
-            elif score_table_match:
-                residue_id = int(score_table_match.group(1))
-                for restraint in restraints:
-                    if residue_id in restraint.residue_ids:
-                        dunbrack_score = float(line.split()[dunbrack_index])
-                        dunbrack_scores[residue_id] = dunbrack_score
-                        break
-
-            elif line.startswith('rmsd'):
-                meta = ScoreMetadata(
-                        name='loop_rmsd',
-                        title='Loop RMSD (Backbone Heavy-Atom)',
-                        unit='Å',
-                        guide=1.0, lower=0.0, upper='95%', order=4,
-                )
-                record[meta.name] = float(line.split()[1])
-                metadata[meta.name] = meta
-
-            elif line.startswith('  all_heavy_atom_unsats'):
-                meta = ScoreMetadata(
-                        name='buried_unsats',
-                        title='Buried Unsatsified H-Bonds',
-                        order=5,
-                )
-                record[meta.name] = float(line.split()[2])
-                metadata[meta.name] = meta
-
-            elif line.startswith('  sc_heavy_atom_unsats'):
-                meta = ScoreMetadata(
-                        name='buried_unsats_sidechain',
-                        title='Buried Unsatisfied H-Bonds (Sidechain)',
-                        order=5,
-                )
-                record[meta.name] = float(line.split()[2])
-                metadata[meta.name] = meta
-
-            elif line.startswith('  bb_heavy_atom_unsats'):
-                meta = ScoreMetadata(
-                        name='buried_unsats_backbone',
-                        title='Buried Unsatisfied H-Bonds (Backbone)',
-                        order=5,
-                )
-                record[meta.name] = float(line.split()[2])
-                metadata[meta.name] = meta
-
-            elif line.startswith('time'):
-                meta = ScoreMetadata(
-                        name='simulation_time',
-                        title='Simulation Time',
-                        unit='sec',
-                        order=5,
-                )
-                record[meta.name] = float(line.split()[1])
-                metadata[meta.name] = meta
-
-            elif line.startswith('FragmentScoreFilter '):
-                fragment_size = line.split()[2].split('-')[0]
-
-            elif line.startswith('FSF') or line.startswith('FragmentScoreFilter_metric'):
-                splitline = line.split()
-                if splitline[1] == 'Max':
-                    max_res = 0
-                    max_crmsd = 0
-                    if splitline[3] == 'res:':
-                        max_res = splitline[3]
-                        meta = ScoreMetadata(
-                                name='max_fragment_crmsd_position',
-                                title = 'Max {}-Residue Fragment RMSD \
-(C-Alpha) Position'.format(fragment_size),
-                                order=7)
-                    elif splitline[3] == 'score:':
-                        max_crmsd = splitline[3]
-                        meta = ScoreMetadata(
-                                name='max_fragment_crmsd_score',
-                                title = 'Max {}-Residue Fragment RMSD \
-(C-Alpha)'.format(fragment_size),
-                                order=7)
-
-                elif splitline[1] == 'Min':
-                    min_res = 0
-                    min_crmsd = 0
-                    if splitline[3] == 'res:':
-                        min_res = splitline[3]
-                        meta = ScoreMetadata(
-                                name='min_fragment_crmsd_position',
-                                title = 'Min {}-Residue Fragment RMSD \
-(C-Alpha) Position'.format(fragment_size),
-                                order=8)
-                    elif splitline[3] == 'score:':
-                        min_crmsd = splitline[3]
-                        meta = ScoreMetadata(
-                                name='min_fragment_crmsd_score',
-                                title = 'Min {}-Residue Fragment RMSD \
-(C-Alpha)'.format(fragment_size),
-                                order=8)
+        record, _ = parser.parse(lines)
+        record['path'] = os.path.basename(path)
+        atom_xyzs = parser.atom_xyzs
+        sequence_map = parser.sequence_map
+        dunbrack_scores = parser.dunbrack_scores
+
+        # Save the coordinates of the restrained atoms, so that the restraint 
+        # metrics can be recalculated without reading this file again if the 
+        # restraints change (see MetricsCache).
+
+        record.update(restrained_atom_columns(restraints, atom_xyzs, sequence_map))
+        record['_restraints_hash'] = restraints_hash
+
+        if coord_atoms:
+            record['_coords'] = parser.xyzs[coord_rows]
+
+        # Finish calculating some records that depend on the whole structure.
+
+        for resi, score in dunbrack_scores.items():
+            aa = sequence_map[resi] if is_sidechain_restraint[resi] else 'X'
+            res = '{0}{1}'.format(aa, resi)
+            meta = parser.registry.get(('dunbrack_score', res), lambda: ScoreMetadata(
+                    name='dunbrack_score_{0}'.format(res.lower()),
+                    title='Dunbrack Score for {0}'.format(res),
+                    unit='REU',
+                    order=5,
+            ))
+            record[meta.name] = score
+
+        records.append(record)
+        xyzs.append(parser.xyzs)
+        sequence_maps.append(sequence_map)
+
+    if pdb_paths and progress:
+        sys.stdout.write('\n')
+
+    # The registry has the metadata for every metric that was found in any of 
+    # the structures.
+
+    metadata.update(parser.registry.metadata)
+
+    # Calculate how well each restraint was satisfied, for all the structures 
+    # at once.
+
+    restraint_records, restraint_metadata = calculate_restraint_metrics(
+            restraints, parser.atoms, np.array(xyzs), sequence_maps)
+
+    for record, restraint_record in zip(records, restraint_records):
+        record.update(restraint_record)
+    metadata.update(restraint_metadata)
+
+    return records, metadata
+
+def read_and_calculate_dirs(jobs, processes=1, chunk_size=None, checkpoints=None):
+    """
+    Calculate metrics for structures from several directories using a single 
+    pool of worker processes.
+
+    The jobs argument should be a list of (workspace, pdb_paths) tuples, or 
+    (workspace, pdb_paths, coord_atoms) tuples (see read_and_calculate()), and 
+    a list of (records, metadata) tuples is returned in the same order.  The 
+    paths from every job are split into small chunks which are all fed to the 
+    same pool, so the workers stay busy regardless of how the structures are 
+    distributed between directories.  The chunks are merged back together in 
+    the order they were submitted, so the results don't depend on which worker 
+    happened to finish first.
+
+    If checkpoints is given, it should be a list with a function (or None) for 
+    each job.  Each function is called with the records and metadata of every 
+    chunk of its job, in order, as soon as the chunk is finished.  The chunks 
+    are read in this process if only one process is requested.
+    """
+    import multiprocessing
+
+    if processes < 1:
+        processes = multiprocessing.cpu_count()
+
+    # Sort the paths the same way read_and_calculate() does, so that the 
+    # records come back in the same order no matter how many processes are 
+    # used.
+
+    jobs = [
+            (job[0], sorted(job[1]), job[2] if len(job) > 2 else None)
+            for job in jobs
+    ]
+    num_paths = sum(len(pdb_paths) for workspace, pdb_paths, atoms in jobs)
+    checkpoints = checkpoints or [None] * len(jobs)
+
+    if num_paths == 0 or (
+            (processes == 1 or num_paths <= 1) and not any(checkpoints)):
+        return [
+                read_and_calculate(workspace, pdb_paths, coord_atoms=atoms)
+                for workspace, pdb_paths, atoms in jobs
+        ]
+
+    # Use chunks that are small enough that each worker gets several of them, 
+    # which evens out the differences in how long each structure takes to 
+    # parse, but not so small that communicating with the workers dominates.
+
+    if processes == 1 or num_paths <= 1:
+        processes = 1
+    if chunk_size is None:
+        chunk_size = max(1, min(50, num_paths // (4 * processes)))
+
+    chunks = []
+    for i, (workspace, pdb_paths, atoms) in enumerate(jobs):
+        for j in range(0, len(pdb_paths), chunk_size):
+            chunks.append((i, workspace, pdb_paths[j:j+chunk_size], atoms))
+
+    results = [([], {}) for job in jobs]
+    num_read = 0
+    num_dirs = len(set(x[0] for x in chunks))
+    label = "{} directories".format(num_dirs) if num_dirs > 1 else \
+            "'{}'".format(os.path.relpath(os.path.dirname(chunks[0][2][0])))
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+
+    try:
+        chunk_results = _imap_chunks(pool, chunks)
+
+        for i, workspace, pdb_paths, atoms in chunks:
+            records, metadata = next(chunk_results)
+            results[i][0].extend(records)
+            results[i][1].update(metadata)
+
+            if checkpoints[i]:
+                checkpoints[i](records, metadata)
+
+            num_read += len(pdb_paths)
+            sys.stdout.write("\rReading {} [{}/{}]".format(
+                label, num_read, num_paths))
+            sys.stdout.flush()
+
+        sys.stdout.write('\n')
+        if pool: pool.close()
+
+    except:
+        if pool: pool.terminate()
+        raise
+
+    finally:
+        if pool: pool.join()
+
+    return results
+
+def _thread_map(function, items, threads):
+    """
+    Like map(), but call the function in the given number of threads.  This 
+    only helps if the function spends most of its time waiting for the disk or 
+    running code that releases the GIL.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    items = list(items)
+    if threads <= 1 or len(items) <= 1:
+        return [function(x) for x in items]
+
+    pool = ThreadPool(min(threads, len(items)))
+
+    try:
+        # Python2 doesn't deliver KeyboardInterrupt to a thread that's waiting 
+        # on a result without a timeout, so specify a long one.
+        return pool.map_async(function, items, chunksize=1).get(_POOL_TIMEOUT)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _imap_chunks(pool, chunks):
+    if pool is None:
+        for chunk in chunks:
+            yield _read_and_calculate_chunk(chunk)
+        return
+
+    results = pool.imap(_read_and_calculate_chunk, chunks)
+
+    for chunk in chunks:
+        # Python2 doesn't deliver KeyboardInterrupt to a thread that's waiting 
+        # on a result without a timeout, so specify a long one.
+        yield results.next(timeout=_POOL_TIMEOUT)
+
+def _read_and_calculate_chunk(chunk):
+    i, workspace, pdb_paths, atoms = chunk
+    return read_and_calculate(
+            workspace, pdb_paths, progress=False, coord_atoms=atoms)
+
+# The version of the on-disk cache format.  Increment this whenever the format 
+# changes in a way that older versions of this module couldn't read.  Caches 
+# written with any of the readable versions can still be read.
+CACHE_VERSION = 2
+READABLE_CACHE_VERSIONS = [1, 2]
+
+# The prefixes of the metrics that are calculated for every fragment position, 
+# restrained residue, or restrained atom.  Each of these families is stored as 
+# a single array in the cache (see write_metrics_table()).
+METRIC_FAMILIES = [
+        'fragment_crmsd_pos_',
+        'dunbrack_score_',
+        'restraint_dist_',
+        'restraint_angle_',
+        '_xyz_',
+]
+
+# The version of the metrics index (see open_metrics_index()).  Increment this 
+# whenever the schema changes; indices made by other versions are rebuilt.
+METRICS_INDEX_VERSION = 2
+
+# The maximum number of columns in the 'models' table of the metrics index.  
+# This is the smallest limit SQLite is commonly compiled with (the maximum 
+# number of values in one statement), and inserting a row takes one value per 
+# column.
+MAX_INDEX_COLUMNS = 999
+
+# The percentiles and the number of histogram bins saved for every metric in 
+# the summary statistics (see summarize_metrics()).
+SUMMARY_PERCENTILES = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+SUMMARY_BINS = 32
+
+# The columns used to tell whether a cached structure has changed since it was 
+# cached.  These are stored in the cache, but not returned by load().
+MANIFEST_COLUMNS = ['_file_size', '_file_mtime', '_file_inode']
+
+# The number of seconds to wait on a worker process before giving up.  This is 
+# only meant to let Ctrl-C work, so it's a long time (a week).
+_POOL_TIMEOUT = 7 * 24 * 60 * 60
+
+# The number of background threads that read structures ahead of the parser, 
+# and the maximum number of structures they can read ahead (see 
+# prefetch_pdb_lines()).
+PREFETCH_THREADS = 4
+PREFETCH_DEPTH = 16
+
+# The number of threads used to scan directories and read their caches when 
+# many directories are loaded or counted at once (see count_models()).
+LOAD_THREADS = 8
+
+def prefetch_pdb_lines(pdb_paths, num_threads=PREFETCH_THREADS, max_pending=PREFETCH_DEPTH):
+    """
+    Yield a (path, lines) tuple for each of the given structures, in the given 
+    order.  The lines are None if the structure couldn't be read.
+
+    The upcoming structures are read and decompressed by a pool of background 
+    threads while the caller is busy with the current one, so that neither the 
+    disk (which may be a network filesystem) nor the CPU has to wait for the 
+    other.  At most max_pending structures are read ahead of the caller, which 
+    bounds the amount of memory used.  If num_threads is less than 1, each 
+    structure is read when it's asked for.
+    """
+    import itertools
+    from multiprocessing.pool import ThreadPool
+
+    if num_threads < 1 or len(pdb_paths) <= 1:
+        for path in pdb_paths:
+            yield path, _read_pdb_lines(path)
+        return
+
+    pool = ThreadPool(num_threads)
+    paths = iter(pdb_paths)
+    pending = collections.deque()
+
+    def submit(num_paths):
+        for path in itertools.islice(paths, num_paths):
+            pending.append((path, pool.apply_async(_read_pdb_lines, (path,))))
+
+    try:
+        submit(max(1, max_pending))
+
+        while pending:
+            path, result = pending.popleft()
+            # Python2 doesn't deliver KeyboardInterrupt to a thread that's 
+            # waiting on a result without a timeout, so specify a long one.
+            lines = result.get(timeout=_POOL_TIMEOUT)
+            submit(1)
+            yield path, lines
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _read_pdb_lines(path):
+    try:
+        return pdb_codecs.read_lines(path)
+    except EnvironmentError:
+        return None
+
+def parse_restraints(path):
+    restraints = []
+    parsers = {
+            'CoordinateConstraint': CoordinateRestraint,
+            'AtomPairConstraint': AtomPairRestraint,
+            'AtomPair': AtomPairRestraint,
+            'Dihedral': DihedralRestraint,
+            'NamedAngle': AngleRestraint,
+    }
+
+    with open(path) as file:
+        for line in file:
+            if not line.strip(): continue
+            if line.startswith('#'): continue
+
+            tokens = line.split()
+            key, args = tokens[0], tokens[1:]
+
+            if key not in parsers:
+                raise IOError("Cannot parse '{0}' restraints.".format(key))
+
+            restraint = parsers[key](args)
+            restraints.append(restraint)
+
+    return restraints
+
+def hash_restraints(path):
+    """
+    Return a hash of the given restraints file.  This is stored with each 
+    cached record, so the cache can tell which records were calculated using 
+    an older version of the restraints.
+    """
+    import hashlib
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+def find_restrained_atoms(restraints):
+    """
+    Return a sorted list of the (atom name, residue id) tuples that are 
+    involved in any of the given restraints.
+    """
+    atoms = set()
+    for restraint in restraints:
+        atoms.update(zip(restraint.atom_names, restraint.residue_ids))
+    return sorted(atoms, key=lambda x: (x[1], x[0]))
+
+def find_sidechain_restraints(restraints):
+    """
+    Return a dictionary indicating whether or not each restrained residue is 
+    involved in any restraints with sidechain atoms.  This determines how the 
+    per-residue restraint and Dunbrack metrics are named.
+    """
+    backbone_atoms = set(['N', 'C', 'CA', 'O'])
+    is_sidechain_restraint = {}
+
+    for restraint in restraints:
+        backbone_restraint = backbone_atoms.issuperset(restraint.atom_names)
+        for i in restraint.residue_ids:
+            is_sidechain_restraint[i] = (not backbone_restraint) \
+                    or is_sidechain_restraint.get(i, False)
+
+    return is_sidechain_restraint
+
+def calculate_restraint_metrics(restraints, atoms, xyzs, sequence_maps):
+    """
+    Calculate how well each restraint was satisfied in each of the given 
+    structures.
+
+    The atoms argument is a list of (atom name, residue id) tuples, xyzs is an 
+    array with the coordinates of each of those atoms in each structure (i.e. 
+    its shape is n_structures x n_atoms x 3), and sequence_maps is a list with 
+    one dictionary mapping residue ids to one-letter amino acid codes for each 
+    structure.  Return a list with a record containing the 'restraint_*' 
+    metrics for each structure, and a dictionary of metadata for those 
+    metrics.
+
+    All the structures are handled at once: the restraints are evaluated by 
+    evaluate_restraints(), and the maximum deviation for each metric and each 
+    restrained residue is taken using masked reductions over the whole array 
+    of deviations.
+    """
+    records = [{} for x in sequence_maps]
+    metadata = {}
+
+    if not restraints or not records:
+        return records, metadata
+
+    deviations = evaluate_restraints(restraints, atoms, xyzs)
+    is_sidechain_restraint = find_sidechain_restraints(restraints)
+    restraint_units = {
+            'dist': 'Å',
+            'angle': '°',
+    }
+
+    for metric in sorted(set(x.metric for x in restraints)):
+        is_metric = np.array([x.metric == metric for x in restraints])
+        residue_ids = sorted(set(
+                i for x in restraints if x.metric == metric
+                for i in x.residue_ids))
+
+        # Find the worst deviation for this metric overall and for each 
+        # residue.  Structures that are missing any of the relevant atoms get 
+        # NaN, like np.max() would give.
+
+        masks = np.array([is_metric] + [
+                is_metric & np.array([i in x.residue_ids for x in restraints])
+                for i in residue_ids])
+
+        with np.errstate(invalid='ignore'):
+            maxima = np.where(
+                    masks[np.newaxis,:,:],
+                    deviations[:,np.newaxis,:],
+                    -np.inf,
+            ).max(axis=2)
+
+        meta = ScoreMetadata(
+                name='restraint_{0}'.format(metric),
+                title='Restraint Satisfaction',
+                unit=restraint_units[metric],
+                guide=1.0, lower=0.0, upper='95%', order=2,
+        )
+        metadata[meta.name] = meta
+        for record, value in zip(records, maxima[:,0]):
+            record[meta.name] = value
+
+        if len(residue_ids) <= 1:
+            continue
+
+        for j, i in enumerate(residue_ids, 1):
+            for record, sequence_map, value in zip(
+                    records, sequence_maps, maxima[:,j]):
+
+                # I want to put the amino acid in these names, because I think 
+                # it looks nice, but it causes problems for positions that can 
+                # mutate.  So I assume that if a position has a sidechain 
+                # restraint, it must not be allowed to mutate.
+                aa = sequence_map[i] if is_sidechain_restraint[i] else 'X'
+                res = '{0}{1}'.format(aa, i)
+                name = 'restraint_{0}_{1}'.format(metric, res.lower())
+
+                if name not in metadata:
+                    metadata[name] = ScoreMetadata(
+                            name=name,
+                            title='Restraint Satisfaction for {0}'.format(res),
+                            unit=restraint_units[metric],
+                            guide=1.0, lower=0.0, upper='95%', order=3,
+                    )
+                record[name] = value
+
+    return records, metadata
+
+def evaluate_restraints(restraints, atoms, xyzs):
+    """
+    Calculate how far each restraint is from being satisfied in each of the 
+    given structures, and return the results as an array with one row for 
+    each structure and one column for each restraint.
+
+    The atoms and xyzs arguments are the same as for 
+    calculate_restraint_metrics().  The restraints are grouped by type, and 
+    each group is evaluated for every structure at once by the 
+    evaluate_batch() method of that type.  The results are the same (to 
+    floating-point precision) as calling distance_from_ideal() on each 
+    restraint for each structure.
+    """
+    atom_indices = {atom: i for i, atom in enumerate(atoms)}
+    xyzs = np.asarray(xyzs, dtype=float).reshape(-1, len(atoms), 3)
+    deviations = np.empty((len(xyzs), len(restraints)))
+
+    columns_by_type = collections.OrderedDict()
+    for j, restraint in enumerate(restraints):
+        columns_by_type.setdefault(type(restraint), []).append(j)
+
+    for restraint_type, columns in columns_by_type.items():
+        deviations[:,columns] = restraint_type.evaluate_batch(
+                [restraints[j] for j in columns], atom_indices, xyzs)
+
+    return deviations
+
+def restrained_atom_columns(restraints, atom_xyzs, sequence_map):
+    """
+    Return a record containing the coordinates of every restrained atom and 
+    the amino acid of every restrained residue, in hidden columns (i.e. 
+    columns starting with an underscore) named as follows:
+
+        _xyz_<residue id>_<atom name>_<x|y|z>
+        _aa_<residue id>
+
+    This is everything that calculate_restraint_metrics() needs to know about 
+    a structure, see restrained_atoms_from_columns().
+    """
+    record = {}
+
+    for atom_name, residue_id in find_restrained_atoms(restraints):
+        xyz = atom_xyzs.get((atom_name, residue_id))
+        if xyz is None:
+            continue
+        for axis, coord in zip('xyz', xyz):
+            column = '_xyz_{0}_{1}_{2}'.format(residue_id, atom_name, axis)
+            record[column] = coord
+
+        if residue_id in sequence_map:
+            record['_aa_{0}'.format(residue_id)] = sequence_map[residue_id]
+
+    return record
+
+def restrained_atoms_from_columns(records, atoms):
+    """
+    Return the coordinates of the given atoms in each of the given records 
+    (i.e. a data frame of cached metrics), along with a sequence map for each 
+    record, as expected by calculate_restraint_metrics().  Any coordinates 
+    that weren't saved by restrained_atom_columns() are NaN.
+    """
+    xyzs = np.full((len(records), len(atoms), 3), np.nan)
+    sequence_maps = [{} for i in range(len(records))]
+
+    for i, (atom_name, residue_id) in enumerate(atoms):
+        for j, axis in enumerate('xyz'):
+            column = '_xyz_{0}_{1}_{2}'.format(residue_id, atom_name, axis)
+            if column in records:
+                xyzs[:,i,j] = records[column].values
+
+    for residue_id in set(x[1] for x in atoms):
+        column = '_aa_{0}'.format(residue_id)
+        aas = records[column].values if column in records else [None] * len(records)
+
+        for sequence_map, aa in zip(sequence_maps, aas):
+            sequence_map[residue_id] = \
+                    aa if isinstance(aa, basestring) and aa else 'X'
+
+    return xyzs, sequence_maps
+
+def recalculate_restraint_metrics(records, restraints):
+    """
+    Recalculate the restraint metrics for the given records using the 
+    coordinates saved by restrained_atom_columns(), rather than reading the 
+    structures again.  Return the updated records, the metadata for the new 
+    metrics, and a boolean mask indicating which records could be updated.  
+    Records that didn't save the coordinates of every atom involved in the 
+    given restraints have to be read again, and are left as they were.
+
+    All the existing 'restraint_*' columns are discarded from the records 
+    that are updated, because the old restraints may have produced metrics 
+    (e.g. for particular residues) that the new ones don't.
+    """
+    atoms = find_restrained_atoms(restraints)
+    xyzs, sequence_maps = restrained_atoms_from_columns(records, atoms)
+    updated = ~np.isnan(xyzs).any(axis=(1,2))
 
-                elif splitline[1] == 'Avg':
-                    meta = ScoreMetadata(
-                            name='avg_fragment_crmsd',
-                            title='Avg {}-Residue Fragment RMSD \
-(C-Alpha)'.format(fragment_size),
-                            order=9)
-                else:
-                    position = splitline[2]
-                    crmsd = splitline[4]
-                    meta = ScoreMetadata(
-                            name='fragment_crmsd_pos_{}'.format(position),
-                            title='{}-Residue Fragment RMSD at Res {} \
-(C-Alpha)'.format(fragment_size,position),
-                            order=6)
+    new_records, metadata = calculate_restraint_metrics(
+            restraints, atoms, xyzs[updated],
+            [x for x, ok in zip(sequence_maps, updated) if ok])
 
-                record[meta.name] = float(splitline[4])
-                metadata[meta.name] = meta
+    records = records.copy()
+    old_columns = [x for x in records if x.startswith('restraint_')]
+    records.loc[updated, old_columns] = np.nan
 
-            elif line.startswith('EXTRA_SCORE'):
-                tokens = line[len('EXTRA_SCORE_'):].rsplit(None, 1)
-                meta = parse_extra_metric(tokens[0], 5)
-                record[meta.name] = float(tokens[1])
-                metadata[meta.name] = meta
+    new_records = pd.DataFrame(new_records, index=records.index[updated])
+    for column in new_records:
+        if column not in records:
+            records[column] = np.nan
+        records.loc[updated, column] = new_records[column].values
 
-            elif line.startswith('EXTRA_METRIC'):
-                tokens = line[len('EXTRA_METRIC '):].rsplit(None, 1)
+    return records, metadata, updated
 
-                # Ignore the BuriedUnsat filter.  It just reports 911 every 
-                # time, and we extract the actual buried unsat information from 
-                # some other lines it adds to the PDB.
-                if tokens[0] == 'IGNORE':
-                    continue
-                if tokens[0] == 'Buried Unsatisfied H-Bonds [-|#]':
-                    continue
+def rescore_restraints(pdb_dirs, restraints_paths):
+    """
+    Calculate the restraint metrics that the structures in the given 
+    directories would have with each of the given restraints files, without 
+    reading any structures.  This is meant for quickly seeing how existing 
+    models fare against new design goals.
+
+    The coordinates come from the metrics cache (see restrained_atom_columns()) 
+    and, for atoms that weren't restrained when the structures were cached, 
+    from the coordinate store (see load_coords()).  So the structures need to 
+    have been cached already, and restraints on atoms that are in neither 
+    place produce NaN metrics.  The coordinates for all the directories and 
+    all the restraints files are gathered once, and each restraints file is 
+    then evaluated for every structure at once.
+
+    Return a list with one (records, metadata) tuple for each restraints file.  
+    The records are a data frame with the 'directory' and 'path' of each 
+    structure followed by the 'restraint_*' columns.
+    """
+    restraint_sets = [parse_restraints(x) for x in restraints_paths]
+    atoms = find_restrained_atoms([x for xs in restraint_sets for x in xs])
 
-                meta = parse_extra_metric(tokens[0], 5)
-                record[meta.name] = float(tokens[1])
-                metadata[meta.name] = meta
-
-            elif (line.startswith('ATOM') or line.startswith('HETATM')):
-                atom_name = line[12:16].strip()
-                residue_id = int(line[22:26].strip())
-                residue_name = line[17:20].strip()
-
-                # Keep track of this model's sequence.
-
-                if residue_id != last_residue_id:
-                    if line.startswith('ATOM'): 
-                        one_letter_code = residue_type_3to1_map.get(residue_name, 'X')
-                        sequence += one_letter_code
-                        sequence_map[residue_id] = one_letter_code
-                        last_residue_id = residue_id
-                    elif line.startswith('HETATM'):
-                        sequence_map[residue_id] = 'X'
-                        last_residue_id = residue_id
-
-                # Save the coordinate for this atom.  This will be used later 
-                # to calculate restraint distances.
-
-                atom_xyzs[atom_name, residue_id] = xyz_to_array((
-                        line[30:38], line[38:46], line[46:54]))
-
-        # Calculate how well each restraint was satisfied.
-
-        restraint_values = {}
-        restraint_values_by_residue = {}
-        is_sidechain_restraint = {}
-        restraint_units = {
-                'dist': 'Å',
-                'angle': '°',
-        }
+    paths, xyzs, sequence_maps = [], [], []
 
-        for restraint in restraints:
-            d = restraint.distance_from_ideal(atom_xyzs)
-            metric = restraint.metric
-            backbone_atoms = set(['N', 'C', 'CA', 'O'])
-            backbone_restraint = backbone_atoms.issuperset(restraint.atom_names)
-
-            restraint_values.setdefault(metric, []).append(d)
-            restraint_values_by_residue.setdefault(metric, {})
-            for i in restraint.residue_ids:
-                restraint_values_by_residue[metric].setdefault(i, []).append(d)
-                is_sidechain_restraint[i] = (not backbone_restraint) \
-                        or is_sidechain_restraint.get(i, False)
-
-        for metric, values in restraint_values.items():
-            meta = ScoreMetadata(
-                    name='restraint_{0}'.format(metric),
-                    title='Restraint Satisfaction',
-                    unit=restraint_units[metric],
-                    guide=1.0, lower=0.0, upper='95%', order=2,
-            )
-            record[meta.name] = np.max(values)
-            metadata[meta.name] = meta
-
-        for metric, values_by_residue in restraint_values_by_residue.items():
-            if len(values_by_residue) <= 1:
-                continue
+    for pdb_dir in pdb_dirs:
+        dir_paths, dir_xyzs, dir_sequence_maps = \
+                read_cached_coords(pdb_dir, atoms)
+        paths += [(pdb_dir, x) for x in dir_paths]
+        xyzs.append(dir_xyzs)
+        sequence_maps += dir_sequence_maps
 
-            for i in values_by_residue:
-                # I want to put the amino acid in these names, because I think 
-                # it looks nice, but it causes problems for positions that can 
-                # mutate.  So I assume that if a position has a sidechain 
-                # restraint, it must not be allowed to mutate.
-                aa = sequence_map[i] if is_sidechain_restraint[i] else 'X'
-                res = '{0}{1}'.format(aa, i)
-                meta = ScoreMetadata(
-                        name='restraint_{0}_{1}'.format(metric, res.lower()),
-                        title='Restraint Satisfaction for {0}'.format(res),
-                        unit=restraint_units[metric],
-                        guide=1.0, lower=0.0, upper='95%', order=3,
-                )
-                record[meta.name] = np.max(values_by_residue[i])
-                metadata[meta.name] = meta
+    xyzs = np.concatenate(xyzs) if xyzs else np.empty((0, len(atoms), 3))
+    results = []
 
-        # Finish calculating some records that depend on the whole structure.
+    for restraints in restraint_sets:
+        records, metadata = calculate_restraint_metrics(
+                restraints, atoms, xyzs, sequence_maps)
 
-        record['sequence'] = sequence
-        for i, score in dunbrack_scores.items():
-            aa = sequence_map[i] if is_sidechain_restraint[i] else 'X'
-            res = '{0}{1}'.format(aa, i)
-            meta = ScoreMetadata(
-                    name='dunbrack_score_{0}'.format(res.lower()),
-                    title='Dunbrack Score for {0}'.format(res),
-                    unit='REU',
-                    order=5,
-            )
-            record[meta.name] = score
-            metadata[meta.name] = meta
+        columns = ['directory', 'path'] + sorted(metadata)
+        records = pd.DataFrame(records, columns=columns)
+        records['directory'] = [x[0] for x in paths]
+        records['path'] = [x[1] for x in paths]
+        results.append((records, metadata))
 
-        records.append(record)
+    return results
 
-    if pdb_paths:
-        sys.stdout.write('\n')
+def read_cached_coords(pdb_dir, atoms):
+    """
+    Return the coordinates of the given atoms for every cached structure in 
+    the given directory, gathered from the metrics cache and the coordinate 
+    store, as described in rescore_restraints().  Return the file names, an 
+    array of coordinates (NaN for atoms that weren't saved), and a sequence 
+    map for each structure.
+    """
+    cache_dir = os.path.join(pdb_dir, 'metrics_cache')
+    manifest = scan_pdb_dir(pdb_dir)
+    records, num_rows = read_metrics_shards(cache_dir)
+    records, num_dropped = drop_stale_records(records, manifest)
+    records = records.sort_values('path').reset_index(drop=True)
 
-    return records, metadata
+    xyzs, sequence_maps = restrained_atoms_from_columns(records, atoms)
 
-def parse_restraints(path):
-    restraints = []
-    parsers = {
-            'CoordinateConstraint': CoordinateRestraint,
-            'AtomPairConstraint': AtomPairRestraint,
-            'AtomPair': AtomPairRestraint,
-            'Dihedral': DihedralRestraint,
-            'NamedAngle': AngleRestraint,
-    }
+    # Amino acids are only saved for residues that were restrained, so fall 
+    # back on the sequence for any others.
 
-    with open(path) as file:
-        for line in file:
-            if not line.strip(): continue
-            if line.startswith('#'): continue
+    for residue_id in set(x[1] for x in atoms):
+        if '_aa_{0}'.format(residue_id) in records:
+            continue
+        for sequence_map, sequence in zip(sequence_maps, records['sequence']):
+            if isinstance(sequence, basestring) and residue_id <= len(sequence):
+                sequence_map[residue_id] = sequence[residue_id - 1]
+
+    # Look in the coordinate store for any atoms that weren't restrained when 
+    # the structures were cached.  Only ask for atoms that are actually in the 
+    # store, because load_coords() ignores shards missing any requested atom.
+
+    coords_dir = os.path.join(cache_dir, 'coords')
+    coord_shards = list_metrics_shards(coords_dir)
+    missing = np.isnan(xyzs).any(axis=(0,2))
+    columns = []
+
+    if coord_shards and missing.any():
+        last_shard = os.path.join(coords_dir, coord_shards[-1])
+        stored_atoms = set(
+                tuple(x) for x in read_metrics_schema(last_shard)['attrs']['atoms'])
+        columns = [
+                i for i, atom in enumerate(atoms)
+                if missing[i] and atom in stored_atoms]
+
+    if columns:
+        stored_paths, stored_xyzs = \
+                load_coords(pdb_dir, [atoms[i] for i in columns])
+        stored_rows = pd.Series(np.arange(len(stored_paths)), index=stored_paths)
+        stored_rows = stored_rows.reindex(records['path']).values
+        found = np.flatnonzero(~np.isnan(stored_rows))
+
+        cached_xyzs = xyzs[np.ix_(found, columns)]
+        xyzs[np.ix_(found, columns)] = np.where(
+                np.isnan(cached_xyzs),
+                stored_xyzs[stored_rows[found].astype(int)],
+                cached_xyzs,
+        )
 
-            tokens = line.split()
-            key, args = tokens[0], tokens[1:]
+    return list(records['path']), xyzs, sequence_maps
 
-            if key not in parsers:
-                raise IOError("Cannot parse '{0}' restraints.".format(key))
+def sequence_matrix(sequences):
+    """
+    Return the given sequences (e.g. the 'sequence' column of a data frame from 
+    load()) as a matrix of residue codes, with one row for each sequence and 
+    one column for each residue (i.e. residue i is in column i-1).
+
+    The codes are the ASCII values of the one-letter amino acid codes, stored 
+    as uint8, so the matrix takes one byte per residue and any row (or any 
+    slice of a row) can be turned back into a string with tostring().  Missing 
+    sequences, and the ends of sequences that are shorter than the others, 
+    are filled with zeros.  This takes one vectorized conversion, because the 
+    sequences are byte strings of the same width once they're in a numpy 
+    array.
+    """
+    sequences = np.array([
+            x.encode('ascii') if isinstance(x, unicode) else
+            x if isinstance(x, bytes) else b''
+            for x in sequences], dtype=bytes)
+    return sequences.view(np.uint8).reshape(len(sequences), sequences.itemsize)
 
-            restraint = parsers[key](args)
-            restraints.append(restraint)
+def designable_mask(resfile, num_residues):
+    """
+    Return a boolean mask selecting the positions that are designable in the 
+    given resfile (see pipeline.load_resfile()) from the columns of a sequence 
+    matrix (see sequence_matrix()) with the given number of columns.  An 
+    IOError is raised if the resfile refers to positions beyond the end of 
+    the sequences, e.g. because it's from a different workspace.
+    """
+    positions = [int(i) for i in resfile.designable]
+    out_of_range = [i for i in positions if not 1 <= i <= num_residues]
 
-    return restraints
+    if out_of_range:
+        raise IOError("""\
+The resfile '{0}' refers to positions that aren't in the designed sequences, 
+which only have {1} residues: {2}""".format(
+            getattr(resfile, 'path', '?'), num_residues,
+            ', '.join(str(x) for x in sorted(out_of_range))))
+
+    mask = np.zeros(num_residues, dtype=bool)
+    mask[[i - 1 for i in positions]] = True
+    return mask
 
 def parse_extra_metric(desc, default_order=None):
     """
@@ -561,6 +2476,66 @@ def xyz_to_array(xyz):
     """
     return np.array([float(x) for x in xyz])
 
+def _atom_record_chars(lines):
+    # Rosetta writes every line with the same width, in which case the lines 
+    # can be used as they are.  Otherwise pad or truncate them to the width of 
+    # the fields we need.
+
+    width = 54
+    lengths = set(map(len, lines))
+
+    if len(lengths) == 1 and min(lengths) > width:
+        buffer = b''.join(lines)
+    else:
+        buffer = b''.join(x.rstrip(b'\r\n')[:width].ljust(width) for x in lines)
+
+    return np.frombuffer(buffer, dtype=np.uint8).reshape(len(lines), -1)
+
+def _decode_strings(chars):
+    # Only a handful of different strings (e.g. atom names) appear in each 
+    # field, so only strip the unique ones.
+    strings = np.ascontiguousarray(chars).view('S{}'.format(chars.shape[1]))
+    unique, indices = np.unique(strings.ravel(), return_inverse=True)
+    unique = np.array([x.strip() for x in unique.tolist()], dtype=unique.dtype)
+    return unique[indices]
+
+def _decode_numbers(chars):
+    """
+    Decode a 2D array of characters, where each row is a right-aligned number 
+    (e.g. '  -1.234') with the decimal point (if any) in the same column, into 
+    a 1D array of floats.
+
+    Each number is calculated as an exact integer, then divided by the right 
+    power of ten, so the results are identical to calling float() on each row.  
+    Rows that don't fit this format are passed to float() instead.
+    """
+    num_rows, width = chars.shape
+    digits = chars - np.uint8(ord(b'0'))
+    is_digit = digits < 10
+    is_point = chars == ord(b'.')
+    is_minus = chars == ord(b'-')
+    is_space = chars == ord(b' ')
+    columns = np.arange(width)
+
+    point = np.argmax(is_point[0]) if is_point[0].any() else width
+    is_formatted = \
+            (is_point == (columns == point)).all() and \
+            (is_digit | is_point | is_minus | is_space).all() and \
+            is_digit.any(axis=1).all()
+
+    if not is_formatted:
+        strings = np.ascontiguousarray(chars).view('S{}'.format(width))
+        return np.array([float(x) for x in strings.ravel()])
+
+    exponents = width - 1 - columns
+    exponents[columns < point] -= point < width
+    weights = np.where(columns == point, 0, 10.0 ** exponents)
+    decimals = max(width - 1 - point, 0)
+
+    numbers = (digits * is_digit).dot(weights) / 10.0 ** decimals
+    numbers[is_minus.any(axis=1)] *= -1
+    return numbers
+
 def angle(array_of_xyzs):
     """
     Calculates angle between three coordinate points (I could not find a package
@@ -610,7 +2585,57 @@ def dihedral(array_of_xyzs):
     return principle_dihedral
 
 
-def make_picks(workspace, pick_file=None, clear=False, use_cache=True, dry_run=False, keep_dups=False):
+def angles(a, b, c):
+    """
+    Calculate the angles (in radians) between the given arrays of coordinates, 
+    which can have any number of leading dimensions.  This is the vectorized 
+    equivalent of angle().
+    """
+    ab = a - b
+    cb = c - b
+    return np.arccos(_dots(ab, cb) / (_norms(ab) * _norms(cb)))
+
+def dihedrals(p1, p2, p3, p4):
+    """
+    Calculate the dihedral angles (in radians) between the given arrays of 
+    coordinates, which can have any number of leading dimensions.  This is the 
+    vectorized equivalent of dihedral().
+    """
+    vector1 = -1.0 * (p2 - p1)
+    vector2 = p3 - p2
+    vector3 = p4 - p3
+
+    vector2 = vector2 / _norms(vector2)[...,np.newaxis]
+
+    v = vector1 - _dots(vector1, vector2)[...,np.newaxis] * vector2
+    w = vector3 - _dots(vector3, vector2)[...,np.newaxis] * vector2
+
+    x = _dots(v, w)
+    y = _dots(np.cross(vector2, v), w)
+    return np.arctan2(y, x)
+
+def _dots(a, b):
+    return (a * b).sum(axis=-1)
+
+def _norms(a):
+    return np.sqrt(_dots(a, a))
+
+def _gather_coords(restraints, attr, atom_indices, xyzs):
+    # Return one (n_structures x n_restraints x 3) array for each of the atoms 
+    # (in order) involved in the given restraints.
+    atoms = zip(*[getattr(x, attr) for x in restraints])
+    return [xyzs[:,[atom_indices[x] for x in column]] for column in atoms]
+
+def _principal_angle_deviations(measured, ideal):
+    # Make sure we don't get the wrong number because of non-principle angles.
+    return np.minimum.reduce([
+            abs(measured - ideal),
+            abs(measured + 360 - ideal),
+            abs(measured - 360 - ideal),
+    ])
+
+
+def make_picks(workspace, pick_file=None, clear=False, use_cache=True, dry_run=False, keep_dups=False, compact=False, processes=1):
     """
     Return a subset of the designs in the given data frame based on the 
     conditions specified in the given "pick" file.
@@ -634,6 +2659,13 @@ def make_picks(workspace, pick_file=None, clear=False, use_cache=True, dry_run=F
     metrics listed in the "Pareto" section will be kept.  The "depth" and 
     "epsilon" parameters provide a measure of control over how many designs 
     are included in the Pareto front.
+
+    If compact is true, the metrics are kept in a more memory efficient form 
+    while the picks are being made (see compact_metrics()).
+
+    The predecessor's output directories are checked and loaded in parallel 
+    threads (see refresh_metrics_index()), and any models that haven't been 
+    cached yet are divided between the given number of processes.
     """
     # Read the rules for making picks from the given file.
 
@@ -676,23 +2708,19 @@ Did you mean:
     if clear:
         workspace.clear_inputs()
 
+    # The metrics are read from the workspace-wide index, so only directories 
+    # that changed since they were last loaded have to be loaded again.
+
     predecessor = workspace.predecessor
-    metrics = []
-    metadata = {}
+    input_dirs = predecessor.output_subdirs
 
-    for input_dir in predecessor.output_subdirs:
-        submetrics, submetadata = load(
-                input_dir,
-                use_cache=use_cache,
-        )
-        submetrics['abspath'] = submetrics.apply(
-                lambda row: os.path.abspath(os.path.join(input_dir, row['path'])),
-                axis='columns',
-        )
-        metrics.append(submetrics)
-        metadata.update(submetadata)
+    refresh_metrics_index(
+            workspace, input_dirs, use_cache=use_cache, processes=processes)
+    metrics, metadata = query_metrics_index(workspace, input_dirs)
+    metrics = metrics.drop(['round', 'step', 'design'], axis=1)
 
-    metrics = pd.concat(metrics, ignore_index=True)
+    if compact:
+        metrics = compact_metrics(metrics)
 
     # Check to make sure we know about all the metrics we were given, and 
     # produce a helpful error if we find something unexpected (e.g. maybe a 
@@ -787,6 +2815,8 @@ correct the 'dir' field for any metrics necessary."""
     # Keep only the lowest scoring model for each set of identical sequences.
 
     if not keep_dups:
+        if metrics['sequence'].dtype.name == 'category':
+            metrics['sequence'] = metrics['sequence'].cat.remove_unused_categories()
         groups = metrics.groupby('sequence', group_keys=False)
         metrics = groups.\
                 apply(lambda df: df.ix[df.total_score.idxmin()]).\
@@ -816,11 +2846,16 @@ correct the 'dir' field for any metrics necessary."""
         )
         print status.update(metrics, 'minus Pareto dominated')
 
-    # Remove designs that have already been picked.
+    # Remove designs that have already been picked.  The absolute paths are 
+    # only worked out for the designs that are left at this point, by adding 
+    # each directory (joined once per directory) to the front of the paths.
 
-    existing_inputs = set(
-            os.path.abspath(os.path.realpath(x))
-            for x in workspace.input_paths)
+    directories = metrics['directory'].astype(object)
+    prefixes = {x: os.path.join(x, '') for x in directories.unique()}
+    metrics = metrics.assign(
+            abspath=directories.map(prefixes) + metrics['path'].astype(object))
+
+    existing_inputs = set(picked_source(x) for x in workspace.input_paths)
     metrics = metrics.query('abspath not in @existing_inputs')
     print status.update(metrics, 'minus current inputs')
 
@@ -828,15 +2863,26 @@ correct the 'dir' field for any metrics necessary."""
 
     if not dry_run:
         existing_ids = set(
-                int(x[0:-len('.pdb.gz')])
+                int(pdb_codecs.strip_extension(x))
                 for x in os.listdir(workspace.input_dir)
-                if x.endswith('.pdb.gz'))
+                if pdb_codecs.is_pdb_path(x))
         next_id = max(existing_ids) + 1 if existing_ids else 0
 
         for id, picked_index in enumerate(metrics.index, next_id):
             target = metrics.loc[picked_index]['abspath']
             link_name = os.path.join(workspace.input_dir, '{0:04}.pdb.gz')
-            scripting.relative_symlink(target, link_name.format(id))
+
+            # Rosetta can only read gzipped (or uncompressed) models, so models 
+            # saved in any other format are copied rather than linked.  The 
+            # source of each copy is recorded first, so the model is never 
+            # picked again (see picked_source()).
+            if target.endswith('.pdb.gz'):
+                scripting.relative_symlink(target, link_name.format(id))
+            else:
+                with open(link_name.format(id) + '.source', 'w') as file:
+                    file.write(target + '\n')
+                pdb_codecs.write_bytes(
+                        link_name.format(id), pdb_codecs.read_bytes(target))
 
     print
     print "Picked {} designs.".format(len(metrics))
@@ -844,6 +2890,19 @@ correct the 'dir' field for any metrics necessary."""
     if dry_run:
         print "(Dry run: no symlinks created.)"
 
+def picked_source(input_path):
+    """
+    Return the absolute path of the model that the given input was picked 
+    from by make_picks().  Inputs are usually symlinks to the picked models, 
+    but models that rosetta can't read are copied instead, and the path of 
+    the original is saved in a file next to the copy.
+    """
+    try:
+        with open(input_path + '.source') as file:
+            return file.read().strip()
+    except EnvironmentError:
+        return os.path.abspath(os.path.realpath(input_path))
+
 def find_pareto_front(metrics, metadata, columns, depth=1, epsilon=None, progress=None):
     """
     Return the subset of the given metrics that are Pareto optimal with respect 
@@ -975,6 +3034,1097 @@ def find_pareto_front(metrics, metadata, columns, depth=1, epsilon=None, progres
     return metrics[mask]
 
 
+class MetricsCache(object):
+    """
+    Keep track of which structures in a directory have already been cached, and 
+    add newly calculated metrics to the cache.
+
+    Creating a MetricsCache object validates the given directory and reads the 
+    existing cache, if there is one and use_cache is true.  The paths that 
+    still need to be read are then available via the uncached_paths attribute.  
+    Once the metrics for those paths have been calculated, pass them to 
+    update() to write the cache and get the complete data frame.
+
+    The cache is append-only: update() writes the new records to a new shard 
+    rather than rewriting the whole cache, so the cost of caching a handful of 
+    new structures doesn't depend on how many structures were cached before.  
+    The shards are periodically merged by compact_metrics_cache().
+
+    If store_coords is true, the coordinates of the restrained atoms and the 
+    loop backbone atoms (see find_stored_atoms()) are also saved in a separate 
+    coordinate store, which has the same append-only layout as the cache.  The 
+    coordinates of newly read structures are extracted while they're being 
+    parsed for their metrics (see read_and_calculate()).  Structures that were 
+    cached before the coordinates were asked for are read again by update(), 
+    but only once.
+
+    If columns is given, only those columns (see load()) are read from the 
+    cache, along with the columns the cache itself needs.  Every column is 
+    still read if any of the cached records have to be rewritten (e.g. 
+    because the restraints changed), since the new records would otherwise 
+    be incomplete.
+
+    Metrics can also be saved before update() is called, by passing them to 
+    checkpoint() as they're calculated.  Checkpointed records are written to 
+    the cache as ordinary shards, so if the process is interrupted, the next 
+    MetricsCache for the same directory will simply find them already cached.
+
+    update() also keeps summary statistics for every metric alongside the 
+    cache (see read_metrics_summary()), and attaches them to the metadata it 
+    returns, so that things like axis limits don't need to look at every 
+    value.  The statistics are only recalculated for metrics that weren't 
+    summarized yet, or once the structures or restraints change.
+    """
+
+    # Compact the cache once it has more than this many shards, or once more 
+    # than this fraction of the records in it have been superseded or refer to 
+    # files that have been changed or deleted.
+    max_shards = 16
+    max_stale_fraction = 0.5
+
+    # Write checkpointed records to the cache once this many have accumulated, 
+    # or once this many seconds have passed since the last checkpoint.
+    checkpoint_size = 1000
+    checkpoint_interval = 300
+
+    def __init__(self, pdb_dir, use_cache=True, require_io_dir=True, store_coords=False, columns=None):
+        self.pdb_dir = pdb_dir
+        self.use_cache = use_cache
+        self.store_coords = store_coords
+        self.columns = None if columns is None else list(columns)
+
+        # Make sure the given directory seems to be a reasonable place to look 
+        # for data, i.e. it exists and contains PDB files.  This also records 
+        # the size, modification time, and inode of every structure, so we can 
+        # tell which ones have changed since they were cached.
+
+        self.manifest = scan_pdb_dir(pdb_dir)
+
+        # The given directory must also be a workspace, so that the restraint 
+        # file can be found and used to calculate the "restraint_dist" metric 
+        # later on.
+
+        try:
+            self.workspace = pipeline.workspace_from_dir(pdb_dir)
+        except pipeline.WorkspaceNotFound:
+            raise IOError("'{}' is not a workspace".format(pdb_dir))
+        if require_io_dir and not any(
+                os.path.samefile(pdb_dir, x) for x in self.workspace.io_dirs):
+            raise IOError("'{}' is not an input or output directory".format(pdb_dir))
+
+        # Find all the structures in the given directory, then decide which 
+        # have already been cached and which haven't.
+
+        self.cache_dir = os.path.join(pdb_dir, 'metrics_cache')
+        self.coords_dir = os.path.join(self.cache_dir, 'coords')
+        self.legacy_cache_path = os.path.join(pdb_dir, 'metrics.pkl')
+        self.metadata_path = os.path.join(pdb_dir, 'metrics.yml')
+
+        self.cached_records = pd.DataFrame()
+        self.metadata = {}
+        self.num_shards = 0
+        self.num_stale = 0
+        self.is_legacy = False
+
+        self.pending_records = []
+        self.pending_metadata = {}
+        self.checkpointed_paths = set()
+        self.checkpoint_time = time.time()
+        self.cleared_dirs = set()
+
+        try:
+            self.restraints_hash = hash_restraints(self.workspace.restraints_path)
+        except EnvironmentError:
+            self.restraints_hash = None
+
+        # If the cache exists but can't be read, warn the user rather than 
+        # silently recalculating everything.  Since caches are only ever 
+        # replaced atomically, this shouldn't happen because another process 
+        # is writing to the cache at the same time.
+
+        if use_cache and self.cache_exists:
+            try:
+                self._read_cache(self.columns)
+                if self.columns is not None and self._find_outdated_records().any():
+                    self._read_cache()
+                self.metadata = read_metadata(self.metadata_path)
+
+            except (EnvironmentError, ValueError, KeyError, yaml.YAMLError) as error:
+                print "Ignoring unreadable cache in '{}': {}".format(pdb_dir, error)
+                self.cached_records = pd.DataFrame()
+                self.metadata = {}
+                self.num_shards = 0
+                self.num_stale = 0
+                self.is_legacy = False
+
+        # Recalculate the restraint metrics for any cached records that were 
+        # calculated using a different restraints file.
+
+        self.rescored = np.zeros(len(self.cached_records), dtype=bool)
+
+        if self.restraints_hash and len(self.cached_records):
+            self._update_restraint_metrics()
+
+        cached_paths = set(self.cached_records.get('path', []))
+        uncached = ~self.manifest['path'].isin(cached_paths)
+
+        # Use the metrics that were calculated on the cluster (see 
+        # write_metrics_sidecar()) for any structures that aren't cached yet, 
+        # so that those structures don't have to be read again.
+
+        self.sidecar_records = []
+        self.sidecar_metadata = {}
+
+        if use_cache and uncached.any():
+            self.sidecar_records, self.sidecar_metadata = read_metrics_sidecars(
+                    pdb_dir, self.manifest[uncached], self.restraints_hash)
+
+        sidecar_paths = set(x['path'] for x in self.sidecar_records)
+        self.uncached_paths = [
+                os.path.join(pdb_dir, x) for x in self.manifest['path'][uncached]
+                if x not in sidecar_paths]
+
+        # Find out which structures already have their coordinates stored, if 
+        # the coordinates were asked for.
+
+        self.coord_atoms = []
+        self.stored_coord_paths = set()
+
+        if store_coords:
+            self.coord_atoms = find_stored_atoms(self.workspace, pdb_dir)
+
+        if store_coords and use_cache:
+            try:
+                index, num_rows = read_coords_index(
+                        self.coords_dir, self.coord_atoms)
+                index, num_dropped = drop_stale_records(index, self.manifest)
+                self.stored_coord_paths = set(index['path'])
+            except (EnvironmentError, ValueError, KeyError) as error:
+                print "Ignoring unreadable coordinates in '{}': {}".format(pdb_dir, error)
+
+    @property
+    def cache_exists(self):
+        return bool(list_metrics_shards(self.cache_dir)) or \
+                os.path.exists(self.legacy_cache_path)
+
+    def _read_cache(self, columns=None):
+        """
+        Read the records that are still up-to-date from the cache.  Caches from 
+        older versions of this module (i.e. pickled data frames) are read if no 
+        newer cache is present, but will be converted into the current format.
+        """
+        if columns is not None:
+            columns = list(columns) + ['_restraints_hash']
+
+        try:
+            records, num_rows = read_metrics_shards(self.cache_dir, columns)
+            self.num_shards = len(list_metrics_shards(self.cache_dir))
+        except IOError:
+            if not os.path.exists(self.legacy_cache_path):
+                raise
+            records = pd.read_pickle(self.legacy_cache_path)
+            num_rows = len(records)
+            self.is_legacy = True
+
+        self.cached_records, num_dropped = \
+                drop_stale_records(records, self.manifest)
+        self.num_stale = num_rows - len(self.cached_records)
+
+    def _find_outdated_records(self):
+        """
+        Return a mask of the cached records that will be rewritten because they 
+        weren't calculated with the current restraints file, or because it's 
+        not known which restraints file they were calculated with (see 
+        _update_restraint_metrics()).
+        """
+        records = self.cached_records
+        if not self.restraints_hash or not len(records):
+            return np.zeros(len(records), dtype=bool)
+
+        hashes = records.reindex(columns=['_restraints_hash'])['_restraints_hash']
+        return hashes.fillna('').values != self.restraints_hash
+
+    def _update_restraint_metrics(self):
+        """
+        Make sure every cached record reflects the current restraints file.
+
+        The restraint metrics depend only on the coordinates of the restrained 
+        atoms, which are saved in the cache along with a hash of the restraints 
+        file they were calculated with.  So if the restraints change, these 
+        metrics can usually be recalculated without reading any structures.  
+        A copy of each restraints file is kept in the cache, so we can tell 
+        whether the old and new restraints involve the same residues.  If they 
+        don't, the Dunbrack scores (which are only recorded for restrained 
+        residues) are out-of-date too, and the records are discarded so that 
+        the structures will be read again.  The same happens if the new 
+        restraints involve atoms that weren't saved.
+
+        Records from caches that predate this check can't be checked, so 
+        they're assumed to be up-to-date (which is what older versions did).
+        """
+        records = self.cached_records
+        hashes = records.reindex(columns=['_restraints_hash'])['_restraints_hash']
+        hashes = hashes.fillna('').values
+
+        unknown = hashes == ''
+        outdated = (hashes != self.restraints_hash) & ~unknown
+
+        if not unknown.any() and not outdated.any():
+            return
+
+        restraints = parse_restraints(self.workspace.restraints_path)
+        is_sidechain_restraint = find_sidechain_restraints(restraints)
+        keep = ~outdated
+        rescorable = np.zeros(len(records), dtype=bool)
+
+        for old_hash in set(hashes[outdated]):
+            try:
+                old_restraints = parse_restraints(
+                        self._restraints_copy_path(old_hash))
+            except EnvironmentError:
+                continue
+
+            if find_sidechain_restraints(old_restraints) == is_sidechain_restraint:
+                rescorable |= hashes == old_hash
+
+        if rescorable.any():
+            rescored, metadata, updated = recalculate_restraint_metrics(
+                    records[rescorable], restraints)
+            keep[np.flatnonzero(rescorable)[updated]] = True
+
+            columns = sorted(set(records.columns) | set(rescored.columns))
+            records = pd.concat([
+                    records[~rescorable].reindex(columns=columns),
+                    rescored.reindex(columns=columns),
+            ]).sort_index()
+            self.metadata.update(metadata)
+
+        # Once the remaining records are saved with the current hash, the 
+        # records they replace will be stale.
+
+        rescored = (outdated | unknown)[keep]
+        records = records[keep].reset_index(drop=True)
+        records.loc[rescored, '_restraints_hash'] = self.restraints_hash
+
+        self.cached_records = records
+        self.rescored = rescored
+        self.num_stale += np.sum(rescored)
+
+    def _restraints_copy_path(self, restraints_hash):
+        return os.path.join(self.cache_dir, 'restraints', restraints_hash)
+
+    def _save_restraints(self):
+        """
+        Keep a copy of the current restraints file in the cache, so we can tell 
+        how they differ from the restraints used in the future.  The caller 
+        must hold the lock for the cache.
+        """
+        import shutil
+
+        if not self.restraints_hash:
+            return
+
+        copy_path = self._restraints_copy_path(self.restraints_hash)
+        if os.path.exists(copy_path):
+            return
+
+        try:
+            os.makedirs(os.path.dirname(copy_path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(copy_path)):
+                raise
+
+        # Make sure the file didn't change since we hashed it.
+        tmp_path = '{}.tmp{}'.format(copy_path, os.getpid())
+        shutil.copyfile(self.workspace.restraints_path, tmp_path)
+
+        if hash_restraints(tmp_path) == self.restraints_hash:
+            os.rename(tmp_path, copy_path)
+        else:
+            os.remove(tmp_path)
+
+    def update(self, uncached_records, uncached_metadata, job_report=None):
+        """
+        Combine the cached and newly calculated metrics into a single data 
+        frame, save the new metrics to disk, and return the data frame along 
+        with the metadata for each metric.
+        """
+        uncached_metadata = dict(uncached_metadata)
+        uncached_metadata.update(self.sidecar_metadata)
+
+        uncached_records, uncached_coords = self._add_manifest(
+                self.sidecar_records + list(uncached_records))
+        self.pending_records = []
+        self.pending_metadata = {}
+
+        all_records = concat_records([self.cached_records, uncached_records])
+
+        metadata = self.metadata.copy()
+        metadata.update(uncached_metadata)
+
+        # Make sure all the expected metrics were calculated.
+
+        expected_metrics = [
+                'total_score',
+                'restraint_dist',
+                'sequence',
+        ]
+        if self.columns is not None:
+            expected_metrics = match_columns(expected_metrics, self.columns)
+
+        for metric in expected_metrics:
+            if metric not in all_records:
+                print all_records.keys()
+                raise IOError("'{}' wasn't calculated for the models in '{}'".format(metric, self.pdb_dir))
+
+        # If everything else looks good, cache the new records so we can load 
+        # faster next time.  Records from a legacy cache are written too, so 
+        # that cache won't be needed anymore.  Records that were already 
+        # written by a checkpoint aren't written again.
+
+        unwritten_records = uncached_records
+        if len(uncached_records):
+            unwritten_records = uncached_records[
+                    ~uncached_records['path'].isin(self.checkpointed_paths)]
+
+        if self.is_legacy:
+            new_records = all_records
+        else:
+            new_records = concat_records([
+                    self.cached_records[self.rescored], unwritten_records])
+
+        if len(new_records):
+            self._write_cache(new_records, uncached_metadata)
+
+        if self.store_coords:
+            self._store_coords(uncached_coords)
+
+        if self.needs_compaction:
+            self.compact_in_background()
+
+        # Report how many structures had to be cached, in case the caller is 
+        # interested, and return to loaded data frame.
+
+        if job_report is not None:
+            job_report['new_records'] = len(uncached_records)
+            job_report['old_records'] = len(self.cached_records)
+
+        # Don't return the columns that are only used by the cache (i.e. the 
+        # ones with names starting with an underscore) or metrics that no 
+        # longer apply to any structure (e.g. restraints that were removed).
+
+        public_columns = [
+                x for x in all_records.columns
+                if not x.startswith('_') and not (
+                    x.startswith('restraint_') and all_records[x].isnull().all())
+        ]
+        metadata = {
+                k: v for k, v in metadata.items()
+                if k in public_columns
+        }
+
+        summary = self._update_summary(all_records[public_columns])
+        for name, meta in metadata.items():
+            meta.summary = summary.get(name)
+
+        # Keep the workspace-wide index of every model's metrics up to date 
+        # (see open_metrics_index()), but don't fail if it can't be written.  
+        # If only some columns were read, only the new records are complete 
+        # enough to be indexed.
+
+        changed_paths = list(new_records.get('path', [])) + \
+                sorted(self.checkpointed_paths)
+
+        # The restraints hash is indexed too, so refresh_metrics_index() can 
+        # tell when the restraint metrics are out of date.
+        index_records = all_records.reindex(
+                columns=public_columns + MANIFEST_COLUMNS + ['_restraints_hash'])
+        index_records['_restraints_hash'] = \
+                index_records['_restraints_hash'].astype(object)
+
+        self._update_index(
+                index_records, metadata, changed_paths,
+                partial=self.columns is not None)
+
+        if self.columns is not None:
+            selected = set(match_columns(public_columns, self.columns))
+            public_columns = [
+                    x for x in public_columns
+                    if x == 'path' or x in selected]
+            metadata = {
+                    k: v for k, v in metadata.items()
+                    if k in selected
+            }
+
+        return all_records[public_columns], metadata
+
+    def _update_summary(self, records):
+        """
+        Make sure the summary statistics include every metric in the given 
+        records, and return the statistics for each metric.  If only some 
+        columns were loaded, the statistics for the other columns are kept as 
+        long as they're still up to date.
+        """
+        fingerprint = manifest_fingerprint(self.manifest)
+        summary = _read_summary_file(metrics_summary_path(self.pdb_dir))
+
+        if summary is None or \
+                summary['fingerprint'] != fingerprint or \
+                summary['restraints_hash'] != self.restraints_hash or \
+                summary['num_models'] != len(records):
+            summary = {
+                    'version': CACHE_VERSION,
+                    'fingerprint': fingerprint,
+                    'restraints_hash': self.restraints_hash,
+                    'num_models': len(records),
+                    'percentiles': SUMMARY_PERCENTILES,
+                    'columns': {},
+            }
+
+        unsummarized = [x for x in records if x not in summary['columns']]
+        new_stats = summarize_metrics(records[unsummarized])
+
+        # Don't bother rewriting the file if the only new columns are ones 
+        # that can't be summarized (e.g. sequences).
+
+        if new_stats or not summary['columns']:
+            summary['columns'].update(new_stats)
+            try:
+                write_metrics_summary(self.pdb_dir, summary)
+            except EnvironmentError as error:
+                print "Couldn't update the summary statistics for '{}': {}".format(
+                        self.pdb_dir, error)
+
+        return summary['columns']
+
+    def checkpoint(self, records, metadata):
+        """
+        Save the given newly calculated records and metadata once enough of 
+        them have accumulated (see checkpoint_size and checkpoint_interval).  
+        This is meant to be called as the structures are read, so that a long 
+        cache build doesn't lose its progress if it's interrupted.  The same 
+        records must still be passed to update() once every structure has been 
+        read, but they won't be written again.
+        """
+        self.pending_records += list(records)
+        self.pending_metadata.update(metadata)
+
+        elapsed = time.time() - self.checkpoint_time
+        if len(self.pending_records) >= self.checkpoint_size or \
+                elapsed >= self.checkpoint_interval:
+            self.flush_checkpoint()
+
+    def flush_checkpoint(self):
+        """
+        Write any records that were passed to checkpoint() but haven't been 
+        written yet to the cache.
+        """
+        records, coords = self._add_manifest(self.pending_records)
+        metadata = self.pending_metadata
+
+        self.pending_records = []
+        self.pending_metadata = {}
+        self.checkpoint_time = time.time()
+
+        if not len(records):
+            return
+
+        # Convert a legacy cache along with the first checkpoint, because the 
+        # legacy cache is ignored once there are any shards.
+
+        if self.is_legacy:
+            self._write_cache(concat_records([self.cached_records, records]), metadata)
+            self.is_legacy = False
+        else:
+            self._write_cache(records, metadata)
+
+        if self.store_coords:
+            self._append_coords(*self._new_coords(coords))
+
+        self.checkpointed_paths.update(records['path'])
+
+    def _add_manifest(self, records):
+        """
+        Return a data frame of the given newly calculated records, with the 
+        manifest columns added and sorted by path, along with a dictionary of 
+        the coordinates (if any) that were included in the records.
+        """
+        records = pd.DataFrame(records)
+        coords = {}
+        if '_coords' in records:
+            coords = dict(zip(records['path'], records.pop('_coords')))
+        if len(records):
+            records = records.merge(self.manifest, on='path')
+            records = records.sort_values('path')
+            records = records.reset_index(drop=True)
+        return records, coords
+
+    def _update_index(self, records, metadata, changed_paths, partial=False):
+        import sqlite3
+
+        try:
+            update_metrics_index(
+                    self.workspace, self.pdb_dir, records, metadata,
+                    changed_paths, partial)
+        except (sqlite3.Error, EnvironmentError) as error:
+            print "Couldn't update the metrics index for '{}': {}".format(
+                    self.pdb_dir, error)
+
+    def _write_cache(self, new_records, new_metadata):
+        """
+        Add the given records to the cache.  The metadata file is updated 
+        first, so that no reader ever sees records without metadata.  Other 
+        processes may have added metrics to that file since we read it, so it 
+        is re-read and merged while we hold the lock.
+        """
+        with lock_metrics_cache(self.cache_dir):
+            metadata = {}
+            if os.path.exists(self.metadata_path):
+                try:
+                    metadata = read_metadata(self.metadata_path)
+                except (EnvironmentError, ValueError, KeyError, yaml.YAMLError):
+                    pass
+
+            metadata.update(self.metadata)
+            metadata.update(new_metadata)
+            write_metadata(self.metadata_path, metadata)
+            self._save_restraints()
+
+            old_shards = list_metrics_shards(self.cache_dir)
+            append_metrics_shard(self.cache_dir, new_records)
+            self.num_shards += 1
+
+            # If the cache wasn't used, the shards that were there before this 
+            # object first wrote to the cache are no longer needed.
+
+            if not self.use_cache and self.cache_dir not in self.cleared_dirs:
+                import shutil
+                for shard in old_shards:
+                    shutil.rmtree(os.path.join(self.cache_dir, shard))
+                self.num_shards = 1
+                self.cleared_dirs.add(self.cache_dir)
+
+    def _store_coords(self, uncached_coords):
+        """
+        Add the coordinates of every structure that isn't already in the 
+        coordinate store to it.  Newly read structures come with their 
+        coordinates (given as a dictionary mapping paths to arrays).  The 
+        remaining structures (i.e. ones that were cached before the 
+        coordinates were asked for, or whose metrics came from sidecars) are 
+        read here.
+        """
+        paths, xyzs = self._new_coords(uncached_coords)
+
+        stored_paths = self.stored_coord_paths | set(paths)
+        unstored_paths = [
+                os.path.join(self.pdb_dir, x) for x in self.manifest['path']
+                if x not in stored_paths]
+
+        if unstored_paths:
+            read_paths, read_xyzs = read_coords_from_pdbs(
+                    unstored_paths, self.coord_atoms)
+            paths += [os.path.basename(x) for x in read_paths]
+            xyzs += list(read_xyzs)
+
+        self._append_coords(paths, xyzs)
+
+    def _new_coords(self, coords):
+        """
+        Return the paths and coordinates from the given dictionary that aren't 
+        in the coordinate store yet.
+        """
+        paths, xyzs = [], []
+
+        for path, xyz in sorted(coords.items()):
+            if isinstance(xyz, np.ndarray) and path not in self.stored_coord_paths:
+                paths.append(path)
+                xyzs.append(xyz)
+
+        return paths, xyzs
+
+    def _append_coords(self, paths, xyzs):
+        if not paths:
+            return
+
+        records = self.manifest.set_index('path').loc[paths].reset_index()
+        xyzs = np.array(xyzs).reshape(len(paths), len(self.coord_atoms), 3)
+
+        with lock_metrics_cache(self.cache_dir):
+            old_shards = list_metrics_shards(self.coords_dir)
+            append_coords_shard(
+                    self.coords_dir, records, self.coord_atoms, xyzs)
+
+            # If the cache wasn't used, every structure is being stored 
+            # again, so the shards that were there before this object first 
+            # wrote to the store are no longer needed.
+
+            if not self.use_cache and self.coords_dir not in self.cleared_dirs:
+                import shutil
+                for shard in old_shards:
+                    shutil.rmtree(os.path.join(self.coords_dir, shard))
+                self.cleared_dirs.add(self.coords_dir)
+
+        self.stored_coord_paths.update(paths)
+
+    @property
+    def needs_compaction(self):
+        num_records = len(self.cached_records) + self.num_stale
+        return self.num_shards > self.max_shards or \
+                self.num_stale > self.max_stale_fraction * num_records
+
+    def compact_in_background(self):
+        """
+        Start compacting the cache in a separate thread, and return that 
+        thread.  The thread is not a daemon, so the program won't exit until 
+        the compaction is finished.
+        """
+        import threading
+        thread = threading.Thread(
+                target=compact_metrics_cache, args=(self.pdb_dir,))
+        thread.start()
+        return thread
+
+
+class LazyMetrics(object):
+    """
+    A read-only, data-frame-like view of the metrics for the structures in a 
+    directory, which only reads each column from the cache the first time it's 
+    used.  Create these objects with load_lazy(), which makes sure the cache 
+    is up to date.
+
+    Indexing with a column name returns a series, and indexing with a list of 
+    column names returns a data frame, in both cases with the same rows and 
+    index that load() would return.  Several columns can be read in a single 
+    pass over the cache with load(), and query() reads only the columns that 
+    the query refers to.
+    """
+
+    def __init__(self, pdb_dir, paths):
+        self.pdb_dir = pdb_dir
+        self.cache_dir = os.path.join(pdb_dir, 'metrics_cache')
+        self.metadata_path = os.path.join(pdb_dir, 'metrics.yml')
+        self.paths = pd.Series(list(paths), name='path')
+        self.index = self.paths.index
+        self._series = {'path': self.paths}
+        self._columns = None
+        self._metadata = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def __getitem__(self, key):
+        if isinstance(key, (list, tuple)):
+            return self.load(key)
+        if key not in self.columns:
+            raise KeyError(key)
+        return self.load([key])[key]
+
+    @property
+    def columns(self):
+        """
+        The names of all the metrics in the cache, without reading any of them.
+        """
+        if self._columns is None:
+            names = set()
+            for shard in list_metrics_shards(self.cache_dir):
+                schema = read_metrics_schema(os.path.join(self.cache_dir, shard))
+                names.update(x['name'] for x in schema['columns'])
+            self._columns = sorted(x for x in names if not x.startswith('_'))
+        return self._columns
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            metadata = read_metadata(self.metadata_path)
+            self._metadata = {
+                    k: v for k, v in metadata.items()
+                    if k in self.columns
+            }
+        return self._metadata
+
+    def load(self, columns):
+        """
+        Return a data frame with the given columns (which can be wildcards, 
+        see match_columns()) plus the 'path' column, reading any columns that 
+        haven't been read yet from the cache.
+        """
+        columns = ['path'] + [
+                x for x in match_columns(self.columns, columns) if x != 'path']
+        unread = [x for x in columns if x not in self._series]
+
+        if unread:
+            # The most recent record for each path is always the current one, 
+            # because load_lazy() already cached every structure that changed.
+            records, num_rows = read_metrics_shards(self.cache_dir, unread)
+            records = records.set_index('path').reindex(self.paths.values)
+            for column in unread:
+                self._series[column] = pd.Series(
+                        records[column].values, index=self.index, name=column)
+
+        return pd.DataFrame(collections.OrderedDict(
+            (x, self._series[x]) for x in columns))
+
+    def query(self, expr):
+        """
+        Return the rows matching the given query (see DataFrame.query()), 
+        along with the columns it refers to.  Only those columns are read.
+        """
+        names = set(re.findall(r'[A-Za-z_]\w*', expr))
+        return self.load([x for x in self.columns if x in names]).query(expr)
+
+
+class RosettaPdbParser(object):
+    """
+    Extract score metrics, the sequence, and atom coordinates from the PDB 
+    files generated by rosetta.
+
+    These files have three sections: the coordinates (i.e. ATOM and HETATM 
+    records), the pose energies table, and a trailer with the values reported 
+    by filters and other movers.  The parser keeps track of which section it's 
+    in, and looks up a handler for each line using the first three characters 
+    of that line, so most lines cost a single dictionary lookup rather than a 
+    long chain of string comparisons.  Lines are only decoded from UTF-8 when 
+    they contain metric names, since that's the only place non-ASCII 
+    characters can appear.
+
+    The same parser can be used for any number of files.  The restrained 
+    residues need to be specified up front, because Dunbrack scores are only 
+    extracted from the energies table for those residues.
+    """
+
+    # It's kinda hard to tell which lines are part of the score table.  The 
+    # first column has some pretty heterogeneous strings (examples below) and 
+    # all the other columns are just numbers.  My strategy here is to try to 
+    # make a regular expression that matches all of these examples, with the 
+    # exception of the ligand.  I think the ligand will simply be too 
+    # heterogeneous to match, and the purpose of this is to get dunbrack 
+    # scores, which the ligand doesn't have.
+    #
+    #   MET:NtermProteinFull_1
+    #   ASN_2
+    #   LYS:protein_cutpoint_lower_39
+    #   ASP:protein_cutpoint_upper_40
+    #   ALA:CtermProteinFull_124
+    #   HIS_D_224
+    #   pdb_EQU_250
+
+    score_table_pattern = re.compile(
+            r'^[A-Z]{3}(?:_[A-Z])?'  # Residue name with optional tautomer.
+            r'(?::[A-Za-z_]+)?'      # Optional patch type.
+            r'_([0-9]+) '            # Residue number preceded by underscore.
+    )                                # The terminal space is important to match
+                                     # the full residue number.
+
+    def __init__(self, restrained_residue_ids=(), atoms=()):
+        self.restrained_residue_ids = set(restrained_residue_ids)
+        self.atoms = list(atoms)
+        self.atom_residue_ids = np.array(sorted(set(x[1] for x in self.atoms)))
+        self.registry = ScoreMetadataRegistry()
+
+    def parse(self, lines):
+        """
+        Parse the given lines (undecoded, as read from a PDB file) and return 
+        a record and a dictionary of metadata for the metrics found in them.  
+        The sequence map and the Dunbrack scores are available as attributes 
+        afterwards.  The metadata objects are shared between structures (see 
+        ScoreMetadataRegistry), so they shouldn't be modified.
+
+        Coordinates are only extracted for the atoms (i.e. (atom name, residue 
+        id) tuples) given to the constructor, typically the restrained atoms.  
+        These are available afterwards as an array with one row for each of 
+        those atoms (xyzs) and as a dictionary mapping each atom to its row 
+        (atom_xyzs).  Both are created anew for each structure, and any atoms 
+        that weren't found in the structure are NaN.
+        """
+        self.record = {}
+        self.metadata = {}
+        self.sequence_map = {}
+        self.xyzs = np.full((len(self.atoms), 3), np.nan)
+        self.atom_xyzs = dict(zip(self.atoms, self.xyzs))
+        self.atom_lines = []
+        self.dunbrack_index = None
+        self.dunbrack_scores = {}
+        self.fragment_size = 0
+        self.section = 'header'
+
+        handlers = self.handlers
+        parse_score_table_row = self._parse_score_table_row
+
+        for line in lines:
+            handler = handlers.get(line[:3])
+            if handler is not None:
+                handler(self, line)
+            elif self.section == 'score_table':
+                parse_score_table_row(line)
+
+        self._parse_coordinates()
+        return self.record, self.metadata
+
+    def _add_metric(self, meta, value):
+        self.record[meta.name] = value
+        self.metadata[meta.name] = meta
+
+    def _parse_atom(self, line):
+        # The coordinates are decoded all at once by _parse_coordinates(), 
+        # once we've seen every line.
+        if line.startswith((b'ATOM', b'HETATM')):
+            self.atom_lines.append(line)
+            self.section = 'coordinates'
+
+    def _parse_coordinates(self):
+        from klab.bio.basics import residue_type_3to1_map
+
+        self.record['sequence'] = ''
+
+        if not self.atom_lines:
+            return
+
+        # Only decode the fields that are actually needed, and only for the 
+        # atoms that they're needed for.  Every atom has a residue number, but 
+        # only the first atom in each residue has a relevant residue name, and 
+        # only the atoms in residues we want coordinates for have relevant 
+        # atom names.
+
+        chars = _atom_record_chars(self.atom_lines)
+        res_seq = _decode_numbers(chars[:,22:26]).astype(int)
+
+        # Keep track of this model's sequence.  A new residue starts whenever 
+        # the residue number changes.  HETATM residues are part of the sequence 
+        # map (as 'X'), but not the sequence.
+
+        is_first_atom = np.ones(len(res_seq), dtype=bool)
+        is_first_atom[1:] = res_seq[1:] != res_seq[:-1]
+
+        first_chars = chars[is_first_atom]
+        is_hetatm = first_chars[:,0] == ord(b'H')
+        res_names = _decode_strings(first_chars[:,17:20])
+
+        names, name_indices = np.unique(res_names, return_inverse=True)
+        codes = np.array([
+                residue_type_3to1_map.get(x, 'X') for x in names.tolist()],
+                dtype=object)[name_indices]
+        codes[is_hetatm] = 'X'
+
+        self.record['sequence'] = ''.join(codes[~is_hetatm])
+        self.sequence_map = dict(zip(res_seq[is_first_atom].tolist(), codes))
+
+        # Save the coordinates for the requested atoms.  These will be used 
+        # later to calculate restraint distances.  If an atom appears more than 
+        # once, the last one is used.
+
+        if not self.atoms:
+            return
+
+        candidates = np.flatnonzero(np.in1d(res_seq, self.atom_residue_ids))
+        candidate_res_seq = res_seq[candidates]
+        candidate_names = _decode_strings(chars[candidates,12:16]).astype(object)
+
+        rows, slots = [], []
+        for i, (atom_name, residue_id) in enumerate(self.atoms):
+            matches = candidates[
+                    (candidate_res_seq == residue_id) &
+                    (candidate_names == atom_name)]
+            if len(matches):
+                rows.append(matches[-1])
+                slots.append(i)
+
+        if rows:
+            xyzs = _decode_numbers(chars[rows,30:54].reshape(-1, 8))
+            self.xyzs[slots] = xyzs.reshape(-1, 3)
+
+    def _parse_comment(self, line):
+        if line.startswith(b'#BEGIN_POSE_ENERGIES_TABLE'):
+            self.section = 'score_table'
+        elif line.startswith(b'#END_POSE_ENERGIES_TABLE'):
+            self.section = 'trailer'
+
+    def _parse_label(self, line):
+        if line.startswith(b'label'):
+            fields = line.split()
+            self.dunbrack_index = fields.index(b'fa_dun')
+            self.section = 'score_table'
+
+    def _parse_pose(self, line):
+        if line.startswith(b'pose'):
+            meta = self.registry.get('total_score', lambda: ScoreMetadata(
+                    name='total_score',
+                    title='Total Score',
+                    unit='REU',
+                    order=1,
+            ))
+            self._add_metric(meta, float(line.split()[-1]))
+
+    def _parse_score_table_row(self, line):
+        if self.dunbrack_index is None:
+            return
+
+        # Only use the regular expression once we know the row is for one of 
+        # the restrained residues, because most rows aren't.
+
+        name = line[:line.find(b' ')]
+        residue_id = name[name.rfind(b'_') + 1:]
+
+        if not residue_id.isdigit():
+            return
+        if int(residue_id) not in self.restrained_residue_ids:
+            return
+        if not self.score_table_pattern.match(line):
+            return
+
+        dunbrack_score = float(line.split()[self.dunbrack_index])
+        self.dunbrack_scores[int(residue_id)] = dunbrack_score
+
+    def _parse_rmsd(self, line):
+        if line.startswith(b'rmsd'):
+            meta = self.registry.get('loop_rmsd', lambda: ScoreMetadata(
+                    name='loop_rmsd',
+                    title='Loop RMSD (Backbone Heavy-Atom)',
+                    unit='Å',
+                    guide=1.0, lower=0.0, upper='95%', order=4,
+            ))
+            self._add_metric(meta, float(line.split()[1]))
+
+    def _parse_unsats(self, line):
+        if line.startswith(b'  all_heavy_atom_unsats'):
+            meta = self.registry.get('buried_unsats', lambda: ScoreMetadata(
+                    name='buried_unsats',
+                    title='Buried Unsatsified H-Bonds',
+                    order=5,
+            ))
+        elif line.startswith(b'  sc_heavy_atom_unsats'):
+            meta = self.registry.get('buried_unsats_sidechain', lambda: ScoreMetadata(
+                    name='buried_unsats_sidechain',
+                    title='Buried Unsatisfied H-Bonds (Sidechain)',
+                    order=5,
+            ))
+        elif line.startswith(b'  bb_heavy_atom_unsats'):
+            meta = self.registry.get('buried_unsats_backbone', lambda: ScoreMetadata(
+                    name='buried_unsats_backbone',
+                    title='Buried Unsatisfied H-Bonds (Backbone)',
+                    order=5,
+            ))
+        else:
+            return
+
+        self._add_metric(meta, float(line.split()[2]))
+
+    def _parse_time(self, line):
+        if line.startswith(b'time'):
+            meta = self.registry.get('simulation_time', lambda: ScoreMetadata(
+                    name='simulation_time',
+                    title='Simulation Time',
+                    unit='sec',
+                    order=5,
+            ))
+            self._add_metric(meta, float(line.split()[1]))
+
+    def _parse_fragment_filter(self, line):
+        if line.startswith(b'FragmentScoreFilter '):
+            self.fragment_size = line.split()[2].split(b'-')[0].decode('utf8')
+            return
+
+        if not line.startswith((b'FSF', b'FragmentScoreFilter_metric')):
+            return
+
+        splitline = line.decode('utf8').split()
+        fragment_size = self.fragment_size
+
+        if splitline[1] == 'Max':
+            if splitline[3] == 'res:':
+                meta = self.registry.get(
+                        ('max_fragment_crmsd_position', fragment_size), lambda: ScoreMetadata(
+                        name='max_fragment_crmsd_position',
+                        title = 'Max {}-Residue Fragment RMSD \
+(C-Alpha) Position'.format(fragment_size),
+                        order=7))
+            elif splitline[3] == 'score:':
+                meta = self.registry.get(
+                        ('max_fragment_crmsd_score', fragment_size), lambda: ScoreMetadata(
+                        name='max_fragment_crmsd_score',
+                        title = 'Max {}-Residue Fragment RMSD \
+(C-Alpha)'.format(fragment_size),
+                        order=7))
+            else:
+                return
+
+        elif splitline[1] == 'Min':
+            if splitline[3] == 'res:':
+                meta = self.registry.get(
+                        ('min_fragment_crmsd_position', fragment_size), lambda: ScoreMetadata(
+                        name='min_fragment_crmsd_position',
+                        title = 'Min {}-Residue Fragment RMSD \
+(C-Alpha) Position'.format(fragment_size),
+                        order=8))
+            elif splitline[3] == 'score:':
+                meta = self.registry.get(
+                        ('min_fragment_crmsd_score', fragment_size), lambda: ScoreMetadata(
+                        name='min_fragment_crmsd_score',
+                        title = 'Min {}-Residue Fragment RMSD \
+(C-Alpha)'.format(fragment_size),
+                        order=8))
+            else:
+                return
+
+        elif splitline[1] == 'Avg':
+            meta = self.registry.get(
+                    ('avg_fragment_crmsd', fragment_size), lambda: ScoreMetadata(
+                    name='avg_fragment_crmsd',
+                    title='Avg {}-Residue Fragment RMSD \
+(C-Alpha)'.format(fragment_size),
+                    order=9))
+        else:
+            position = splitline[2]
+            meta = self.registry.get(
+                    ('fragment_crmsd_pos', position, fragment_size), lambda: ScoreMetadata(
+                    name='fragment_crmsd_pos_{}'.format(position),
+                    title='{}-Residue Fragment RMSD at Res {} \
+(C-Alpha)'.format(fragment_size,position),
+                    order=6))
+
+        self._add_metric(meta, float(splitline[4]))
+
+    def _parse_extra_metric(self, line):
+        if line.startswith(b'EXTRA_SCORE'):
+            tokens = line[len(b'EXTRA_SCORE_'):].decode('utf8').rsplit(None, 1)
+
+        elif line.startswith(b'EXTRA_METRIC'):
+            tokens = line[len(b'EXTRA_METRIC '):].decode('utf8').rsplit(None, 1)
+
+            # Ignore the BuriedUnsat filter.  It just reports 911 every time, 
+            # and we extract the actual buried unsat information from some 
+            # other lines it adds to the PDB.
+            if tokens[0] == 'IGNORE':
+                return
+            if tokens[0] == 'Buried Unsatisfied H-Bonds [-|#]':
+                return
+
+        else:
+            return
+
+        meta = self.registry.extra_metric(tokens[0], 5)
+        self._add_metric(meta, float(tokens[1]))
+
+    handlers = {
+            b'ATO': _parse_atom,
+            b'HET': _parse_atom,
+            b'#BE': _parse_comment,
+            b'#EN': _parse_comment,
+            b'lab': _parse_label,
+            b'pos': _parse_pose,
+            b'rms': _parse_rmsd,
+            b'  a': _parse_unsats,
+            b'  s': _parse_unsats,
+            b'  b': _parse_unsats,
+            b'tim': _parse_time,
+            b'Fra': _parse_fragment_filter,
+            b'FSF': _parse_fragment_filter,
+            b'EXT': _parse_extra_metric,
+    }
+
+
 class ScoreMetadata(object):
 
     def __init__(self, title, dir='-', unit=None, guide=None, lower=None, upper=None, order=None, fmt=None, name=None):
@@ -990,25 +4140,9 @@ class ScoreMetadata(object):
         self.upper = upper
         self.format = fmt
 
-        def cutoff(limit, x, default):
-            if limit is None:
-                return default
-
-            if isinstance(limit, (str, unicode)):
-                if limit.endswith('%'):
-                    value = float(limit[:-1])
-                    return np.percentile(x, value)
-                else:
-                    return float(value)
-
-            else:
-                return limit
-
-
-        self.limits = lambda x: (
-                cutoff(lower, x, min(x)),
-                cutoff(upper, x, max(x)),
-        )
+        # The summary statistics for this metric (see summarize_metrics()), if 
+        # they were loaded along with the metrics.
+        self.summary = None
 
     def __repr__(self):
         return '<ScoreMetadata name="{0}">'.format(self.name)
@@ -1034,6 +4168,75 @@ class ScoreMetadata(object):
 
         return d
 
+    def limits(self, x):
+        # This is a method rather than a lambda defined in the constructor so 
+        # that metadata objects can be pickled and sent between processes.
+
+        # If x is the whole column that the summary statistics were calculated 
+        # from, the statistics can be used instead of looking at every value.
+        summary = getattr(self, 'summary', None)
+        if summary is not None and len(x) != summary['count']:
+            summary = None
+
+        def percentile(value):
+            if summary is not None and value in SUMMARY_PERCENTILES:
+                return summary['percentiles'][SUMMARY_PERCENTILES.index(value)]
+            return np.percentile(x, value)
+
+        def cutoff(limit, default):
+            if limit is None:
+                return default()
+
+            if isinstance(limit, (str, unicode)):
+                if limit.endswith('%'):
+                    return percentile(float(limit[:-1]))
+                else:
+                    return float(limit)
+
+            else:
+                return limit
+
+        return (
+                cutoff(self.lower, lambda: summary['min'] if summary else min(x)),
+                cutoff(self.upper, lambda: summary['max'] if summary else max(x)),
+        )
+
+
+class ScoreMetadataRegistry(object):
+    """
+    Keep a single ScoreMetadata object for each distinct metric, so that 
+    parsing a structure doesn't create new metadata (and parse the titles of 
+    extra metrics again) for every metric it reports.
+
+    Each metadata object is identified by a key that includes everything it 
+    depends on (e.g. the name of the metric, plus the fragment size for the 
+    fragment metrics), and is only created (by calling the given factory) the 
+    first time its key is looked up.  The metadata for every metric looked up 
+    so far are available by name in the metadata attribute, which is what 
+    read_and_calculate() returns to be saved in metrics.yml.
+    """
+
+    def __init__(self):
+        self.metadata = {}
+        self._metadata_by_key = {}
+
+    def get(self, key, factory):
+        try:
+            return self._metadata_by_key[key]
+        except KeyError:
+            meta = self._metadata_by_key[key] = factory()
+            self.metadata[meta.name] = meta
+            return meta
+
+    def extra_metric(self, desc, default_order=None):
+        """
+        Return the metadata for an extra metric with the given description 
+        (see parse_extra_metric()).
+        """
+        return self.get(
+                ('extra_metric', desc, default_order),
+                lambda: parse_extra_metric(desc, default_order))
+
 
 class CoordinateRestraint(object):
 
@@ -1049,6 +4252,12 @@ class CoordinateRestraint(object):
     def distance_from_ideal(self, atom_xyzs):
         return euclidean(self.coord, atom_xyzs[self.atom])
 
+    @staticmethod
+    def evaluate_batch(restraints, atom_indices, xyzs):
+        atoms = [atom_indices[x.atom] for x in restraints]
+        coords = np.array([x.coord for x in restraints])
+        return _norms(xyzs[:,atoms] - coords)
+
 
 class AtomPairRestraint(object):
 
@@ -1063,6 +4272,12 @@ class AtomPairRestraint(object):
         coords = [atom_xyzs[x] for x in self.atom_pair]
         return euclidean(*coords) - self.ideal_distance
 
+    @staticmethod
+    def evaluate_batch(restraints, atom_indices, xyzs):
+        coords = _gather_coords(restraints, 'atom_pair', atom_indices, xyzs)
+        ideal_distances = np.array([x.ideal_distance for x in restraints])
+        return _norms(coords[0] - coords[1]) - ideal_distances
+
 
 class DihedralRestraint(object):
 
@@ -1083,6 +4298,13 @@ class DihedralRestraint(object):
                     self.ideal_dihedral)]
         return min(dihedrals) 
 
+    @staticmethod
+    def evaluate_batch(restraints, atom_indices, xyzs):
+        coords = _gather_coords(restraints, 'atoms', atom_indices, xyzs)
+        measured = dihedrals(*coords) * (360 / (2 * np.pi))
+        ideal = np.array([x.ideal_dihedral for x in restraints])
+        return _principal_angle_deviations(measured, ideal)
+
 
 class AngleRestraint(object):
 
@@ -1102,6 +4324,13 @@ class AngleRestraint(object):
                 self.ideal_angle), abs(measured_angle - (360) - self.ideal_angle)]
         return min(angles)
 
+    @staticmethod
+    def evaluate_batch(restraints, atom_indices, xyzs):
+        coords = _gather_coords(restraints, 'atoms', atom_indices, xyzs)
+        measured = angles(*coords) * (360 / (2 * np.pi))
+        ideal = np.array([x.ideal_angle for x in restraints])
+        return _principal_angle_deviations(measured, ideal)
+
 
 class Design (object):
     """
@@ -1109,14 +4338,32 @@ class Design (object):
     scores, 500 restraint distances, and a "representative" (i.e. lowest
     scoring) model.  The representative has its own score and restraint
     distance, plus a path to a PDB structure.
+
+    By default every metric is loaded, but the columns argument can be used to 
+    load only some of them (e.g. essential_columns), see load().  The 
+    'total_score' and 'sequence' metrics are always loaded, because they're 
+    needed to pick the representative model and to build the sequence matrix.
     """
 
-    def __init__(self, directory):
+    # The metrics that are loaded when only the essentials are asked for.
+    essential_columns = [
+            'total_score',
+            'restraint_dist',
+            'loop_rmsd',
+            'sequence',
+    ]
+
+    def __init__(self, directory, compact=False, columns=None):
         self.directory = directory
-        self.structures, self.metadata = load(directory)
+        if columns is not None:
+            columns = ['total_score', 'sequence'] + list(columns)
+        self.structures, self.metadata = load(
+                directory, compact=compact, columns=columns)
         self.loops = pipeline.load_loops(directory)
         self.resfile = pipeline.load_resfile(directory)
         self.representative = self.rep = self.scores.idxmin()
+        self.sequences = sequence_matrix(self['sequence'])
+        self.designable = designable_mask(self.resfile, self.sequences.shape[1])
 
     def __getitem__(self, key):
         return self.structures[key]
@@ -1129,10 +4376,17 @@ class Design (object):
     def distances(self):
         return self['restraint_dist']
 
+    @property
+    def designable_sequences(self):
+        return self.sequences[:, self.designable]
+
+    @property
+    def resfile_sequence_codes(self):
+        return self.sequences[self.structures.index.get_loc(self.rep), self.designable]
+
     @property
     def resfile_sequence(self):
-        resis = sorted(int(i) for i in self.resfile.designable)
-        return ''.join(self['sequence'][self.rep][i-1] for i in resis)
+        return self.resfile_sequence_codes.tostring().decode('ascii')
 
     @property
     def rep_path(self):
@@ -91,6 +91,7 @@ setup(
             define_command('fetch_data'),
             define_command('web_logo', '[analysis]'),
             define_command('push_data'),
+            define_command('rescore_models', '[analysis]'),
             define_command('plot_funnels', '[analysis]'),
         ],
     },
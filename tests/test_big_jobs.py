@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 from pull_into_place import RestrainedModels, big_jobs
 
 def test_finalize_protocol():
@@ -28,3 +29,66 @@ def test_finalize_protocol():
 
 
 
+
+def test_write_metrics_sidecar_failure(tmpdir, monkeypatch, capsys):
+    from pull_into_place import structures
+
+    pdb_path = str(tmpdir.join('model.pdb.gz'))
+    open(pdb_path, 'w').close()
+
+    class Workspace:
+        def output_path(self, job_info):
+            return pdb_path
+
+    def broken_sidecar(workspace, pdb_path):
+        raise ValueError("can't parse model")
+
+    # A sidecar that can't be written shouldn't make the job fail.
+    monkeypatch.setattr(structures, 'write_metrics_sidecar', broken_sidecar)
+    big_jobs.write_metrics_sidecar(Workspace(), {})
+    assert "can't parse model" in capsys.readouterr()[0]
+
+def test_run_external_metrics(tmpdir, monkeypatch):
+    from pull_into_place import pdb_codecs
+
+    pdb_path = str(tmpdir.join('model.pdb.gz'))
+    pdb_codecs.write_bytes(pdb_path, b'ATOM\n')
+
+    class Workspace:
+        metric_scripts = ['metric.sh']
+        def output_path(self, job_info):
+            return pdb_path
+
+    def run_metric(command):
+        return stdout, ''
+
+    monkeypatch.setattr(big_jobs, 'tee', run_metric)
+
+    # Scripts that don't report any metrics shouldn't change the model.
+    stdout = 'No metrics here.\n'
+    with open(pdb_path, 'rb') as file:
+        data = file.read()
+
+    big_jobs.run_external_metrics(Workspace(), {})
+    with open(pdb_path, 'rb') as file:
+        assert file.read() == data
+
+    stdout = 'EXTRA_METRIC x 1.0\n'
+    big_jobs.run_external_metrics(Workspace(), {})
+    assert pdb_codecs.read_lines(pdb_path) == [b'ATOM\n', b'EXTRA_METRIC x 1.0\n']
+
+def test_rosetta_readable_copy(tmpdir):
+    from pull_into_place import pdb_codecs
+
+    gz_path = str(tmpdir.join('model.pdb.gz'))
+    pdb_codecs.write_bytes(gz_path, b'ATOM\n')
+    with big_jobs.rosetta_readable_copy(gz_path) as path:
+        assert path == gz_path
+
+    # Formats rosetta can't read are gzipped into a temporary file with the 
+    # same name.
+    bz2_path = pdb_codecs.recompress(gz_path, 'bz2')
+    with big_jobs.rosetta_readable_copy(bz2_path) as path:
+        assert os.path.basename(path) == 'model.pdb.gz'
+        assert pdb_codecs.read_lines(path) == [b'ATOM\n']
+    assert not os.path.exists(path)
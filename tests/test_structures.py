@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
+import os, shutil
 import numpy as np, pandas as pd
-from pull_into_place import structures
+from pull_into_place import structures, pdb_codecs
 from pprint import pprint
 
+def copy_workspace(tmpdir, name='test_load'):
+    root = os.path.join(str(tmpdir), name)
+    shutil.copytree(os.path.join('workspaces', name), root)
+    return root
+
 def test_find_pareto_front():
     # Create a grid of points for us to check the Pareto front on.  Include one 
     # column where smaller is better (x) and another where bigger is better 
@@ -42,6 +48,688 @@ def test_find_pareto_front():
     front = structures.find_pareto_front(df, meta, cols, depth=3, epsilon=60)
     assert set(front.index) == {2, 0, 8, 6}
 
+def test_load_in_parallel(tmpdir):
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+
+    serial, serial_meta = structures.load(outputs, use_cache=False)
+    parallel, parallel_meta = structures.load(outputs, use_cache=False, processes=2)
+
+    assert list(parallel['path']) == ['output_A.pdb.gz', 'output_B.pdb.gz']
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert sorted(serial_meta) == sorted(parallel_meta)
+
+def test_load_dirs(tmpdir):
+    root_1 = copy_workspace(tmpdir.mkdir('1'))
+    root_2 = copy_workspace(tmpdir.mkdir('2'))
+    outputs = [os.path.join(x, '01_build_models', 'outputs') for x in (root_1, root_2)]
+    os.remove(os.path.join(outputs[1], 'output_A.pdb.gz'))
+
+    results = structures.load_dirs(outputs, processes=2)
+
+    assert [list(df['path']) for df, meta in results] == [
+            ['output_A.pdb.gz', 'output_B.pdb.gz'],
+            ['output_B.pdb.gz'],
+    ]
+    assert structures.list_metrics_shards(
+            os.path.join(outputs[1], 'metrics_cache')) == ['shard_000000_000000']
+
+def test_load_changed_files(tmpdir, monkeypatch):
+    monkeypatch.setattr(structures.MetricsCache, 'max_stale_fraction', 1)
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    path_a = os.path.join(outputs, 'output_A.pdb.gz')
+    path_b = os.path.join(outputs, 'output_B.pdb.gz')
+
+    report = {}
+    df, meta = structures.load(outputs, job_report=report)
+    assert report == {'new_records': 2, 'old_records': 0}
+    assert '_file_size' not in df
+
+    # Replace one model with the other, and make sure the cache notices.
+    score_b = df.set_index('path').loc['output_B.pdb.gz', 'total_score']
+    shutil.copy(path_b, path_a)
+
+    df, meta = structures.load(outputs, job_report=report)
+    assert report == {'new_records': 1, 'old_records': 1}
+    assert list(df['total_score']) == [score_b, score_b]
+
+    # Delete a model, and make sure it's dropped from the cache.
+    os.remove(path_b)
+
+    df, meta = structures.load(outputs, job_report=report)
+    assert report == {'new_records': 0, 'old_records': 1}
+    assert list(df['path']) == ['output_A.pdb.gz']
+
+    # Make sure compacting the cache discards the stale records.
+    cache_dir = os.path.join(outputs, 'metrics_cache')
+    assert structures.list_metrics_shards(cache_dir) == \
+            ['shard_000000_000000', 'shard_000001_000001']
+
+    structures.compact_metrics_cache(outputs)
+
+    assert structures.list_metrics_shards(cache_dir) == ['shard_000000_000002']
+    records, num_rows = structures.read_metrics_shards(cache_dir)
+    assert num_rows == 1
+    assert list(records['path']) == ['output_A.pdb.gz']
+
+def test_load_checkpoints(tmpdir, monkeypatch):
+    monkeypatch.setattr(structures.MetricsCache, 'checkpoint_size', 1)
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    cache_dir = os.path.join(outputs, 'metrics_cache')
+
+    # Interrupt the load after the first structure has been read.
+    read_chunk = structures._read_and_calculate_chunk
+    chunks = []
+
+    def interrupted_read_chunk(chunk):
+        if chunks:
+            raise KeyboardInterrupt
+        chunks.append(chunk)
+        return read_chunk(chunk)
+
+    monkeypatch.setattr(
+            structures, '_read_and_calculate_chunk', interrupted_read_chunk)
+
+    try:
+        structures.load(outputs)
+    except KeyboardInterrupt:
+        pass
+    else:
+        assert False, "load wasn't interrupted"
+
+    records, num_rows = structures.read_metrics_shards(cache_dir)
+    assert list(records['path']) == ['output_A.pdb.gz']
+
+    # Only the structure that wasn't checkpointed should be read again.
+    monkeypatch.setattr(structures, '_read_and_calculate_chunk', read_chunk)
+
+    report = {}
+    df, meta = structures.load(outputs, job_report=report)
+    ref_df, ref_meta = structures.load(outputs, use_cache=False)
+    assert report == {'new_records': 1, 'old_records': 1}
+    pd.testing.assert_frame_equal(df, ref_df)
+    assert sorted(meta) == sorted(ref_meta)
+
+    # The use_cache=False load replaced the old shards with its own.
+    records, num_rows = structures.read_metrics_shards(cache_dir)
+    assert num_rows == 2
+
+def test_load_changed_restraints(tmpdir):
+    root = copy_workspace(tmpdir.mkdir('cached'))
+    ref_root = copy_workspace(tmpdir.mkdir('reference'))
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    ref_outputs = os.path.join(ref_root, '01_build_models', 'outputs')
+
+    def edit_restraints(old, new):
+        for workspace in (root, ref_root):
+            path = os.path.join(workspace, 'restraints')
+            with open(path) as file:
+                restraints = file.read()
+            with open(path, 'w') as file:
+                file.write(restraints.replace(old, new))
+
+    report = {}
+    structures.load(outputs)
+
+    # Move one of the restraints.  The restraint metrics should be updated 
+    # without reading any of the structures again.
+    edit_restraints('17.895 73.085 10.634', '16.895 72.085 11.634')
+
+    df, meta = structures.load(outputs, job_report=report)
+    ref_df, ref_meta = structures.load(ref_outputs, use_cache=False)
+    assert report == {'new_records': 0, 'old_records': 2}
+    pd.testing.assert_frame_equal(df, ref_df)
+    assert sorted(meta) == sorted(ref_meta)
+
+    # The updated metrics should be cached.
+    df, meta = structures.load(outputs, job_report=report)
+    assert report == {'new_records': 0, 'old_records': 2}
+    pd.testing.assert_frame_equal(df, ref_df)
+
+    # Restrain an atom whose coordinates weren't cached.  The structures have 
+    # to be read again.
+    edit_restraints('HARMONIC 0.0 0.707', 'HARMONIC 0.0 0.707\n'
+            'CoordinateConstraint CB  38 CA 1 20.090 72.256 10.794 HARMONIC 0.0 1.0')
+
+    df, meta = structures.load(outputs, job_report=report)
+    ref_df, ref_meta = structures.load(ref_outputs, use_cache=False)
+    assert report == {'new_records': 2, 'old_records': 0}
+    pd.testing.assert_frame_equal(df, ref_df)
+
+def test_load_sidecars(tmpdir):
+    import json
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    path_a = os.path.join(outputs, 'output_A.pdb.gz')
+    workspace = structures.pipeline.workspace_from_dir(outputs)
+
+    # Mark the metrics in the sidecar, so we can tell if they were used.
+    structures.write_metrics_sidecar(workspace, path_a)
+    sidecar_path = structures.metrics_sidecar_path(path_a)
+    with open(sidecar_path) as file:
+        sidecar = json.load(file)
+    sidecar['record']['total_score'] = 123
+    with open(sidecar_path, 'w') as file:
+        json.dump(sidecar, file)
+
+    report = {}
+    df, meta = structures.load(outputs, job_report=report)
+    assert report == {'new_records': 2, 'old_records': 0}
+    assert list(df['path']) == ['output_A.pdb.gz', 'output_B.pdb.gz']
+    assert df['total_score'][0] == 123
+    assert '_restraints_hash' not in df
+
+    # Sidecars are ignored if the structure changed after they were written.
+    os.utime(path_a, (0, 0))
+    df, meta = structures.load(outputs, job_report=report)
+    assert report == {'new_records': 1, 'old_records': 1}
+    assert df['total_score'][0] != 123
+
+def test_load_coords(tmpdir):
+    import gzip
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    loops = structures.pipeline.load_loops(outputs)
+    atoms = structures.loop_backbone_atoms(loops)
+
+    # Structures that were cached before the coordinates were asked for are 
+    # read again, but only once.
+    structures.load(outputs)
+    assert structures.load_coords(outputs, atoms)[0] == []
+    structures.load(outputs, store_coords=True)
+    paths, xyzs = structures.load_coords(outputs, atoms)
+    assert paths == ['output_A.pdb.gz', 'output_B.pdb.gz']
+
+    with gzip.open(os.path.join(outputs, paths[0])) as file:
+        expected = [
+                [float(x[30:38]), float(x[38:46]), float(x[46:54])]
+                for x in file if x.startswith(b'ATOM  ')
+                and x[12:16].strip() in (b'N', b'CA', b'C')
+                and loops[0][0] <= int(x[22:26]) <= loops[0][1]
+        ]
+    assert np.allclose(xyzs[0], expected, atol=1e-4)
+
+    # Structures that change are left out until they're cached again.
+    os.utime(os.path.join(outputs, paths[0]), (0, 0))
+    assert structures.load_coords(outputs, atoms)[0] == ['output_B.pdb.gz']
+    structures.load(outputs, store_coords=True)
+    structures.compact_metrics_cache(outputs)
+
+    coords_dir = os.path.join(outputs, 'metrics_cache', 'coords')
+    assert structures.list_metrics_shards(coords_dir) == ['shard_000000_000002']
+    paths, compact_xyzs = structures.load_coords(outputs, atoms)
+    assert np.array_equal(compact_xyzs, xyzs)
+
+def test_rescore_restraints(tmpdir):
+    root = copy_workspace(tmpdir.mkdir('cached'))
+    ref_root = copy_workspace(tmpdir.mkdir('reference'))
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    ref_outputs = os.path.join(ref_root, '01_build_models', 'outputs')
+
+    # Move one restraint and restrain a loop backbone atom, which is only 
+    # available from the coordinate store.
+    with open(os.path.join(ref_root, 'restraints')) as file:
+        restraints = file.read().replace('17.895 73.085 10.634', '16.895 72.085 11.634')
+    restraints += 'CoordinateConstraint CA  30 CA 1 20.0 70.0 10.0 HARMONIC 0.0 1.0\n'
+    with open(os.path.join(ref_root, 'restraints'), 'w') as file:
+        file.write(restraints)
+
+    df, meta = structures.load(outputs, store_coords=True)
+    ref_df, ref_meta = structures.load(ref_outputs, use_cache=False)
+
+    results = structures.rescore_restraints(
+            [outputs], [os.path.join(x, 'restraints') for x in (root, ref_root)])
+
+    for (records, metadata), expected in zip(results, [df, ref_df]):
+        columns = [x for x in expected if x.startswith('restraint_')]
+        assert list(records['directory']) == [outputs, outputs]
+        assert list(records['path']) == list(expected['path'])
+        assert sorted(metadata) == sorted(columns)
+        assert np.allclose(records[columns], expected[columns], atol=1e-4)
+
+def test_metrics_index(tmpdir, monkeypatch):
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    workspace = structures.pipeline.workspace_from_dir(outputs)
+
+    # Loading a directory adds its models to the index.
+    df, meta = structures.load(outputs)
+    records, metadata = structures.query_metrics_index(workspace)
+    assert list(records['directory']) == [outputs, outputs]
+    assert list(records['step']) == ['build_models', 'build_models']
+    assert sorted(metadata) == sorted(meta)
+    pd.testing.assert_frame_equal(
+            records[df.columns], df[df.columns], check_like=True)
+
+    records, metadata = structures.query_metrics_index(
+            workspace, [outputs], 'total_score < ?', [df['total_score'].max()])
+    assert list(records['path']) == [df['path'][df['total_score'].idxmin()]]
+
+    # Only directories that changed are loaded again.
+    loaded_dirs = []
+    load_dirs = structures.load_dirs
+    def spy_load_dirs(pdb_dirs, **kwargs):
+        loaded_dirs.extend(pdb_dirs)
+        return load_dirs(pdb_dirs, **kwargs)
+    monkeypatch.setattr(structures, 'load_dirs', spy_load_dirs)
+
+    structures.refresh_metrics_index(workspace, [outputs])
+    assert loaded_dirs == []
+
+    os.remove(os.path.join(outputs, 'output_B.pdb.gz'))
+    structures.refresh_metrics_index(workspace, [outputs])
+    assert loaded_dirs == [outputs]
+    old_dists = list(
+            structures.query_metrics_index(workspace)[0]['restraint_dist'])
+
+    records, metadata = structures.query_metrics_index(workspace)
+    assert list(records['path']) == ['output_A.pdb.gz']
+
+    # Directories are loaded again if the restraints change, and the index 
+    # picks up the rescored restraint metrics.
+    restraints_path = os.path.join(root, 'restraints')
+    with open(restraints_path) as file:
+        restraints = file.read()
+    with open(restraints_path, 'w') as file:
+        file.write(restraints.replace('17.895 73.085 10.634', '16.895 72.085 11.634'))
+
+    del loaded_dirs[:]
+    structures.refresh_metrics_index(workspace, [outputs])
+    assert loaded_dirs == [outputs]
+
+    df, meta = structures.load(outputs)
+    records, metadata = structures.query_metrics_index(workspace)
+    assert list(records['restraint_dist']) == list(df['restraint_dist'])
+    assert records['restraint_dist'][0] != old_dists[0]
+
+    structures.refresh_metrics_index(workspace, [outputs])
+    assert loaded_dirs == [outputs]
+
+    # The per-position metrics aren't stored as columns.
+    import sqlite3
+    db = sqlite3.connect(workspace.metrics_index_path)
+    columns = [x[1] for x in db.execute('PRAGMA table_info(models)')]
+    db.close()
+    assert 'total_score' in columns
+    assert not any(structures.metric_family(x) for x in columns)
+
+    # Each directory keeps its own metadata.
+    other_dir = os.path.join(root, '02_design_models', 'outputs')
+    other_meta = {
+            'total_score': structures.ScoreMetadata(
+                **dict(meta['total_score'].to_dict(), dir='+'))}
+    structures.update_metrics_index(
+            workspace, other_dir, df, other_meta, df['path'])
+
+    records, metadata = structures.query_metrics_index(workspace, [outputs])
+    assert metadata['total_score'].direction == '-'
+    records, metadata = structures.query_metrics_index(workspace, [other_dir])
+    assert metadata['total_score'].direction == '+'
+    assert list(records['path']) == list(df['path'])
+
+    # It's an error if the index can't be updated, e.g. because the database 
+    # is locked, rather than silently returning stale metrics.
+    def locked(*args, **kwargs):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(structures, 'update_metrics_index', locked)
+
+    os.utime(os.path.join(outputs, 'output_A.pdb.gz'), (0, 0))
+    try:
+        structures.refresh_metrics_index(workspace, [outputs])
+    except EnvironmentError:
+        pass
+    else:
+        assert False, "stale metrics index was not reported"
+
+def test_load_compact(tmpdir):
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+
+    df, meta = structures.load(outputs)
+    compact_df, compact_meta = structures.load(outputs, compact=True)
+
+    assert sorted(compact_meta) == sorted(meta)
+    assert compact_df['total_score'].dtype == np.float32
+    assert compact_df['sequence'].dtype.name == 'category'
+    assert list(compact_df['path']) == list(df['path'])
+    assert list(compact_df['sequence']) == list(df['sequence'])
+    assert np.allclose(compact_df['total_score'], df['total_score'], rtol=1e-6)
+    assert compact_df.memory_usage(deep=True).sum() < \
+            df.memory_usage(deep=True).sum()
+
+def test_load_columns(tmpdir):
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+
+    df, meta = structures.load(outputs)
+    columns = ['total_score', 'restraint_dist_*']
+    subset_df, subset_meta = structures.load(outputs, columns=columns)
+
+    expected = ['path'] + structures.match_columns(list(df.columns), columns)
+    assert sorted(subset_df.columns) == sorted(expected)
+    assert sorted(subset_meta) == sorted(x for x in expected if x in meta)
+    pd.testing.assert_frame_equal(subset_df, df[subset_df.columns])
+
+    # The lazy frame should read the same values, but only when asked.
+    lazy = structures.load_lazy(outputs)
+    assert len(lazy) == len(df)
+    assert list(lazy.columns) == sorted(df.columns)
+    assert sorted(lazy.metadata) == sorted(meta)
+    pd.testing.assert_series_equal(lazy['total_score'], df['total_score'])
+    assert sorted(lazy._series) == ['path', 'total_score']
+
+    query = 'restraint_dist < 1.0'
+    pd.testing.assert_frame_equal(
+            lazy.query(query), df[['path', 'restraint_dist']].query(query))
+
+def test_metrics_summary(tmpdir):
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+
+    # If only some columns are read from the cache, only those are summarized.
+    structures.load(outputs)
+    os.remove(structures.metrics_summary_path(outputs))
+
+    df, meta = structures.load(outputs, columns=['total_score'])
+    summary = structures.read_metrics_summary(outputs)
+    assert summary['num_models'] == 2
+    assert sorted(summary['columns']) == ['total_score']
+
+    # Loading more columns adds to the summary.
+    df, meta = structures.load(outputs)
+    summary = structures.read_metrics_summary(outputs)
+    stats = summary['columns']['total_score']
+    assert stats['count'] == 2
+    assert stats['min'] == df['total_score'].min()
+    assert stats['max'] == df['total_score'].max()
+    assert sum(stats['histogram']) == 2
+    assert 'sequence' not in summary['columns']
+    assert meta['total_score'].summary == stats
+
+    # Limits come from the summary, but match what they would be without it.
+    meta['total_score'].lower = '5%'
+    limits = meta['total_score'].limits(df['total_score'])
+    meta['total_score'].summary = None
+    assert np.allclose(limits, meta['total_score'].limits(df['total_score']))
+
+    # Queries can be answered if every model is on one side of a threshold.
+    lower, upper = stats['min'], stats['max']
+    count = structures.count_from_summary
+    assert count(summary) == 2
+    assert count(summary, 'total_score < {0}'.format(lower)) == 0
+    assert count(summary, 'total_score <= {0}'.format(upper)) == 2
+    assert count(summary, '{0} > total_score'.format(upper + 1)) == 2
+    assert count(summary, 'total_score > {0}'.format(lower)) is None
+    assert count(summary, 'total_score <= {0} and total_score > {1}'.format(
+        upper, upper)) == 0
+    assert count(summary, 'total_score < 0 or total_score > 0') is None
+    assert count(summary, 'unknown_metric < 0') is None
+
+    # The summary is ignored once the structures change.
+    os.remove(os.path.join(outputs, 'output_B.pdb.gz'))
+    assert structures.read_metrics_summary(outputs) is None
+
+def test_count_models(tmpdir, monkeypatch):
+    outputs = [
+            os.path.join(copy_workspace(tmpdir.mkdir(x)), '01_build_models', 'outputs')
+            for x in 'ab'
+    ]
+    os.remove(os.path.join(outputs[1], 'output_B.pdb.gz'))
+
+    # The first count has to read the models.
+    df, meta = structures.load(outputs[0], use_cache=False)
+    scores = sorted(df['total_score'])
+    query = 'total_score < {0}'.format(scores[1])
+    expected = [
+            len(df.query(query)),
+            len(df[df['path'] == 'output_A.pdb.gz'].query(query)),
+    ]
+    assert structures.count_models(outputs, query) == expected
+    assert structures.count_models(outputs) == [2, 1]
+
+    # Now the caches are up to date, and the summaries can answer some 
+    # queries on their own.
+    def fail_load_dirs(*args, **kwargs):
+        assert False, "load_dirs() shouldn't be needed"
+
+    monkeypatch.setattr(structures, 'load_dirs', fail_load_dirs)
+    assert structures.count_models(outputs, 'total_score > 0') == [0, 0]
+
+def test_make_picks_twice(tmpdir):
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    pick_file = str(tmpdir.join('picks.yml'))
+    with open(pick_file, 'w') as file:
+        file.write('threshold:\n- total_score < 0\n')
+
+    # Models that rosetta can't read are copied rather than linked, but they 
+    # still shouldn't be picked twice.
+    for name in os.listdir(outputs):
+        if pdb_codecs.is_pdb_path(name):
+            pdb_codecs.recompress(os.path.join(outputs, name), 'bz2')
+
+    workspace = structures.pipeline.FixbbDesigns(root, 1)
+    workspace.make_dirs()
+
+    for i in range(2):
+        structures.make_picks(workspace, pick_file, keep_dups=True)
+        assert sorted(workspace.input_names) == ['0000.pdb.gz', '0001.pdb.gz']
+
+    sources = sorted(structures.picked_source(x) for x in workspace.input_paths)
+    assert sources == [
+            os.path.join(outputs, 'output_{0}.pdb.bz2'.format(x)) for x in 'AB']
+
+def test_sequence_matrix(tmpdir):
+    matrix = structures.sequence_matrix([u'MEK', b'ME', np.nan])
+    assert matrix.dtype == np.uint8
+    assert matrix.tolist() == [[77, 69, 75], [77, 69, 0], [0, 0, 0]]
+    assert matrix[0,1:].tostring() == b'EK'
+
+    # The designable positions of the representative should match the 
+    # sequence.
+    root = copy_workspace(tmpdir)
+    outputs = os.path.join(root, '01_build_models', 'outputs')
+    design = structures.Design(outputs)
+    resis = sorted(int(i) for i in design.resfile.designable)
+    sequence = design['sequence'][design.rep]
+
+    assert design.resfile_sequence == ''.join(sequence[i-1] for i in resis)
+    assert design.designable_sequences.shape == (2, len(resis))
+
+    # Resfiles that don't match the sequences are a clear error.
+    try:
+        structures.designable_mask(design.resfile, max(resis) - 1)
+    except EnvironmentError as error:
+        assert design.resfile.path in str(error)
+    else:
+        assert False, "out of range resfile position was accepted"
+
+def test_prefetch_pdb_lines(tmpdir):
+    import gzip
+    paths = []
+    for i in range(5):
+        path = str(tmpdir.join('{0}.pdb.gz'.format(i)))
+        with gzip.open(path, 'wb') as file:
+            file.write(b'ATOM {0}\nEND\n'.format(i))
+        paths.append(path)
+
+    bad_path = str(tmpdir.join('bad.pdb.gz'))
+    with open(bad_path, 'w') as file:
+        file.write('not gzipped')
+    paths.insert(2, bad_path)
+
+    for num_threads in 0, 2:
+        results = list(structures.prefetch_pdb_lines(paths, num_threads, 2))
+        assert [x[0] for x in results] == paths
+        assert results[0][1] == [b'ATOM 0\n', b'END\n']
+        assert results[2][1] is None
+
+def test_pdb_codecs(tmpdir):
+    lines = [b'ATOM 0\n', b'END\n']
+    extra = [b'EXTRA_METRIC x 1.0\n']
+    path = str(tmpdir.join('model.pdb.gz'))
+    pdb_codecs.write_bytes(path, b''.join(lines))
+
+    for name in 'none', 'bz2', 'gz':
+        path = pdb_codecs.recompress(path, name)
+        assert pdb_codecs.find_codec(path).name == name
+        assert pdb_codecs.find_model(str(tmpdir.join('model.pdb.gz'))) == path
+        assert os.listdir(str(tmpdir)) == [os.path.basename(path)]
+
+        pdb_codecs.append_lines(path, extra)
+        assert pdb_codecs.read_lines(path) == lines + extra
+        lines += extra
+
+    assert pdb_codecs.strip_extension(path) == str(tmpdir.join('model'))
+    assert not pdb_codecs.is_pdb_path('model.metrics.json')
+
+    # Truncated files should be errors, not silently shorter models.
+    with open(path, 'rb') as file:
+        data = file.read()
+    with open(path, 'wb') as file:
+        file.write(data[:-10])
+
+    try:
+        pdb_codecs.read_lines(path)
+    except EnvironmentError:
+        pass
+    else:
+        assert False, "truncated model was read"
+
+    # So should corrupted ones.
+    corrupt = bytearray(data)
+    corrupt[-6] ^= 1
+    with open(path, 'wb') as file:
+        file.write(bytes(corrupt))
+
+    try:
+        pdb_codecs.read_lines(path)
+    except EnvironmentError:
+        pass
+    else:
+        assert False, "corrupted model was read"
+
+def test_rosetta_pdb_parser():
+    lines = [
+        b'ATOM      1  N   MET A   1      27.340  24.430   2.614  1.00  0.00           N  \n',
+        b'ATOM      2  CA  MET A   1      26.266  25.413   2.842  1.00  0.00           C  \n',
+        b'ATOM      3  N   GLU A   2      26.913  26.639  -3.097  1.00  0.00           N  \n',
+        b'HETATM    4  C1  EQU B   3      27.000  20.000   1.000  1.00  0.00           C  \n',
+        b'#BEGIN_POSE_ENERGIES_TABLE\n',
+        b'label fa_atr fa_dun total\n',
+        b'pose -10.0 5.0 -5.0\n',
+        b'MET:NtermProteinFull_1 -1.0 1.5 0.5\n',
+        b'GLU_2 -2.0 2.5 0.5\n',
+        b'pdb_EQU_3 -3.0 0 -3.0\n',
+        b'#END_POSE_ENERGIES_TABLE\n',
+        b'GLU_2 -4.0 4.5 0.5\n',
+        b'  all_heavy_atom_unsats 2 3\n',
+        b'EXTRA_METRIC Foldability [+] 0.5\n',
+        b'EXTRA_METRIC IGNORE 911\n',
+    ]
+    parser = structures.RosettaPdbParser([2, 3], [('CA', 1), ('CB', 1)])
+    record, meta = parser.parse(lines)
+
+    assert record == {
+            'total_score': -5.0,
+            'sequence': 'ME',
+            'buried_unsats': 3.0,
+            'foldability': 0.5,
+    }
+    assert set(meta) == {'total_score', 'buried_unsats', 'foldability'}
+    assert meta['foldability'].direction == '+'
+    assert parser.sequence_map == {1: 'M', 2: 'E', 3: 'X'}
+    assert parser.dunbrack_scores == {2: 2.5}
+    assert list(parser.atom_xyzs['CA', 1]) == [26.266, 25.413, 2.842]
+    assert np.isnan(parser.atom_xyzs['CB', 1]).all()
+
+    # Make sure coordinates aren't carried over from one structure to the 
+    # next.
+    parser.parse([x for x in lines if b' CA ' not in x])
+    assert np.isnan(parser.xyzs).all()
+
+def test_score_metadata_registry():
+    registry = structures.ScoreMetadataRegistry()
+    meta = registry.extra_metric('Foldability Filter [+|guide 0.1]', 5)
+
+    assert meta.name == 'foldability_filter'
+    assert meta.direction == '+'
+    assert meta.guide == 0.1
+    assert meta.order == 5
+    assert registry.extra_metric('Foldability Filter [+|guide 0.1]', 5) is meta
+    assert registry.metadata == {'foldability_filter': meta}
+
+def test_evaluate_restraints():
+    restraints = [
+        structures.CoordinateRestraint(
+            'CA 1 CA 1 1.0 2.0 3.0 HARMONIC 0.0 1.0'.split()),
+        structures.AtomPairRestraint(
+            'CA 1 CB 2 HARMONIC 3.8 0.1'.split()),
+        structures.DihedralRestraint(
+            'N 1 CA 1 C 1 N 2 CIRCULARHARMONIC 3.1 0.1'.split()),
+        structures.AngleRestraint(
+            'N 1 CA 1 C 1 CIRCULARHARMONIC 1.9 0.1'.split()),
+        structures.DihedralRestraint(
+            'CA 1 C 1 N 2 CA 2 CIRCULARHARMONIC -3.1 0.1'.split()),
+    ]
+    atoms = structures.find_restrained_atoms(restraints)
+    xyzs = np.random.RandomState(0).normal(size=(50, len(atoms), 3))
+
+    deviations = structures.evaluate_restraints(restraints, atoms, xyzs)
+
+    for i, model in enumerate(xyzs):
+        atom_xyzs = dict(zip(atoms, model))
+        for j, restraint in enumerate(restraints):
+            expected = restraint.distance_from_ideal(atom_xyzs)
+            assert np.isclose(deviations[i,j], expected, rtol=1e-10)
+
+def test_metrics_table(tmpdir):
+    table_dir = str(tmpdir.join('table'))
+    df = pd.DataFrame({
+        'path': ['a.pdb.gz', 'b.pdb.gz'],
+        'total_score': [-1.5, np.nan],
+    })
+    structures.write_metrics_table(table_dir, df)
+
+    pd.testing.assert_frame_equal(
+            structures.read_metrics_table(table_dir), df)
+    pd.testing.assert_frame_equal(
+            structures.read_metrics_table(table_dir, ['total_score']),
+            df[['total_score']])
+
+    # Tables are never replaced, because readers could see them missing.
+    try:
+        structures.write_metrics_table(table_dir, df[['path']])
+    except EnvironmentError:
+        pass
+    else:
+        assert False, "existing table was replaced"
+    pd.testing.assert_frame_equal(
+            structures.read_metrics_table(table_dir), df)
 
+def test_metrics_table_families(tmpdir):
+    import json
+    table_dir = str(tmpdir.join('table'))
+    df = pd.DataFrame({
+        'path': ['a.pdb.gz', 'b.pdb.gz', 'c.pdb.gz'],
+        'restraint_dist': [0.5, 1.0, 1.5],
+        'fragment_crmsd_pos_1': [0.1, 0.2, np.nan],
+        'fragment_crmsd_pos_2': [0.3, 0.4, 0.5],
+        'dunbrack_score_x38': [np.nan, 2.0, np.nan],
+        'dunbrack_score_x40': [np.nan, np.nan, np.nan],
+    })
+    structures.write_metrics_table(table_dir, df)
 
+    with open(os.path.join(table_dir, 'schema.json')) as file:
+        schema = json.load(file)
+    layouts = {x['prefix']: x['layout'] for x in schema['families']}
+    assert layouts == {'fragment_crmsd_pos_': 'dense', 'dunbrack_score_': 'long'}
+    assert not os.path.exists(os.path.join(table_dir, 'fragment_crmsd_pos_1.npy'))
 
+    pd.testing.assert_frame_equal(
+            structures.read_metrics_table(table_dir), df)
+    pd.testing.assert_frame_equal(
+            structures.read_metrics_table(table_dir, ['dunbrack_score_*']),
+            df[['dunbrack_score_x38', 'dunbrack_score_x40']])